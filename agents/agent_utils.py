@@ -1,7 +1,14 @@
 import json
 import time
 
-from openaiAPI import query_openai
+from openaiAPI import (
+    query_openai,
+    get_provider_context,
+    set_provider_context,
+    openai_add_dropped_calls,
+    GenerationCancelledError,
+    ProviderContext,
+)
 from typing import Tuple, List
 from threading import Thread, Lock
 
@@ -128,6 +135,7 @@ def query_in_parallel(
 ) -> list:
     """
     Query a function in parallel.
+    The calls run with the provider context (Ex: priority class) of the caller.
 
     Args:
         function (callable): the function to query
@@ -137,21 +145,35 @@ def query_in_parallel(
 
     Returns:
         list: the list of results
+
+    Raises:
+        GenerationCancelledError: if the generation of the caller has been cancelled
+            (the calls that have not started yet are dropped)
     """
 
     results = []
     threads = []
 
     result_lock = Lock()
+    context = get_provider_context()
+    cancel_token = context.cancel_token
 
     def call_and_store_result(id, args):
-        result = function(*args)
+        set_provider_context(context)
+        try:
+            result = function(*args)
+        except GenerationCancelledError:
+            result = None
 
         with result_lock:
             results.append([id, result])
 
     numbers_of_call = len(args_list)
     for start_index in range(0, numbers_of_call, max_parallel_queries):
+        if cancel_token is not None and cancel_token.is_cancelled():
+            openai_add_dropped_calls(numbers_of_call - start_index)
+            break
+
         args_to_call = args_list[start_index : start_index + max_parallel_queries]
         for i, args in enumerate(args_to_call):
             t = Thread(
@@ -165,8 +187,63 @@ def query_in_parallel(
             t.join()
 
         if start_index + max_parallel_queries < numbers_of_call:
-            time.sleep(time_between_queries)
+            if cancel_token is not None:
+                cancel_token.wait(time_between_queries)
+            else:
+                time.sleep(time_between_queries)
+
+    if cancel_token is not None:
+        cancel_token.raise_if_cancelled()
 
     results = sorted(results, key=lambda x: x[0])
     results = [result[1] for result in results]
     return results
+
+
+def query_in_background(
+    function: callable,
+    args_list: List[List],
+    max_parallel_queries,
+    time_between_queries,
+    on_result: callable = None,
+    context: ProviderContext = None,
+) -> Thread:
+    """
+    Query a function in parallel from a background thread (see query_in_parallel).
+
+    Args:
+        function (callable): the function to query
+        args_list (List[List[]]): the list of list of arguments to pass to the function
+        max_parallel_queries (int): the maximum number of parallel queries
+        time_between_queries (int): the time to wait between queries
+        on_result (callable(int, object)): called with the index and the result of each call as soon as it finishes
+        context (ProviderContext): the provider context of the calls (None -> copy of the caller context)
+            -> changing its priority affects the calls that have not started yet
+
+    Returns:
+        Thread: the started thread (join it to wait for the results)
+    """
+    if context is None:
+        context = get_provider_context().copy()
+
+    def call_and_notify(index, *args):
+        result = function(*args)
+        if on_result is not None:
+            on_result(index, result)
+        return result
+
+    def run():
+        set_provider_context(context)
+        try:
+            query_in_parallel(
+                function=call_and_notify,
+                args_list=[[i, *args] for i, args in enumerate(args_list)],
+                max_parallel_queries=max_parallel_queries,
+                time_between_queries=time_between_queries,
+            )
+        except GenerationCancelledError:
+            pass
+
+    thread = Thread(target=run, daemon=True)
+    thread.start()
+    return thread
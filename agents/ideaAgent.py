@@ -1,10 +1,8 @@
-import json
-import os
-
 from agents.agent_utils import (
     AGENT_INTRODUCTION,
     query_llm_with_feedback_json,
 )
+from storage.idea_store import append_idea, read_last_ideas
 
 
 def query_expand_story_idea(story_idea) -> dict:
@@ -81,22 +79,24 @@ Make sure to have your answer in the JSON format.
     )
 
 
-PREVIOUS_IDEAS_FILE_PATH = "out/previous_ideas.json"
+# Number of previous ideas given to the LLM to avoid similar ideas
+PREVIOUS_IDEAS_PROMPT_LIMIT = 50
 
 
-def get_previous_ideas() -> list:
+def get_previous_ideas(limit: int = PREVIOUS_IDEAS_PROMPT_LIMIT) -> list:
     """
     Get the previous ideas.
 
+    Args:
+        limit (int): the maximum number of ideas (the most recent ones)
+
     Returns:
         list: the previous ideas
     """
-    base_path = os.path.dirname(PREVIOUS_IDEAS_FILE_PATH)
-    os.makedirs(base_path, exist_ok=True)
     try:
-        with open(PREVIOUS_IDEAS_FILE_PATH, "r") as f:
-            ideas = json.load(f)
-    except:
+        ideas = read_last_ideas(limit)
+    except Exception as e:
+        print("Failed to read the previous ideas: {}".format(e))
         ideas = []
 
     return ideas
@@ -109,10 +109,7 @@ def add_new_idea(idea: dict):
     Args:
         idea (dict): the idea (story information)
     """
-    ideas = get_previous_ideas()
-    ideas.append(idea)
-    with open(PREVIOUS_IDEAS_FILE_PATH, "w") as f:
-        json.dump(ideas, f)
+    append_idea(idea)
 
 
 def query_idea() -> dict:
@@ -122,9 +119,7 @@ def query_idea() -> dict:
     Returns:
         str: The story idea
     """
-    ideas = get_previous_ideas()
-
-    ideas = ideas[-50:]
+    ideas = get_previous_ideas(PREVIOUS_IDEAS_PROMPT_LIMIT)
 
     JSON_FORMAT = """
 {
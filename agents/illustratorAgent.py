@@ -3,6 +3,7 @@ import re
 from typing import Tuple, List
 from agents.agent_utils import query_llm_with_feedback_json
 from openaiAPI import query_openai_image_generation
+from storage.image_prompt_index import find_similar_image, add_image_prompt
 
 
 def _get_valid_illustrations(
@@ -253,3 +254,33 @@ Provide the image description in the following format:
     if answer is None:
         return None
     return answer["image_description"]
+
+
+def query_illustration(
+    description: str, style: str = "vivid", reuse_similar: bool = True
+) -> str:
+    """
+    Get the illustration of a description: the image of a near-identical description is
+    reused (see storage/image_prompt_index.py), else a new image is generated.
+
+    Args:
+        description (str): The complete description of the illustration (the prompt)
+        style (str): The style of the image (standard or vivid)
+        reuse_similar (bool): False to always generate a new image
+
+    Returns:
+        str: asset id of the image (see storage.asset_store)
+    """
+    if description is None:
+        return None
+
+    if reuse_similar:
+        asset_id, similarity = find_similar_image(description, style)
+        if asset_id is not None:
+            print("Image reused (prompt similarity: {:.2f})".format(similarity))
+            return asset_id
+
+    asset_id = query_openai_image_generation(description, style)
+    if asset_id is not None:
+        add_image_prompt(description, style, asset_id)
+    return asset_id
@@ -1,16 +1,15 @@
-import os
-
 from openaiAPI import query_openai_tts
 
 
-def query_speech(text: str, working_folder: str = "out") -> str:
+def query_speech(text: str, stream=None) -> str:
     """
     Read the story.
 
     Args:
         text (str): the text to read
+        stream (SpeechStream): receives the audio while it is synthesized (None -> no streaming)
 
     Returns:
-        str: the file path of the generated speech
+        str: the asset id of the generated speech
     """
-    return query_openai_tts(text=text, working_folder=working_folder)
+    return query_openai_tts(text=text, stream=stream)
@@ -0,0 +1,229 @@
+"""
+Measure how the story storage behaves with the size of the story library (offline).
+
+For each library size, a synthetic library is generated in the story.json + asset files layout
+of the story folders, then the benchmark measures:
+    - get_story_infos: the first visit of the history (catalog build) and the first / a deep page
+    - AIStory.load_story: opening a story (and reading all its parts) before and after its first save
+    - Story.save_to_file: the first save (conversion to the story log) and the save of a new part
+    - the disk usage of the stories, their assets, the catalog and the search index
+
+Usage (from the repository root):
+    python -m bench.bench_storage_scale --sizes 1000 10000 100000 --output bench_output.json
+"""
+
+import argparse
+import json
+import os
+import random
+import tempfile
+import time
+
+from bench.synthetic_stories import make_synthetic_story, make_synthetic_part
+
+import story.story
+import storage.asset_store
+import storage.story_catalog
+import storage.story_log
+import storage.story_search
+from story.story_type.ai_story import AIStory
+from storage.story_catalog import rebuild_catalog, catalog_list_stories
+
+# Number of different synthetic stories (the library repeats them with other ids)
+NUMBER_OF_TEMPLATES = 64
+# Page size of the history (see streamlit_app/main_page.py)
+STORIES_PER_PAGE = 10
+
+
+def _summarize(durations: list) -> dict:
+    durations = sorted(durations)
+    return {
+        "mean_ms": 1000 * sum(durations) / len(durations),
+        "p50_ms": 1000 * durations[len(durations) // 2],
+        "p95_ms": 1000 * durations[min(len(durations) - 1, int(0.95 * len(durations)))],
+        "max_ms": 1000 * durations[-1],
+    }
+
+
+def _measure(function, arguments: list) -> dict:
+    durations = []
+    for argument in arguments:
+        start_time = time.perf_counter()
+        function(argument)
+        durations.append(time.perf_counter() - start_time)
+    return _summarize(durations)
+
+
+def _make_templates(number_of_parts: int) -> list:
+    return [
+        make_synthetic_story(number_of_parts, seed=seed, id="template").to_dict()
+        for seed in range(NUMBER_OF_TEMPLATES)
+    ]
+
+
+def _write_story(story_dict: dict, directory: str, asset_data: bytes) -> None:
+    """
+    Write a story folder of the legacy layout: story.json and its image and speech files.
+    """
+    os.makedirs(directory)
+    for part in story_dict["story_parts"]:
+        for module_dict in part:
+            for path_key in ["image_path", "speech_file_path"]:
+                if module_dict.get(path_key) is not None:
+                    path = os.path.join(
+                        directory, os.path.basename(module_dict[path_key])
+                    )
+                    with open(path, "wb") as file:
+                        file.write(asset_data)
+                    module_dict[path_key] = path
+    with open(os.path.join(directory, "story.json"), "w") as file:
+        json.dump(story_dict, file, indent=4)
+
+
+def _generate_library(
+    library: str, size: int, templates: list, asset_bytes: int
+) -> float:
+    asset_data = os.urandom(asset_bytes)
+    start_time = time.perf_counter()
+    for i in range(size):
+        story_dict = json.loads(json.dumps(templates[i % len(templates)]))
+        story_dict["id"] = "story{:07d}".format(i)
+        story_dict["saved_time"] = "2024-01-01T00:00:{:02d}.{:06d}".format(
+            (i // 10**6) % 60, i % 10**6
+        )
+        _write_story(story_dict, os.path.join(library, story_dict["id"]), asset_data)
+    return time.perf_counter() - start_time
+
+
+def _get_library_usage(library: str) -> dict:
+    stories = {"files": 0, "bytes": 0, "disk_bytes": 0}
+    assets = {"files": 0, "bytes": 0, "disk_bytes": 0}
+    for name in os.listdir(library):
+        for filename in os.listdir(os.path.join(library, name)):
+            stat = os.stat(os.path.join(library, name, filename))
+            usage = stories if filename.startswith("story.") else assets
+            usage["files"] += 1
+            usage["bytes"] += stat.st_size
+            usage["disk_bytes"] += getattr(stat, "st_blocks", 0) * 512
+    return {"story_files": stories, "asset_files": assets}
+
+
+def _get_database_size(path: str) -> int:
+    # The SQLite database and its write-ahead log
+    return sum(
+        os.path.getsize(path + suffix)
+        for suffix in ["", "-wal"]
+        if os.path.exists(path + suffix)
+    )
+
+
+def _bench_size(
+    size: int, templates: list, args: argparse.Namespace, directory: str
+) -> dict:
+    library = os.path.join(directory, "stories")
+    os.makedirs(library)
+    # Every file of the benchmark stays in its temporary directory
+    story.story.WORKING_FOLDER = library + "/"
+    storage.story_catalog.CATALOG_PATH = os.path.join(directory, "catalog.sqlite")
+    storage.story_search.SEARCH_INDEX_PATH = os.path.join(directory, "search.sqlite")
+    storage.asset_store.ASSET_STORE_PATH = os.path.join(directory, "assets")
+    storage.asset_store.ASSET_DATABASE_PATH = os.path.join(
+        directory, "assets", "assets.sqlite"
+    )
+
+    results = {"stories": size}
+    results["generate_seconds"] = _generate_library(
+        library, size, templates, args.asset_bytes
+    )
+    results["disk_usage"] = _get_library_usage(library)
+
+    # get_story_infos: the first visit builds the catalog
+    start_time = time.perf_counter()
+    rebuild_catalog([library])
+    catalog_list_stories(limit=STORIES_PER_PAGE)
+    results["get_story_infos_first_visit_seconds"] = time.perf_counter() - start_time
+    results["get_story_infos_first_page"] = _measure(
+        lambda _: catalog_list_stories(limit=STORIES_PER_PAGE), range(args.repeat)
+    )
+    # Keyset paging: the page after the middle of the history
+    middle_cursor = catalog_list_stories(limit=max(1, size // 2))[-1]["cursor"]
+    results["get_story_infos_deep_page"] = _measure(
+        lambda _: catalog_list_stories(limit=STORIES_PER_PAGE, after=middle_cursor),
+        range(args.repeat),
+    )
+
+    rng = random.Random(0)
+    sample = [
+        os.path.join(library, "story{:07d}".format(i))
+        for i in rng.sample(range(size), min(args.sample, size))
+    ]
+
+    def load(path: str):
+        return AIStory.load_story(path)
+
+    def load_and_read(path: str):
+        for part in AIStory.load_story(path).get_story_parts():
+            part.to_prompt_string()
+
+    results["load_story_legacy"] = _measure(load, sample)
+    results["load_and_read_story_legacy"] = _measure(load_and_read, sample)
+
+    # save_to_file is measured in the calling thread (no write-behind)
+    story.story.SAVE_WRITE_BEHIND = False
+    stories = {path: AIStory.load_story(path) for path in sample}
+    results["save_first"] = _measure(lambda path: stories[path].save_to_file(), sample)
+
+    def save_new_part(path: str):
+        story_obj = stories[path]
+        story_obj._story_parts.append(make_synthetic_part(rng, story_obj.id))
+        story_obj.save_to_file()
+
+    results["save_new_part"] = _measure(save_new_part, sample)
+    story.story.SAVE_WRITE_BEHIND = True
+
+    results["load_story_log"] = _measure(load, sample)
+    results["load_and_read_story_log"] = _measure(load_and_read, sample)
+    results["database_bytes"] = {
+        "catalog": _get_database_size(storage.story_catalog.CATALOG_PATH),
+        "search_index": _get_database_size(storage.story_search.SEARCH_INDEX_PATH),
+    }
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000])
+    parser.add_argument("--parts", type=int, default=4, help="parts per story")
+    parser.add_argument(
+        "--asset-bytes", type=int, default=4096, help="size of each image and speech file"
+    )
+    parser.add_argument(
+        "--sample", type=int, default=200, help="stories loaded and saved per size"
+    )
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--no-fsync", action="store_true")
+    parser.add_argument("--output", default=None, help="JSON output file")
+    args = parser.parse_args()
+
+    storage.story_log.STORY_LOG_FSYNC = not args.no_fsync
+
+    templates = _make_templates(args.parts)
+    results = {
+        "parts": args.parts,
+        "asset_bytes": args.asset_bytes,
+        "fsync": not args.no_fsync,
+        "sizes": {},
+    }
+    for size in args.sizes:
+        with tempfile.TemporaryDirectory() as directory:
+            results["sizes"][str(size)] = _bench_size(size, templates, args, directory)
+
+    output = json.dumps(results, indent=4)
+    print(output)
+    if args.output is not None:
+        with open(args.output, "w") as file:
+            file.write(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+"""
+Compare the cost of opening a long story:
+    - eager: every part and module is decoded (AIStory.load_story before the lazy loader)
+    - lazy: AIStory.load_story, then the last part is read (what the apps show first)
+
+Usage (from the repository root):
+    python -m bench.bench_story_loading --parts 100 --output bench_output.json
+"""
+
+import argparse
+import json
+import os
+import tempfile
+import time
+
+from bench.synthetic_stories import make_synthetic_story
+
+import story.story
+import storage.asset_store
+import storage.story_catalog
+import storage.story_search
+from story.story_type.ai_story import AIStory
+from story.story_part import StoryPart
+from story.story_modules import StoryModules
+from storage.story_log import read_story_dict
+
+
+def _open_eager(directory: str):
+    story_dict, _ = read_story_dict(directory)
+    story_obj = AIStory.from_dict(story_dict)
+    story_obj._story_parts = [
+        StoryPart([StoryModules.from_dict(module) for module in part])
+        for part in story_dict["story_parts"]
+    ]
+    return story_obj._story_parts[-1]
+
+
+def _open_lazy(directory: str):
+    story_obj = AIStory.load_story(directory)
+    return story_obj.get_story_parts()[-1]
+
+
+def _measure(function, directory: str, repeat: int) -> float:
+    durations = []
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        function(directory)
+        durations.append(time.perf_counter() - start_time)
+    return 1000 * min(durations)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--parts", type=int, default=100)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--output", default=None, help="JSON output file")
+    args = parser.parse_args()
+
+    results = {"parts": args.parts, "open_ms": {}}
+    with tempfile.TemporaryDirectory() as working_folder:
+        # Every file of the benchmark stays in its temporary directory
+        story.story.WORKING_FOLDER = os.path.join(working_folder, "stories") + "/"
+        storage.story_catalog.CATALOG_PATH = os.path.join(working_folder, "catalog.sqlite")
+        storage.story_search.SEARCH_INDEX_PATH = os.path.join(
+            working_folder, "search.sqlite"
+        )
+        storage.asset_store.ASSET_STORE_PATH = os.path.join(working_folder, "assets")
+        storage.asset_store.ASSET_DATABASE_PATH = os.path.join(
+            working_folder, "assets", "assets.sqlite"
+        )
+        story_obj = make_synthetic_story(args.parts)
+        story_obj.save_to_file(wait=True)
+        directory = story_obj.get_working_folder()
+
+        results["open_ms"]["eager"] = _measure(_open_eager, directory, args.repeat)
+        results["open_ms"]["lazy"] = _measure(_open_lazy, directory, args.repeat)
+
+    output = json.dumps(results, indent=4)
+    print(output)
+    if args.output is not None:
+        with open(args.output, "w") as file:
+            file.write(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""
+Measure the cost of the story modules: construct, serialize (to_dict) and deserialize
+(StoryModules.from_dict) modules shaped like the generated ones, and their memory.
+
+Usage (from the repository root):
+    python -m bench.bench_story_modules --modules 100000 --output bench_output.json
+"""
+
+import argparse
+import json
+import random
+import time
+import tracemalloc
+
+from bench.synthetic_stories import make_text
+
+from story.story_modules import (
+    StoryModules,
+    TextModule,
+    ImageModule,
+    ChoiceModule,
+    PossibleChoicesModule,
+)
+
+
+def _make_module(index: int, text: str):
+    kind = index % 4
+    if kind == 0 or kind == 2:
+        module = TextModule(text)
+        module.set_speech_asset("{:064x}.mp3".format(index))
+        return module
+    if kind == 1:
+        return ImageModule(None, "{:064x}.jpg".format(index))
+
+    module = PossibleChoicesModule([ChoiceModule(text[:40]) for _ in range(3)])
+    module.set_user_choice(module.get_choices()[index % 3])
+    return module
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--modules", type=int, default=100000)
+    parser.add_argument("--output", default=None, help="JSON output file")
+    args = parser.parse_args()
+
+    # Shared texts: the measured memory is the memory of the module objects
+    rng = random.Random(0)
+    texts = [make_text(rng, 120) for _ in range(16)]
+
+    results = {"modules": args.modules}
+
+    tracemalloc.start()
+    start_time = time.perf_counter()
+    modules = [_make_module(i, texts[i % len(texts)]) for i in range(args.modules)]
+    results["construct_seconds"] = time.perf_counter() - start_time
+    results["bytes_per_module"] = tracemalloc.get_traced_memory()[0] / args.modules
+    tracemalloc.stop()
+
+    start_time = time.perf_counter()
+    module_dicts = [module.to_dict() for module in modules]
+    results["serialize_seconds"] = time.perf_counter() - start_time
+
+    del modules
+    start_time = time.perf_counter()
+    modules = [StoryModules.from_dict(module_dict) for module_dict in module_dicts]
+    results["deserialize_seconds"] = time.perf_counter() - start_time
+
+    output = json.dumps(results, indent=4)
+    print(output)
+    if args.output is not None:
+        with open(args.output, "w") as file:
+            file.write(output)
+
+
+if __name__ == "__main__":
+    main()
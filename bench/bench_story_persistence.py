@@ -0,0 +1,101 @@
+"""
+Compare the cost of saving a story after each part:
+    - legacy: the whole story is dumped in story.json (json.dump(..., indent=4))
+    - log: the new part is appended to the story log (story.jsonl)
+    - write_behind: the save is queued and written by the persistence queue
+      (measured: the time the caller waits, and the time to flush the queue at the end)
+
+Usage (from the repository root):
+    python -m bench.bench_story_persistence --parts 200 --output bench_output.json
+"""
+
+import argparse
+import json
+import os
+import random
+import tempfile
+import time
+
+from bench.synthetic_stories import make_synthetic_story, make_synthetic_part
+
+import story.story
+import storage.asset_store
+import storage.story_catalog
+import storage.story_log
+import storage.story_search
+from storage.persistence_queue import flush_saves
+
+
+def _save_legacy(story_obj):
+    directory = story_obj.get_working_folder()
+    os.makedirs(directory, exist_ok=True)
+    with open(directory + "/story.json", "w") as file:
+        json.dump(story_obj.to_dict(), file, indent=4)
+
+
+def _run(mode: str, number_of_parts: int) -> list:
+    story.story.SAVE_WRITE_BEHIND = mode == "write_behind"
+    story_obj = make_synthetic_story(0)
+    rng = random.Random(1)
+    durations = []
+    for _ in range(number_of_parts):
+        story_obj._story_parts.append(make_synthetic_part(rng, story_obj.id))
+        start_time = time.perf_counter()
+        if mode == "legacy":
+            _save_legacy(story_obj)
+        else:
+            story_obj.save_to_file()
+        durations.append(time.perf_counter() - start_time)
+    return durations
+
+
+def _window_mean(durations: list, end: int, size: int = 10) -> float:
+    window = durations[max(0, end - size) : end]
+    return sum(window) / len(window)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--parts", type=int, default=200)
+    parser.add_argument("--no-fsync", action="store_true")
+    parser.add_argument("--output", default=None, help="JSON output file")
+    args = parser.parse_args()
+
+    storage.story_log.STORY_LOG_FSYNC = not args.no_fsync
+
+    results = {"parts": args.parts, "fsync": not args.no_fsync, "modes": {}}
+    with tempfile.TemporaryDirectory() as working_folder:
+        # Every file of the benchmark stays in its temporary directory
+        story.story.WORKING_FOLDER = os.path.join(working_folder, "stories") + "/"
+        storage.story_catalog.CATALOG_PATH = os.path.join(working_folder, "catalog.sqlite")
+        storage.story_search.SEARCH_INDEX_PATH = os.path.join(
+            working_folder, "search.sqlite"
+        )
+        storage.asset_store.ASSET_STORE_PATH = os.path.join(working_folder, "assets")
+        storage.asset_store.ASSET_DATABASE_PATH = os.path.join(
+            working_folder, "assets", "assets.sqlite"
+        )
+        for mode in ["legacy", "log", "write_behind"]:
+            durations = _run(mode, args.parts)
+            start_time = time.perf_counter()
+            flush_saves()
+            flush_seconds = time.perf_counter() - start_time
+            checkpoints = sorted({10, args.parts // 2, args.parts})
+            results["modes"][mode] = {
+                "flush_seconds": flush_seconds,
+                "total_seconds": sum(durations),
+                "mean_save_ms_at_part": {
+                    str(part): 1000 * _window_mean(durations, part)
+                    for part in checkpoints
+                },
+            }
+
+    output = json.dumps(results, indent=4)
+    print(output)
+    if args.output is not None:
+        with open(args.output, "w") as file:
+            file.write(output)
+
+
+if __name__ == "__main__":
+    main()
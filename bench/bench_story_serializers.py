@@ -0,0 +1,122 @@
+"""
+Compare the story serializers (size, write and load time) on the demo story and a synthetic story:
+    - legacy: story.json (json.dump(..., indent=4))
+    - json, msgpack, msgpack+zstd: the story log (see storage/story_serializer.py)
+
+Usage (from the repository root):
+    python -m bench.bench_story_serializers --parts 100 --output bench_output.json
+"""
+
+import argparse
+import json
+import os
+import tempfile
+import time
+
+from bench.synthetic_stories import make_synthetic_story
+
+import storage.story_log
+import storage.story_serializer
+from story.story_type.ai_story import AIStory
+from storage.story_log import (
+    LEGACY_STORY_FILENAME,
+    get_story_log_path,
+    read_story_dict,
+    write_story_log,
+)
+
+SERIALIZERS = ["json", "msgpack", "msgpack+zstd"]
+DEMO_STORY = "demo_story/j77T9mMqWf"
+
+
+def _min_time_ms(function, repeat: int) -> float:
+    durations = []
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        function()
+        durations.append(time.perf_counter() - start_time)
+    return 1000 * min(durations)
+
+
+def _bench_legacy(story_dict: dict, directory: str, repeat: int) -> dict:
+    path = os.path.join(directory, LEGACY_STORY_FILENAME)
+
+    def write():
+        with open(path, "w") as file:
+            json.dump(story_dict, file, indent=4)
+
+    write_ms = _min_time_ms(write, repeat)
+    return {
+        "bytes": os.path.getsize(path),
+        "write_ms": write_ms,
+        "load_ms": _min_time_ms(lambda: read_story_dict(directory), repeat),
+    }
+
+
+def _bench_serializer(story_dict: dict, directory: str, repeat: int) -> dict:
+    metadata = {
+        key: value
+        for key, value in story_dict.items()
+        if key not in ["story_parts", "saved_time"]
+    }
+
+    def write():
+        write_story_log(
+            directory, metadata, story_dict["story_parts"], story_dict["saved_time"]
+        )
+
+    write_ms = _min_time_ms(write, repeat)
+    return {
+        "bytes": os.path.getsize(get_story_log_path(directory)),
+        "write_ms": write_ms,
+        "load_ms": _min_time_ms(lambda: read_story_dict(directory), repeat),
+        "open_lazy_ms": _min_time_ms(
+            lambda: AIStory.load_story(directory).get_story_parts()[-1], repeat
+        ),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--parts", type=int, default=100)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--output", default=None, help="JSON output file")
+    args = parser.parse_args()
+
+    # Compare the encodings only (story.json is not flushed to the disk either)
+    storage.story_log.STORY_LOG_FSYNC = False
+
+    stories = {"synthetic_{}_parts".format(args.parts): make_synthetic_story(args.parts)}
+    if os.path.exists(DEMO_STORY):
+        stories["demo"] = AIStory.load_story(DEMO_STORY)
+
+    results = {}
+    for story_name, story_obj in stories.items():
+        story_dict = story_obj.to_dict()
+        results[story_name] = {}
+        with tempfile.TemporaryDirectory() as directory:
+            results[story_name]["legacy"] = _bench_legacy(
+                story_dict, directory, args.repeat
+            )
+            os.remove(os.path.join(directory, LEGACY_STORY_FILENAME))
+
+            for name in SERIALIZERS:
+                storage.story_serializer.STORY_SERIALIZER = name
+                try:
+                    storage.story_serializer.get_serializer()
+                except RuntimeError as e:
+                    results[story_name][name] = {"skipped": str(e)}
+                    continue
+                results[story_name][name] = _bench_serializer(
+                    story_dict, directory, args.repeat
+                )
+
+    output = json.dumps(results, indent=4)
+    print(output)
+    if args.output is not None:
+        with open(args.output, "w") as file:
+            file.write(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+import os
+import random
+
+# The benchmarks run offline: the API clients only need a key to be created
+os.environ.setdefault("OPENAI_KEY", "offline-benchmark")
+os.environ.setdefault("DEEPL_KEY", "offline-benchmark")
+
+from story.story_type.ai_story import AIStory
+from story.story_part import StoryPart
+from story.story_modules import (
+    TextModule,
+    ImageModule,
+    ChoiceModule,
+    PossibleChoicesModule,
+)
+
+_WORDS = (
+    "the sun hung low over the emotion gardens where feelings blossomed like "
+    "flowers and you walked along the path holding the lantern of the keeper "
+    "while the shadows of the vale whispered stories of joy and sorrow"
+).split(" ")
+
+
+def make_text(rng: random.Random, number_of_words: int) -> str:
+    return " ".join(rng.choice(_WORDS) for _ in range(number_of_words)).capitalize()
+
+
+def make_synthetic_part(rng: random.Random, story_id: str) -> StoryPart:
+    """
+    Create a part shaped like a generated one: text, illustration, text and choices.
+    """
+    folder = "out/stories/" + story_id
+    modules = []
+    for _ in range(2):
+        text_module = TextModule(make_text(rng, 120))
+        text_module.set_speech_file_path(
+            "{}/tts_{:06d}.mp3".format(folder, rng.randrange(10**6))
+        )
+        modules.append(text_module)
+        modules.append(ImageModule("{}/{:06d}.jpg".format(folder, rng.randrange(10**6))))
+
+    choices = PossibleChoicesModule(
+        [ChoiceModule(make_text(rng, 12)) for _ in range(3)]
+    )
+    choices.set_user_choice(choices.get_choices()[rng.randrange(3)])
+    modules.append(choices)
+    return StoryPart(modules)
+
+
+def make_synthetic_story(number_of_parts: int, seed: int = 0, id: str = None) -> AIStory:
+    """
+    Create a story without any provider call.
+
+    Args:
+        number_of_parts (int): the number of parts of the story
+        seed (int): the seed of the random texts
+        id (str): the id of the story (None -> random id)
+
+    Returns:
+        AIStory: the synthetic story
+    """
+    rng = random.Random(seed)
+    story = AIStory(
+        title=make_text(rng, 5),
+        overview=make_text(rng, 80),
+        need_illustration=True,
+        generate_speeches=True,
+        story_length=number_of_parts,
+        id=id,
+    )
+    for _ in range(number_of_parts):
+        story._story_parts.append(make_synthetic_part(rng, story.id))
+    return story
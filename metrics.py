@@ -0,0 +1,67 @@
+from threading import Lock
+
+###############################################################################################
+# Metrics
+###############################################################################################
+_counters = {}
+_observations = {}
+metrics_lock = Lock()
+
+
+def metrics_add(name: str, value: float = 1) -> None:
+    """
+    Add a value to a counter.
+
+    Args:
+        name (str): the name of the counter (Example: "part_budget_overruns")
+        value (float): the value to add
+    """
+    with metrics_lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def metrics_observe(name: str, value: float) -> None:
+    """
+    Record an observation (Example: a duration in seconds).
+
+    Args:
+        name (str): the name of the observation
+        value (float): the observed value
+    """
+    with metrics_lock:
+        observation = _observations.setdefault(
+            name, {"count": 0, "total": 0.0, "max": 0.0}
+        )
+        observation["count"] += 1
+        observation["total"] += value
+        observation["max"] = max(observation["max"], value)
+
+
+def metrics_get() -> dict:
+    """
+    Get a copy of the recorded metrics.
+
+    Returns:
+        dict: {"counters": {name: value}, "observations": {name: {"count", "total", "max", "mean"}}}
+    """
+    with metrics_lock:
+        observations = {}
+        for name, observation in _observations.items():
+            observations[name] = dict(observation)
+            observations[name]["mean"] = observation["total"] / observation["count"]
+        return {"counters": dict(_counters), "observations": observations}
+
+
+def metrics_show() -> None:
+    metrics = metrics_get()
+    print("############################################")
+    print("Metrics:")
+    for name, value in sorted(metrics["counters"].items()):
+        print("{}: {}".format(name, value))
+    for name, observation in sorted(metrics["observations"].items()):
+        print(
+            "{}: count={} mean={:.3f} max={:.3f}".format(
+                name, observation["count"], observation["mean"], observation["max"]
+            )
+        )
+    print("############################################")
@@ -1,14 +1,33 @@
 import os
-import io, base64
-import random
-import string
+import base64
 import time
+import heapq
+import itertools
+import subprocess
 
+from contextlib import contextmanager
 from dotenv import load_dotenv
-from openai import OpenAI
+from openai import OpenAI, DefaultHttpxClient
 from random import randint
-from PIL import Image
-from threading import Lock
+from threading import Lock, Condition, Event, local
+from storage.asset_store import (
+    get_asset_path,
+    get_temporary_asset_path,
+    put_asset_file,
+)
+from metrics import metrics_add
+from storage.image_processing import run_image_task, encode_jpeg_task
+from storage.speech_cache import (
+    get_speech_cache_key,
+    speech_cache_get,
+    speech_cache_put,
+)
+from storage.speech_formats import (
+    SPEECH_FORMAT,
+    get_speech_settings_key,
+    should_transcode_speeches,
+    transcode_speech,
+)
 
 load_dotenv()
 
@@ -20,6 +39,7 @@ _openai_key = os.environ.get("OPENAI_KEY")
 _openai_model = "gpt-4o-mini-2024-07-18"
 _openai_client = OpenAI(api_key=_openai_key)
 _openai_model_tts = "tts-1"
+_openai_tts_voice = "nova"
 _openai_model_image_model = "dall-e-3"
 _openai_model_image_resolution = "1792x1024"
 _openai_model_image_quality = "hd"
@@ -32,10 +52,327 @@ _api_prices = {
 # Allow multi-threading calls
 API_MAX_BATCH_IMAGES = 5
 API_MAX_BATCH_SPEECHES = 5
+# Size (bytes) of the audio chunks of the streamed speeches (4096 -> ~0.2 s of tts-1 audio)
+TTS_STREAM_CHUNK_SIZE = 4096
 API_BATCH_DELAY = 60  # seconds
 # Add a delay to API request to avoid rate limiting
 # (+ recommended: set API_MAX_BATCH_IMAGES and API_MAX_BATCH_SPEECHES to 1)
 API_REQUEST_DELAY = 0  # seconds
+# Maximum number of provider calls in flight at the same time (all priorities)
+API_MAX_CONCURRENT_REQUESTS = 10
+# Number of slots left to background calls while interactive calls are slow
+API_BACKGROUND_THROTTLED_SLOTS = 1
+# Interactive latency (seconds, moving average per call kind) above which
+# background calls are throttled
+API_INTERACTIVE_LATENCY_THRESHOLDS = {
+    "chat": 15,
+    "tts": 15,
+    "image": 45,
+}
+# The interactive latency of a kind decays by half every this many seconds without
+# interactive call of the kind (a past spike does not throttle the background calls forever)
+API_INTERACTIVE_LATENCY_HALF_LIFE = 60  # seconds
+
+
+###############################################################################################
+# Cancellation
+###############################################################################################
+
+
+class GenerationCancelledError(Exception):
+    """
+    Raised when a provider call is requested or finished for a cancelled generation.
+    """
+
+
+class CancellationToken:
+    """
+    Cancellation token shared by a generation and all its provider calls.
+    Cancelling it drops the queued calls and aborts the in-flight ones when possible.
+    """
+
+    def __init__(self):
+        self._event = Event()
+        self._lock = Lock()
+        self._callbacks = []
+
+    def cancel(self) -> None:
+        """
+        Cancel the generation and abort the registered in-flight calls.
+        """
+        with self._lock:
+            if self._event.is_set():
+                return
+            self._event.set()
+            callbacks = list(self._callbacks)
+            self._callbacks = []
+
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                print("Failed to abort a provider call: {}".format(e))
+
+    def is_cancelled(self) -> bool:
+        return self._event.is_set()
+
+    def raise_if_cancelled(self) -> None:
+        if self.is_cancelled():
+            raise GenerationCancelledError()
+
+    def wait(self, timeout: float) -> bool:
+        """
+        Sleep until the timeout or the cancellation.
+
+        Returns:
+            bool: True if the token has been cancelled
+        """
+        return self._event.wait(timeout)
+
+    def add_callback(self, callback: callable) -> None:
+        """
+        Register a callback called on cancellation (called immediately if already cancelled).
+        """
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return
+        callback()
+
+    def remove_callback(self, callback: callable) -> None:
+        with self._lock:
+            if callback in self._callbacks:
+                self._callbacks.remove(callback)
+
+
+###############################################################################################
+# Priority classes
+###############################################################################################
+
+PRIORITY_INTERACTIVE = 0  # a reader is waiting for the result
+PRIORITY_BACKGROUND = 1  # backfill, prefetch, bulk generation...
+
+
+class ProviderContext:
+    """
+    Settings applied to the provider calls made by a thread.
+    The worker threads started by a generation share the context of their parent,
+    so changing it (Ex: demoting a generation to background) affects all of them.
+
+    Parameters:
+        priority (int): the priority class of the calls (PRIORITY_INTERACTIVE or PRIORITY_BACKGROUND)
+        cancel_token (CancellationToken): the token that cancels the calls (None -> not cancellable)
+    """
+
+    def __init__(self, priority=PRIORITY_INTERACTIVE, cancel_token=None):
+        self.priority = priority
+        self.cancel_token = cancel_token
+
+    def copy(self):
+        return ProviderContext(priority=self.priority, cancel_token=self.cancel_token)
+
+
+_thread_context = local()
+
+
+def get_provider_context() -> ProviderContext:
+    """
+    Get the provider context of the current thread.
+    """
+    context = getattr(_thread_context, "context", None)
+    if context is None:
+        context = ProviderContext()
+        _thread_context.context = context
+    return context
+
+
+def set_provider_context(context: ProviderContext) -> None:
+    """
+    Set the provider context of the current thread (Ex: in a worker thread).
+    """
+    _thread_context.context = context
+
+
+@contextmanager
+def provider_context(priority=None, cancel_token=None):
+    """
+    Run the enclosed provider calls with a new context.
+
+    Args:
+        priority (int): the priority class of the calls (None -> keep the current one)
+        cancel_token (CancellationToken): the cancellation token of the calls (None -> keep the current one)
+    """
+    previous = get_provider_context()
+    context = previous.copy()
+    if priority is not None:
+        context.priority = priority
+    if cancel_token is not None:
+        context.cancel_token = cancel_token
+
+    set_provider_context(context)
+    try:
+        yield context
+    finally:
+        set_provider_context(previous)
+
+
+class _ProviderScheduler:
+    """
+    Grant the provider call slots, interactive calls first.
+    Background calls are throttled when the interactive latency rises.
+    """
+
+    def __init__(self, max_slots: int, throttled_background_slots: int):
+        self._max_slots = max_slots
+        self._throttled_background_slots = throttled_background_slots
+        self._condition = Condition()
+        self._waiting = []
+        self._sequence = itertools.count()
+        self._active = {PRIORITY_INTERACTIVE: 0, PRIORITY_BACKGROUND: 0}
+        # kind -> (moving average of the interactive latency, time of the last sample)
+        self._interactive_latency = {}
+
+    def _get_interactive_latency(self, kind: str, now: float) -> float:
+        """
+        Get the moving average of the interactive latency of a kind, decayed since its last sample.
+        """
+        latency, sample_time = self._interactive_latency[kind]
+        return latency * 0.5 ** ((now - sample_time) / API_INTERACTIVE_LATENCY_HALF_LIFE)
+
+    def _is_throttled(self) -> bool:
+        now = time.time()
+        for kind in self._interactive_latency:
+            latency = self._get_interactive_latency(kind, now)
+            if latency > API_INTERACTIVE_LATENCY_THRESHOLDS.get(kind, float("inf")):
+                return True
+        return False
+
+    def _can_start(self, entry) -> bool:
+        if self._waiting[0] is not entry:
+            return False
+        if sum(self._active.values()) >= self._max_slots:
+            return False
+        priority = entry[0]
+        if priority == PRIORITY_BACKGROUND and self._is_throttled():
+            return self._active[PRIORITY_BACKGROUND] < self._throttled_background_slots
+        return True
+
+    def _wake_up(self) -> None:
+        with self._condition:
+            self._condition.notify_all()
+
+    def acquire(self, priority: int, cancel_token: CancellationToken = None) -> None:
+        """
+        Wait for a slot.
+
+        Raises:
+            GenerationCancelledError: if the token is cancelled while waiting (the call is dropped)
+        """
+        entry = [priority, next(self._sequence)]
+        if cancel_token is not None:
+            cancel_token.add_callback(self._wake_up)
+
+        try:
+            with self._condition:
+                heapq.heappush(self._waiting, entry)
+                while not self._can_start(entry):
+                    if cancel_token is not None and cancel_token.is_cancelled():
+                        self._waiting.remove(entry)
+                        heapq.heapify(self._waiting)
+                        self._condition.notify_all()
+                        openai_add_dropped_calls(1)
+                        raise GenerationCancelledError()
+                    timeout = None
+                    if priority == PRIORITY_BACKGROUND and self._is_throttled():
+                        # The throttling also ends when the latency decays
+                        timeout = API_INTERACTIVE_LATENCY_HALF_LIFE / 10
+                    self._condition.wait(timeout)
+                heapq.heappop(self._waiting)
+                self._active[priority] += 1
+                self._condition.notify_all()
+        finally:
+            if cancel_token is not None:
+                cancel_token.remove_callback(self._wake_up)
+
+    def release(self, priority: int, kind: str, elapsed: float) -> None:
+        with self._condition:
+            self._active[priority] -= 1
+            if priority == PRIORITY_INTERACTIVE:
+                # Exponential moving average of the interactive latency
+                now = time.time()
+                previous = elapsed
+                if kind in self._interactive_latency:
+                    previous = self._get_interactive_latency(kind, now)
+                self._interactive_latency[kind] = (0.7 * previous + 0.3 * elapsed, now)
+            self._condition.notify_all()
+
+
+_provider_scheduler = _ProviderScheduler(
+    max_slots=API_MAX_CONCURRENT_REQUESTS,
+    throttled_background_slots=API_BACKGROUND_THROTTLED_SLOTS,
+)
+
+
+@contextmanager
+def _provider_call(kind: str, priority: int = None, cancel_token=None):
+    """
+    Wait for a provider slot and hold it during the call.
+
+    Args:
+        kind (str): the kind of call ("chat", "tts" or "image")
+        priority (int): the priority class of the call (None -> priority of the current context)
+        cancel_token (CancellationToken): the cancellation token (None -> token of the current context)
+
+    Yields:
+        CancellationToken: the token of the call (None if not cancellable)
+    """
+    context = get_provider_context()
+    if priority is None:
+        priority = context.priority
+    if cancel_token is None:
+        cancel_token = context.cancel_token
+
+    if cancel_token is not None:
+        if cancel_token.wait(API_REQUEST_DELAY):
+            openai_add_dropped_calls(1)
+            raise GenerationCancelledError()
+    else:
+        time.sleep(API_REQUEST_DELAY)
+
+    _provider_scheduler.acquire(priority, cancel_token)
+    start_time = time.time()
+    try:
+        yield cancel_token
+    finally:
+        _provider_scheduler.release(priority, kind, time.time() - start_time)
+
+
+@contextmanager
+def _abort_on_cancel(cancel_token: CancellationToken, abort: callable):
+    """
+    Call abort (Ex: close the HTTP response) if the token is cancelled during the enclosed call.
+    """
+    if cancel_token is None:
+        yield
+        return
+
+    cancel_token.add_callback(abort)
+    try:
+        yield
+    finally:
+        cancel_token.remove_callback(abort)
+
+
+def _check_cancelled_after_call(cancel_token: CancellationToken, cost: float) -> None:
+    """
+    Record the spend of a call whose result is discarded because of the cancellation.
+
+    Raises:
+        GenerationCancelledError: if the token is cancelled
+    """
+    if cancel_token is not None and cancel_token.is_cancelled():
+        openai_add_cancelled_spend(cost)
+        raise GenerationCancelledError()
 
 
 ###############################################################################################
@@ -43,25 +380,32 @@ API_REQUEST_DELAY = 0  # seconds
 ###############################################################################################
 
 
-def query_openai(messages: list, temperature=0.0) -> str:
+def query_openai(
+    messages: list, temperature=0.0, priority: int = None, cancel_token=None
+) -> str:
     """
     Query the OpenAI API with the current conversation.
 
     Args:
         messages (dict): The message history to query
         temperature (float): The temperature to use for the query (0 to 2 range)
-        output_format (class): The output format to use for the query
+        priority (int): the priority class of the call (None -> priority of the current context)
+        cancel_token (CancellationToken): the cancellation token (None -> token of the current context)
+
+    Raises:
+        GenerationCancelledError: if the generation has been cancelled
     """
-    time.sleep(API_REQUEST_DELAY)
-    response: dict = _openai_client.chat.completions.create(
-        messages=messages,
-        model=_openai_model,
-        temperature=temperature,
-        seed=randint(0, 1000000),
-    ).model_dump()
+    with _provider_call("chat", priority, cancel_token) as cancel_token:
+        response: dict = _openai_client.chat.completions.create(
+            messages=messages,
+            model=_openai_model,
+            temperature=temperature,
+            seed=randint(0, 1000000),
+        ).model_dump()
 
     # Save usage
-    openai_add_usage(response["usage"])
+    cost = openai_add_usage(response["usage"])
+    _check_cancelled_after_call(cancel_token, cost)
 
     return response["choices"][0]["message"]["content"]
 
@@ -70,49 +414,105 @@ def query_openai(messages: list, temperature=0.0) -> str:
 # Query OpenAI Text to Speech
 ###############################################################################################
 
-speech_dir_checking_lock = Lock()
-
-
-def query_openai_tts(text: str, working_folder: str = "out") -> str:
+def _transcode_speech_file(filename: str) -> None:
+    """
+    Transcode a synthesized speech in place (kept as received if it cannot be transcoded).
+    """
+    transcoded_filename = get_temporary_asset_path(SPEECH_FORMAT)
+    try:
+        if transcode_speech(filename, transcoded_filename):
+            os.replace(transcoded_filename, filename)
+    except subprocess.CalledProcessError as e:
+        print("Failed to transcode the speech: {}".format(e))
+    finally:
+        if os.path.exists(transcoded_filename):
+            os.remove(transcoded_filename)
+
+
+def query_openai_tts(
+    text: str, priority: int = None, cancel_token=None, stream=None
+) -> str:
     """
     Query the OpenAI API with the current conversation.
 
     Args:
         text (str): The text to convert to speech
-        working_folder (str): The working folder to save the speech
-    """
-    time.sleep(API_REQUEST_DELAY)
-    openai_add_text_to_speech_usage(len(text))
+        priority (int): the priority class of the call (None -> priority of the current context)
+        cancel_token (CancellationToken): the cancellation token (None -> token of the current context)
+        stream (SpeechStream): receives the audio chunks as they arrive (see storage/speech_streams.py)
 
-    filename = (
-        f"{working_folder}/tts_"
-        + "".join(random.choices(string.ascii_letters + string.digits, k=6))
-        + ".mp3"
-    )
-
-    with speech_dir_checking_lock:
-        os.makedirs(os.path.dirname(filename), exist_ok=True)
-
-    with _openai_client.audio.speech.with_streaming_response.create(
-        model=_openai_model_tts,
-        voice="nova",
-        input=text,
-    ) as response:
-        response.stream_to_file(filename)
-    print("Text to speech saved to {}".format(filename))
+    Returns:
+        str: asset id of the generated speech (see storage.asset_store)
 
-    return filename
+    Raises:
+        GenerationCancelledError: if the generation has been cancelled (the partial file is removed)
+    """
+    # The same text read with the same voice is synthesized once (see storage/speech_cache.py)
+    cache_key = get_speech_cache_key(
+        text, _openai_tts_voice, _openai_model_tts, get_speech_settings_key()
+    )
+    asset_id = speech_cache_get(cache_key)
+    if asset_id is not None:
+        metrics_add("speech_cache_saved_characters", len(text))
+        if stream is not None:
+            with open(get_asset_path(asset_id), "rb") as file:
+                stream.write(file.read())
+            stream.finish(asset_id)
+        return asset_id
+
+    with _provider_call("tts", priority, cancel_token) as cancel_token:
+        # Created once the call starts: a call dropped while it waits leaves no file
+        filename = get_temporary_asset_path(SPEECH_FORMAT)
+        cost = openai_add_text_to_speech_usage(len(text))
+        try:
+            with _openai_client.audio.speech.with_streaming_response.create(
+                model=_openai_model_tts,
+                voice=_openai_tts_voice,
+                input=text,
+                response_format=SPEECH_FORMAT,
+            ) as response:
+                # Closing the response interrupts the download of the speech
+                with _abort_on_cancel(cancel_token, response.close):
+                    if stream is None:
+                        response.stream_to_file(filename)
+                    else:
+                        with open(filename, "wb") as file:
+                            for chunk in response.iter_bytes(TTS_STREAM_CHUNK_SIZE):
+                                file.write(chunk)
+                                stream.write(chunk)
+        except Exception:
+            if stream is not None:
+                stream.fail()
+            if os.path.exists(filename):
+                os.remove(filename)
+            _check_cancelled_after_call(cancel_token, cost)
+            raise
+
+    if cancel_token is not None and cancel_token.is_cancelled():
+        if stream is not None:
+            stream.fail()
+        os.remove(filename)
+    _check_cancelled_after_call(cancel_token, cost)
+
+    if should_transcode_speeches():
+        _transcode_speech_file(filename)
+    asset_id = put_asset_file(filename, SPEECH_FORMAT)
+    speech_cache_put(cache_key, asset_id)
+    if stream is not None:
+        stream.finish(asset_id)
+    print("Text to speech saved to {}".format(get_asset_path(asset_id)))
+    return asset_id
 
 
 ###############################################################################################
 # Query OpenAI Image Generation
 ###############################################################################################
 
-image_dir_checking_lock = Lock()
-
-
 def query_openai_image_generation(
-    prompt: str, style="vivid", working_folder: str = "out"
+    prompt: str,
+    style="vivid",
+    priority: int = None,
+    cancel_token=None,
 ) -> str:
     """
     Generate an image using the OpenAI API.
@@ -120,39 +520,65 @@ def query_openai_image_generation(
     Args:
         prompt (str): The prompt to generate the image
         style (str): The style of the image (standard or vivid)
-        working_folder (str): The working folder to save the image
+        priority (int): the priority class of the call (None -> priority of the current context)
+        cancel_token (CancellationToken): the cancellation token (None -> token of the current context)
 
     Returns:
-        str: file path of the generated image
+        str: asset id of the generated image (see storage.asset_store)
+
+    Raises:
+        GenerationCancelledError: if the generation has been cancelled
     """
     if prompt is None:
         return None
 
-    time.sleep(API_REQUEST_DELAY)
-    response = _openai_client.images.generate(
-        model=_openai_model_image_model,
-        prompt=prompt,
-        size=_openai_model_image_resolution,
-        quality=_openai_model_image_quality,
-        style=style,
-        response_format="b64_json",
-        n=1,
-    )
-    openai_add_image_generation(1)
-
-    image_obj = response.data[0].b64_json
-    image_obj = Image.open(io.BytesIO(base64.b64decode(image_obj)))
-
-    filename = (
-        f"{working_folder}/"
-        + "".join(random.choices(string.ascii_letters + string.digits, k=6))
-        + ".jpg"
-    )
-    with image_dir_checking_lock:
-        os.makedirs(os.path.dirname(filename), exist_ok=True)
-    image_obj.save(filename, quality=100, subsampling=0)
-    print("Image saved to {}".format(filename))
-    return filename
+    with _provider_call("image", priority, cancel_token) as cancel_token:
+        client = _openai_client
+        http_client = None
+        if cancel_token is not None:
+            # A dedicated connection, closed to abort the request on cancellation
+            http_client = DefaultHttpxClient()
+            client = _openai_client.with_options(http_client=http_client)
+
+        try:
+            with _abort_on_cancel(cancel_token, lambda: http_client.close()):
+                response = client.images.generate(
+                    model=_openai_model_image_model,
+                    prompt=prompt,
+                    size=_openai_model_image_resolution,
+                    quality=_openai_model_image_quality,
+                    style=style,
+                    response_format="b64_json",
+                    n=1,
+                )
+        except Exception:
+            if cancel_token is not None and cancel_token.is_cancelled():
+                # The image may still be billed
+                _check_cancelled_after_call(
+                    cancel_token, _api_prices["image_generation"]
+                )
+            raise
+        finally:
+            if http_client is not None:
+                http_client.close()
+
+    cost = openai_add_image_generation(1)
+    _check_cancelled_after_call(cancel_token, cost)
+
+    # The image is decoded and encoded by the image process pool
+    source_path = get_temporary_asset_path("png")
+    output_path = get_temporary_asset_path("jpg")
+    try:
+        with open(source_path, "wb") as file:
+            file.write(base64.b64decode(response.data[0].b64_json))
+        run_image_task(encode_jpeg_task, source_path, output_path)
+        asset_id = put_asset_file(output_path, "jpg")
+    finally:
+        for path in [source_path, output_path]:
+            if os.path.exists(path):
+                os.remove(path)
+    print("Image saved to {}".format(get_asset_path(asset_id)))
+    return asset_id
 
 
 ###############################################################################################
@@ -164,34 +590,71 @@ _usage_dict = {
     "text_to_speech_characters": 0,
     "generated_images": 0,
     "estimated_cost": 0.0,
+    "dropped_calls": 0,
+    "cancelled_calls": 0,
+    "cancelled_cost": 0.0,
 }
 chat_completion_lock = Lock()
 text_to_speech_lock = Lock()
 image_generation_lock = Lock()
+cancellation_lock = Lock()
 
 
-def openai_add_usage(usage: dict) -> None:
+def openai_add_usage(usage: dict) -> float:
+    """
+    Returns:
+        float: the estimated cost of the call
+    """
+    cost = (
+        usage["prompt_tokens"] * _api_prices["per_token_input"]
+        + usage["completion_tokens"] * _api_prices["per_token_output"]
+    )
     with chat_completion_lock:
         _usage_dict["total_input_tokens"] += usage["prompt_tokens"]
         _usage_dict["total_output_tokens"] += usage["completion_tokens"]
-        _usage_dict["estimated_cost"] += (
-            usage["prompt_tokens"] * _api_prices["per_token_input"]
-            + usage["completion_tokens"] * _api_prices["per_token_output"]
-        )
+        _usage_dict["estimated_cost"] += cost
+    return cost
 
 
-def openai_add_text_to_speech_usage(characters_number: int) -> None:
+def openai_add_text_to_speech_usage(characters_number: int) -> float:
+    """
+    Returns:
+        float: the estimated cost of the call
+    """
+    cost = characters_number * _api_prices["text_to_speech_per_character"]
     with text_to_speech_lock:
         _usage_dict["text_to_speech_characters"] += characters_number
-        _usage_dict["estimated_cost"] += (
-            characters_number * _api_prices["text_to_speech_per_character"]
-        )
+        _usage_dict["estimated_cost"] += cost
+    return cost
 
 
-def openai_add_image_generation(image_number: int) -> None:
+def openai_add_image_generation(image_number: int) -> float:
+    """
+    Returns:
+        float: the estimated cost of the call
+    """
+    cost = image_number * _api_prices["image_generation"]
     with image_generation_lock:
         _usage_dict["generated_images"] += image_number
-        _usage_dict["estimated_cost"] += image_number * _api_prices["image_generation"]
+        _usage_dict["estimated_cost"] += cost
+    return cost
+
+
+def openai_add_dropped_calls(calls_number: int) -> None:
+    """
+    Count the queued calls dropped before reaching the provider (no spend).
+    """
+    with cancellation_lock:
+        _usage_dict["dropped_calls"] += calls_number
+
+
+def openai_add_cancelled_spend(cost: float) -> None:
+    """
+    Count a call paid (or possibly paid) for a cancelled generation.
+    """
+    with cancellation_lock:
+        _usage_dict["cancelled_calls"] += 1
+        _usage_dict["cancelled_cost"] += cost
 
 
 def openai_show_usage() -> None:
@@ -204,4 +667,10 @@ def openai_show_usage() -> None:
     )
     print("Generated images: {}".format(_usage_dict["generated_images"]))
     print("Estimated cost: ${}".format(_usage_dict["estimated_cost"]))
+    print("Dropped calls (cancelled): {}".format(_usage_dict["dropped_calls"]))
+    print(
+        "Cancelled spend: ${} ({} calls)".format(
+            _usage_dict["cancelled_cost"], _usage_dict["cancelled_calls"]
+        )
+    )
     print("############################################")
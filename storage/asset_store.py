@@ -0,0 +1,470 @@
+import hashlib
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+from typing import Iterable, List, Set, Union
+from storage.sqlite_utils import get_thread_connection
+from storage.story_log import read_story_dict
+
+###############################################################################################
+# Asset store
+#
+# Content-addressed store shared by all the stories for the generated images and speeches.
+# An asset is identified by the SHA-256 of its content and its extension
+# (Example: "3f1c...9a2b.jpg") and stored once in ASSET_STORE_PATH/3f/3f1c...9a2b.jpg.
+# The stories reference their assets by id (module keys ending with "_asset").
+# The references of each owner (story) are kept in a SQLite database to count the
+# references of each asset. Unreferenced assets are reclaimed with:
+#   python -m storage.asset_store gc
+###############################################################################################
+
+ASSET_STORE_PATH = "out/assets"
+ASSET_DATABASE_PATH = "out/assets/assets.sqlite"
+# Unreferenced assets younger than this (seconds) are kept by the garbage collection
+# (Ex: assets of a part that is still being generated)
+ASSET_GC_GRACE_PERIOD = 24 * 3600
+STORY_DIRECTORIES = ["demo_story", "out/stories"]
+
+_ASSET_SCHEMA = """
+CREATE TABLE IF NOT EXISTS assets (
+    asset_id TEXT PRIMARY KEY,
+    size INTEGER,
+    created_time REAL,
+    reference_count INTEGER DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS assets_reference_count ON assets (reference_count);
+CREATE TABLE IF NOT EXISTS asset_references (
+    owner TEXT,
+    asset_id TEXT,
+    PRIMARY KEY (owner, asset_id)
+);
+CREATE INDEX IF NOT EXISTS asset_references_asset ON asset_references (asset_id);
+"""
+
+
+def _get_connection() -> sqlite3.Connection:
+    return get_thread_connection(ASSET_DATABASE_PATH, _ASSET_SCHEMA)
+
+
+def compute_asset_id(data: bytes, extension: str) -> str:
+    """
+    Compute the id of an asset from its content.
+
+    Args:
+        data (bytes): the content of the asset
+        extension (str): the file extension (Example: "jpg", "mp3")
+    """
+    return hashlib.sha256(data).hexdigest() + "." + extension
+
+
+def get_asset_path(asset_id: str) -> str:
+    """
+    Get the file path of an asset.
+    """
+    return os.path.join(ASSET_STORE_PATH, asset_id[:2], asset_id)
+
+
+def get_asset_extension(asset_id: str) -> str:
+    return asset_id.rsplit(".", 1)[-1]
+
+
+def has_asset(asset_id: str) -> bool:
+    return os.path.exists(get_asset_path(asset_id))
+
+
+_asset_sources = []
+
+
+def register_asset_source(source) -> None:
+    """
+    Serve the assets missing from the store from another source (Example: an opened story bundle).
+
+    Args:
+        source: object with has_asset(asset_id) -> bool and read_asset(asset_id) -> bytes-like
+    """
+    if source not in _asset_sources:
+        _asset_sources.append(source)
+
+
+def import_assets(source, asset_ids: Iterable[str]) -> int:
+    """
+    Copy assets of another source to the store (Example: the assets of an opened story bundle).
+
+    Args:
+        source: object with has_asset(asset_id) -> bool and read_asset(asset_id) -> bytes-like
+        asset_ids (Iterable[str]): the assets to copy (the assets already stored are skipped)
+
+    Returns:
+        int: the number of copied assets
+
+    Raises:
+        ValueError: if the content of an asset does not match its id
+    """
+    imported = 0
+    for asset_id in asset_ids:
+        if has_asset(asset_id) or not source.has_asset(asset_id):
+            continue
+        stored_id = put_asset_bytes(
+            source.read_asset(asset_id), get_asset_extension(asset_id)
+        )
+        if stored_id != asset_id:
+            raise ValueError("Corrupted asset {}".format(asset_id))
+        imported += 1
+    return imported
+
+
+def open_asset(asset_id: str) -> Union[str, memoryview, None]:
+    """
+    Get an asset for display.
+
+    Returns:
+        str | memoryview: the file path of the asset in the store, else its content from
+        a registered source (no copy), else None
+    """
+    path = get_asset_path(asset_id)
+    if os.path.exists(path):
+        return path
+    for source in _asset_sources:
+        if source.has_asset(asset_id):
+            return source.read_asset(asset_id)
+    return None
+
+
+def _register_asset(asset_id: str, size: int) -> None:
+    connection = _get_connection()
+    with connection:
+        # An asset produced again gets a new grace period (see collect_garbage)
+        connection.execute(
+            "INSERT INTO assets (asset_id, size, created_time) VALUES (?, ?, ?) "
+            "ON CONFLICT (asset_id) DO UPDATE SET created_time = excluded.created_time",
+            (asset_id, size, time.time()),
+        )
+
+
+def touch_asset(asset_id: str) -> bool:
+    """
+    Give a new grace period to an asset handed out again before it is referenced
+    (Example: an image reused for a part, referenced when the story is saved).
+
+    Returns:
+        bool: False if the asset is not in the store anymore
+    """
+    connection = _get_connection()
+    with connection:
+        updated = connection.execute(
+            "UPDATE assets SET created_time = ? WHERE asset_id = ?",
+            (time.time(), asset_id),
+        ).rowcount
+    return updated > 0 and has_asset(asset_id)
+
+
+def get_temporary_asset_path(extension: str) -> str:
+    """
+    Get a new temporary file path in the store (Ex: to download an asset before adding it).
+    """
+    temporary_folder = os.path.join(ASSET_STORE_PATH, "tmp")
+    os.makedirs(temporary_folder, exist_ok=True)
+    fd, path = tempfile.mkstemp(dir=temporary_folder, suffix="." + extension)
+    os.close(fd)
+    return path
+
+
+def put_asset_bytes(data: bytes, extension: str) -> str:
+    """
+    Add an asset to the store (stored once whatever the number of identical assets).
+
+    Args:
+        data (bytes): the content of the asset (or any bytes-like object)
+        extension (str): the file extension (Example: "jpg", "mp3")
+
+    Returns:
+        str: the id of the asset
+    """
+    asset_id = compute_asset_id(data, extension)
+    path = get_asset_path(asset_id)
+    if not os.path.exists(path):
+        temporary_path = get_temporary_asset_path(extension)
+        with open(temporary_path, "wb") as file:
+            file.write(data)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(temporary_path, path)
+
+    _register_asset(asset_id, len(data))
+    return asset_id
+
+
+def put_asset_file(file_path: str, extension: str) -> str:
+    """
+    Move a file to the store.
+
+    Args:
+        file_path (str): the file to move (Ex: a temporary asset path)
+        extension (str): the file extension (Example: "jpg", "mp3")
+
+    Returns:
+        str: the id of the asset
+    """
+    sha256 = hashlib.sha256()
+    with open(file_path, "rb") as file:
+        for block in iter(lambda: file.read(1024 * 1024), b""):
+            sha256.update(block)
+    asset_id = sha256.hexdigest() + "." + extension
+
+    path = get_asset_path(asset_id)
+    size = os.path.getsize(file_path)
+    if os.path.exists(path):
+        os.remove(file_path)
+    else:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if os.path.dirname(os.path.abspath(file_path)) == os.path.abspath(
+            os.path.join(ASSET_STORE_PATH, "tmp")
+        ):
+            os.replace(file_path, path)
+        else:
+            shutil.move(file_path, path)
+
+    _register_asset(asset_id, size)
+    return asset_id
+
+
+def collect_asset_ids(obj) -> Set[str]:
+    """
+    Collect the asset ids referenced by a serialized story, part or module.
+    (values of the keys ending with "_asset" and of the dictionaries of the keys ending with "_assets")
+
+    Args:
+        obj: the serialized object (dict, list...)
+
+    Returns:
+        set: the asset ids
+    """
+    asset_ids = set()
+    if isinstance(obj, dict):
+        for key, value in obj.items():
+            if isinstance(value, str) and key.endswith("_asset"):
+                asset_ids.add(value)
+            elif isinstance(value, dict) and key.endswith("_assets"):
+                asset_ids.update(v for v in value.values() if isinstance(v, str))
+            else:
+                asset_ids.update(collect_asset_ids(value))
+    elif isinstance(obj, list):
+        for value in obj:
+            asset_ids.update(collect_asset_ids(value))
+    return asset_ids
+
+
+def _update_reference_counts(connection: sqlite3.Connection, asset_ids: Iterable[str]):
+    connection.executemany(
+        """
+        UPDATE assets SET reference_count = (
+            SELECT COUNT(*) FROM asset_references WHERE asset_references.asset_id = assets.asset_id
+        ) WHERE asset_id = ?
+        """,
+        [(asset_id,) for asset_id in asset_ids],
+    )
+
+
+def add_asset_references(owner: str, asset_ids: Iterable[str]) -> None:
+    """
+    Add references from an owner (Example: a story folder) to assets.
+
+    Args:
+        owner (str): the owner of the references
+        asset_ids (Iterable[str]): the referenced assets
+    """
+    asset_ids = list(asset_ids)
+    if len(asset_ids) == 0:
+        return
+
+    connection = _get_connection()
+    with connection:
+        connection.executemany(
+            "INSERT OR IGNORE INTO asset_references (owner, asset_id) VALUES (?, ?)",
+            [(owner, asset_id) for asset_id in asset_ids],
+        )
+        _update_reference_counts(connection, asset_ids)
+
+
+def remove_asset_references(owner: str, asset_ids: Iterable[str]) -> None:
+    """
+    Remove references from an owner to assets.
+
+    Args:
+        owner (str): the owner of the references
+        asset_ids (Iterable[str]): the assets that are not referenced by the owner anymore
+    """
+    asset_ids = list(asset_ids)
+    if len(asset_ids) == 0:
+        return
+
+    connection = _get_connection()
+    with connection:
+        connection.executemany(
+            "DELETE FROM asset_references WHERE owner = ? AND asset_id = ?",
+            [(owner, asset_id) for asset_id in asset_ids],
+        )
+        _update_reference_counts(connection, asset_ids)
+
+
+def set_asset_references(owner: str, asset_ids: Iterable[str]) -> None:
+    """
+    Replace all the references of an owner.
+
+    Args:
+        owner (str): the owner of the references (Example: a story folder)
+        asset_ids (Iterable[str]): the referenced assets (empty -> remove the owner)
+    """
+    asset_ids = set(asset_ids)
+    connection = _get_connection()
+    with connection:
+        previous = {
+            row["asset_id"]
+            for row in connection.execute(
+                "SELECT asset_id FROM asset_references WHERE owner = ?", (owner,)
+            )
+        }
+        connection.executemany(
+            "DELETE FROM asset_references WHERE owner = ? AND asset_id = ?",
+            [(owner, asset_id) for asset_id in previous - asset_ids],
+        )
+        connection.executemany(
+            "INSERT OR IGNORE INTO asset_references (owner, asset_id) VALUES (?, ?)",
+            [(owner, asset_id) for asset_id in asset_ids - previous],
+        )
+        _update_reference_counts(connection, previous ^ asset_ids)
+
+
+def get_reference_count(asset_id: str) -> int:
+    row = (
+        _get_connection()
+        .execute("SELECT reference_count FROM assets WHERE asset_id = ?", (asset_id,))
+        .fetchone()
+    )
+    return 0 if row is None else row["reference_count"]
+
+
+def rebuild_asset_references(directories: List[str] = None) -> int:
+    """
+    Rebuild the references of all the stories from their files.
+    The owners that are not story folders of the directories (Example: the speech cache) are kept.
+
+    Args:
+        directories (List[str]): the directories that contain the story folders (None -> STORY_DIRECTORIES)
+
+    Returns:
+        int: the number of stories
+    """
+    if directories is None:
+        directories = STORY_DIRECTORIES
+
+    references = {}
+    for directory_path in directories:
+        if not os.path.exists(directory_path):
+            continue
+        for name in os.listdir(directory_path):
+            story_dir = os.path.join(directory_path, name)
+            if not os.path.isdir(story_dir):
+                continue
+            try:
+                story_dict, _ = read_story_dict(story_dir)
+            except Exception as e:
+                print("Failed to read the story {}: {}".format(story_dir, e))
+                continue
+            if story_dict is not None:
+                references[os.path.normpath(story_dir)] = collect_asset_ids(story_dict)
+
+    connection = _get_connection()
+    with connection:
+        owners = [
+            row["owner"]
+            for row in connection.execute("SELECT DISTINCT owner FROM asset_references")
+        ]
+    scanned_directories = {os.path.normpath(path) for path in directories}
+    for owner in owners:
+        if owner not in references and os.path.dirname(owner) in scanned_directories:
+            set_asset_references(owner, [])
+    for owner, asset_ids in references.items():
+        set_asset_references(owner, asset_ids)
+    return len(references)
+
+
+def collect_garbage(grace_period: float = None, dry_run: bool = False) -> dict:
+    """
+    Remove the assets that are not referenced anymore (and the files unknown to the database).
+
+    Args:
+        grace_period (float): the minimum age (seconds) of the removed assets (None -> ASSET_GC_GRACE_PERIOD)
+        dry_run (bool): True to only report what would be removed
+
+    Returns:
+        dict: {"removed_assets": int, "reclaimed_bytes": int}
+    """
+    if grace_period is None:
+        grace_period = ASSET_GC_GRACE_PERIOD
+    limit_time = time.time() - grace_period
+
+    report = {"removed_assets": 0, "reclaimed_bytes": 0}
+    connection = _get_connection()
+    rows = connection.execute(
+        "SELECT asset_id, size FROM assets WHERE reference_count = 0 AND created_time < ?",
+        (limit_time,),
+    ).fetchall()
+    for row in rows:
+        path = get_asset_path(row["asset_id"])
+        if not dry_run:
+            with connection:
+                # Skip the asset if it has been referenced or handed out in the meantime
+                deleted = connection.execute(
+                    "DELETE FROM assets WHERE asset_id = ? AND reference_count = 0 AND created_time < ?",
+                    (row["asset_id"], limit_time),
+                ).rowcount
+            if deleted == 0:
+                continue
+            if os.path.exists(path):
+                os.remove(path)
+        report["removed_assets"] += 1
+        report["reclaimed_bytes"] += row["size"]
+
+    # Files without database entry (Ex: crash between the write and the registration)
+    if os.path.exists(ASSET_STORE_PATH):
+        for folder in os.listdir(ASSET_STORE_PATH):
+            folder_path = os.path.join(ASSET_STORE_PATH, folder)
+            if not os.path.isdir(folder_path):
+                continue
+            for name in os.listdir(folder_path):
+                path = os.path.join(folder_path, name)
+                if os.path.getmtime(path) >= limit_time:
+                    continue
+                if folder != "tmp":
+                    known = connection.execute(
+                        "SELECT 1 FROM assets WHERE asset_id = ?", (name,)
+                    ).fetchone()
+                    if known is not None:
+                        continue
+                report["removed_assets"] += 1
+                report["reclaimed_bytes"] += os.path.getsize(path)
+                if not dry_run:
+                    os.remove(path)
+
+    return report
+
+
+if __name__ == "__main__":
+    commands = ["gc", "gc-dry-run", "rebuild-references"]
+    if len(sys.argv) != 2 or sys.argv[1] not in commands:
+        print("Usage: python -m storage.asset_store [{}]".format("|".join(commands)))
+        sys.exit(1)
+
+    number_of_stories = rebuild_asset_references()
+    print("References of {} stories rebuilt".format(number_of_stories))
+    if sys.argv[1] != "rebuild-references":
+        report = collect_garbage(dry_run=sys.argv[1] == "gc-dry-run")
+        print(
+            "{} unreferenced assets removed ({} bytes reclaimed)".format(
+                report["removed_assets"], report["reclaimed_bytes"]
+            )
+        )
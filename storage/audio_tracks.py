@@ -0,0 +1,317 @@
+import hashlib
+import io
+import json
+import os
+import sqlite3
+import struct
+import subprocess
+import time
+import wave
+
+from typing import List, Tuple, Union
+from metrics import metrics_add, metrics_observe
+from storage.sqlite_utils import get_thread_connection
+from storage.asset_store import (
+    has_asset,
+    put_asset_bytes,
+    get_temporary_asset_path,
+)
+from storage.speech_formats import (
+    get_speech_format,
+    get_speech_duration,
+    concatenate_speeches,
+)
+
+###############################################################################################
+# Audio tracks
+#
+# The speeches of a page are merged into one MP3 track so that the page plays as one stream
+# (no gap between the speeches of its modules). MP3 files are sequences of independent
+# frames: the track is the concatenation of the audio frames of the speeches (without
+# their ID3 tags and Xing/Info header frames) and the start time of each speech in the track
+# is computed from the frame headers (offset index). The WAV speeches are merged the same way
+# (PCM samples), the other formats (see speech_formats.py) are merged by ffmpeg.
+# The tracks are assets of the store, cached by the list of their speeches in a SQLite
+# database. They are not referenced by the stories: the garbage collection of the store
+# reclaims them and they are merged again when needed.
+###############################################################################################
+
+AUDIO_TRACKS_DATABASE_PATH = "out/audio_tracks.sqlite"
+
+_AUDIO_TRACKS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS merged_tracks (
+    track_key TEXT PRIMARY KEY,
+    asset_id TEXT,
+    offsets TEXT,
+    duration REAL
+);
+"""
+
+# MPEG audio version (header bits 19-20) -> sample rates (header bits 10-11)
+_SAMPLE_RATES = {
+    3: [44100, 48000, 32000],  # MPEG 1
+    2: [22050, 24000, 16000],  # MPEG 2
+    0: [11025, 12000, 8000],  # MPEG 2.5
+}
+# Layer III bitrates (kbit/s, header bits 12-15)
+_BITRATES_MPEG1 = [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320]
+_BITRATES_MPEG2 = [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160]
+
+
+def _get_connection() -> sqlite3.Connection:
+    return get_thread_connection(AUDIO_TRACKS_DATABASE_PATH, _AUDIO_TRACKS_SCHEMA)
+
+
+def _skip_id3v2(data: memoryview) -> int:
+    if len(data) >= 10 and data[:3] == b"ID3":
+        # Syncsafe size (7 bits per byte) after the 10 bytes of the header
+        size = 0
+        for byte in data[6:10]:
+            size = (size << 7) | (byte & 0x7F)
+        footer = 10 if data[5] & 0x10 else 0
+        return 10 + size + footer
+    return 0
+
+
+def read_mp3_frames(
+    data: Union[bytes, memoryview], file_start: bool = True, partial: bool = False
+) -> Tuple[List[tuple], int, int]:
+    """
+    Parse the audio frames of a MPEG layer III file.
+
+    Args:
+        data (bytes | memoryview): the content of the file
+        file_start (bool): False if the data starts at a frame in the middle of the file
+        partial (bool): True if the data is the beginning of a file still being written
+            (Ex: streamed speech): the incomplete frame at the end is not returned
+
+    Returns:
+        List[tuple]: the (start, end) byte ranges of the audio frames
+        int: the number of samples of the audio frames
+        int: the sample rate (None if partial data has no complete frame yet)
+
+    Raises:
+        ValueError: if the data is not a MPEG layer III file
+    """
+    data = memoryview(data)
+    position = _skip_id3v2(data) if file_start else 0
+    frames = []
+    samples = 0
+    sample_rate = None
+    while position + 4 <= len(data):
+        header = struct.unpack(">I", data[position : position + 4])[0]
+        if header >> 21 != 0x7FF:
+            if len(frames) > 0:
+                # Ex: ID3v1 tag at the end of the file
+                break
+            raise ValueError("Not a MP3 file (no frame at byte {})".format(position))
+        version = (header >> 19) & 3
+        layer = (header >> 17) & 3
+        bitrate_index = (header >> 12) & 15
+        sample_rate_index = (header >> 10) & 3
+        padding = (header >> 9) & 1
+        if (
+            layer != 1
+            or version == 1
+            or bitrate_index in (0, 15)
+            or sample_rate_index == 3
+        ):
+            raise ValueError("Unsupported MPEG frame at byte {}".format(position))
+
+        frame_sample_rate = _SAMPLE_RATES[version][sample_rate_index]
+        if sample_rate is None:
+            sample_rate = frame_sample_rate
+        elif frame_sample_rate != sample_rate:
+            raise ValueError("Sample rate changes at byte {}".format(position))
+        if version == 3:
+            bitrate = _BITRATES_MPEG1[bitrate_index]
+            frame_samples = 1152
+        else:
+            bitrate = _BITRATES_MPEG2[bitrate_index]
+            frame_samples = 576
+        frame_length = frame_samples // 8 * bitrate * 1000 // sample_rate + padding
+
+        if partial and position + frame_length > len(data):
+            break
+        end = min(position + frame_length, len(data))
+        # The Xing/Info/VBRI header frame of the encoders contains no audio
+        is_header_frame = file_start and len(frames) == 0 and any(
+            tag in bytes(data[position : position + 64])
+            for tag in (b"Xing", b"Info", b"VBRI")
+        )
+        if not is_header_frame:
+            frames.append((position, end))
+            samples += frame_samples
+        position += frame_length
+
+    if sample_rate is None and not partial:
+        raise ValueError("No MP3 frame")
+    return frames, samples, sample_rate
+
+
+def _get_track_key(speech_keys: List[str]) -> str:
+    return hashlib.sha256("\n".join(speech_keys).encode("utf-8")).hexdigest()
+
+
+def _read_source(source: Union[str, memoryview]) -> Union[bytes, memoryview]:
+    if isinstance(source, memoryview):
+        return source
+    with open(source, "rb") as file:
+        return file.read()
+
+
+def _merge_mp3(speeches: List[Tuple[str, bytes]]) -> Tuple[bytes, List[float], float]:
+    chunks = []
+    offsets = []
+    total_samples = 0
+    track_sample_rate = None
+    for key, data in speeches:
+        try:
+            frames, samples, sample_rate = read_mp3_frames(data)
+        except ValueError as e:
+            raise ValueError("{}: {}".format(key, e))
+        if track_sample_rate is None:
+            track_sample_rate = sample_rate
+        elif sample_rate != track_sample_rate:
+            raise ValueError("{}: other sample rate".format(key))
+        offsets.append(total_samples / track_sample_rate)
+        total_samples += samples
+        # The frames of a speech are contiguous
+        chunks.append(data[frames[0][0] : frames[-1][1]] if len(frames) > 0 else b"")
+    return b"".join(chunks), offsets, total_samples / track_sample_rate
+
+
+def _merge_wav(speeches: List[Tuple[str, bytes]]) -> Tuple[bytes, List[float], float]:
+    chunks = []
+    offsets = []
+    total_frames = 0
+    track_parameters = None
+    for key, data in speeches:
+        try:
+            with wave.open(io.BytesIO(data)) as file:
+                parameters = file.getparams()[:3]
+                pcm = file.readframes(file.getnframes())
+        except (wave.Error, EOFError) as e:
+            raise ValueError("{}: {}".format(key, e))
+        if track_parameters is None:
+            track_parameters = parameters
+        elif parameters != track_parameters:
+            raise ValueError("{}: other channels, sample width or rate".format(key))
+        channels, sample_width, frame_rate = parameters
+        offsets.append(total_frames / frame_rate)
+        total_frames += len(pcm) // (channels * sample_width)
+        chunks.append(pcm)
+
+    output = io.BytesIO()
+    with wave.open(output, "wb") as file:
+        file.setnchannels(track_parameters[0])
+        file.setsampwidth(track_parameters[1])
+        file.setframerate(track_parameters[2])
+        file.writeframes(b"".join(chunks))
+    return output.getvalue(), offsets, total_frames / track_parameters[2]
+
+
+def _merge_with_ffmpeg(
+    speeches: List[Tuple[str, bytes]], audio_format: str
+) -> Tuple[bytes, List[float], float]:
+    offsets = []
+    duration = 0
+    paths = []
+    try:
+        for key, data in speeches:
+            try:
+                offsets.append(duration)
+                duration += get_speech_duration(data, audio_format)
+            except (ValueError, struct.error) as e:
+                raise ValueError("{}: {}".format(key, e))
+            path = get_temporary_asset_path(audio_format)
+            paths.append(path)
+            with open(path, "wb") as file:
+                file.write(data)
+        output_path = get_temporary_asset_path(audio_format)
+        paths.append(output_path)
+        try:
+            if not concatenate_speeches(paths[:-1], output_path, audio_format):
+                return None
+        except subprocess.CalledProcessError as e:
+            raise ValueError("ffmpeg failed: {}".format(e))
+        with open(output_path, "rb") as file:
+            return file.read(), offsets, duration
+    finally:
+        for path in paths:
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def get_merged_track(speeches: List[Tuple[str, Union[str, memoryview]]]) -> dict:
+    """
+    Get the track that plays the speeches one after the other (merged on first use).
+
+    Args:
+        speeches (List[tuple]): the (key, source) of each speech: key identifies its content
+            (Example: its asset id, its extension is the format of the speech) and source is
+            its file path or content (see canBeSpeechSynthesized.get_speech)
+
+    Returns:
+        dict: {"asset_id": id of the track, "offsets": [start time of each speech (seconds)], "duration": seconds}
+        or None if the speeches cannot be merged (other formats or sample rates, ffmpeg missing)
+    """
+    if len(speeches) == 0:
+        return None
+    track_key = _get_track_key([key for key, _ in speeches])
+    connection = _get_connection()
+    row = connection.execute(
+        "SELECT asset_id, offsets, duration FROM merged_tracks WHERE track_key = ?",
+        (track_key,),
+    ).fetchone()
+    if row is not None and has_asset(row["asset_id"]):
+        metrics_add("audio_track_hits")
+        return {
+            "asset_id": row["asset_id"],
+            "offsets": json.loads(row["offsets"]),
+            "duration": row["duration"],
+        }
+
+    audio_formats = {get_speech_format(key) for key, _ in speeches}
+    if len(audio_formats) != 1:
+        print("The speeches of different formats cannot be merged")
+        return None
+    audio_format = audio_formats.pop()
+
+    start_time = time.perf_counter()
+    speeches = [(key, _read_source(source)) for key, source in speeches]
+    try:
+        if audio_format == "mp3":
+            merged = _merge_mp3(speeches)
+        elif audio_format == "wav":
+            merged = _merge_wav(speeches)
+        else:
+            merged = _merge_with_ffmpeg(speeches, audio_format)
+    except ValueError as e:
+        print("The speeches cannot be merged: {}".format(e))
+        return None
+    if merged is None:
+        return None
+
+    data, offsets, duration = merged
+    track = {
+        "asset_id": put_asset_bytes(data, audio_format),
+        "offsets": offsets,
+        "duration": duration,
+    }
+    connection = _get_connection()
+    with connection:
+        connection.execute(
+            "INSERT OR REPLACE INTO merged_tracks (track_key, asset_id, offsets, duration) VALUES (?, ?, ?, ?)",
+            (track_key, track["asset_id"], json.dumps(offsets), track["duration"]),
+        )
+    metrics_add("audio_track_merges")
+    metrics_observe("audio_track_merge_seconds", time.perf_counter() - start_time)
+    return track
+
+
+def get_track_offset(track: dict, speech_index: int) -> float:
+    """
+    Get the start time (seconds) of a speech in a merged track.
+    """
+    return track["offsets"][speech_index]
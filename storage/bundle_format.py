@@ -0,0 +1,181 @@
+import json
+import mmap
+import os
+import struct
+import tempfile
+
+from threading import Lock
+from typing import Dict, Union
+from storage.story_log import STORY_LOG_FORMAT_VERSION, migrate_story_dict
+
+###############################################################################################
+# Story bundle format
+#
+# A single file with a story and all its assets:
+#   magic (8 bytes) | asset 1 | asset 2 | ... | index (JSON) | footer
+# index:  {"format_version": 1, "story_format_version": 1, "story": Story.to_dict(),
+#          "assets": {asset_id: [offset, length]}}
+# footer: index offset (uint64) | index length (uint64) | magic (8 bytes)
+# The assets are served by memory-mapping the bundle and slicing it (no copy).
+###############################################################################################
+
+BUNDLE_MAGIC = b"RVBUNDLE"
+BUNDLE_FORMAT_VERSION = 1
+BUNDLE_EXTENSION = ".rvb"
+
+_footer_struct = struct.Struct("<QQ8s")
+_COPY_BLOCK_SIZE = 1024 * 1024
+
+
+def is_bundle_path(path: str) -> bool:
+    return path.endswith(BUNDLE_EXTENSION) and os.path.isfile(path)
+
+
+def write_bundle(
+    bundle_path: str, story_dict: dict, assets: Dict[str, Union[str, bytes]]
+) -> None:
+    """
+    Write a story bundle (through a temporary file renamed over the destination).
+
+    Args:
+        bundle_path (str): the path of the bundle
+        story_dict (dict): the story dictionary (Story.to_dict format, referencing the assets by id)
+        assets (Dict[str, str | bytes]): the assets of the story: asset id -> file path or content (bytes-like)
+    """
+    directory = os.path.dirname(bundle_path) or "."
+    os.makedirs(directory, exist_ok=True)
+    fd, temporary_path = tempfile.mkstemp(dir=directory, suffix=BUNDLE_EXTENSION)
+    try:
+        with os.fdopen(fd, "wb") as file:
+            file.write(BUNDLE_MAGIC)
+
+            asset_offsets = {}
+            for asset_id, asset in assets.items():
+                offset = file.tell()
+                if isinstance(asset, str):
+                    with open(asset, "rb") as asset_file:
+                        for block in iter(
+                            lambda: asset_file.read(_COPY_BLOCK_SIZE), b""
+                        ):
+                            file.write(block)
+                else:
+                    file.write(asset)
+                asset_offsets[asset_id] = [offset, file.tell() - offset]
+
+            index = json.dumps(
+                {
+                    "format_version": BUNDLE_FORMAT_VERSION,
+                    "story_format_version": STORY_LOG_FORMAT_VERSION,
+                    "story": story_dict,
+                    "assets": asset_offsets,
+                },
+                separators=(",", ":"),
+                ensure_ascii=False,
+            ).encode("utf-8")
+            index_offset = file.tell()
+            file.write(index)
+            file.write(_footer_struct.pack(index_offset, len(index), BUNDLE_MAGIC))
+        os.replace(temporary_path, bundle_path)
+    except BaseException:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+        raise
+
+
+def _read_index(file) -> dict:
+    file.seek(-_footer_struct.size, os.SEEK_END)
+    index_offset, index_length, magic = _footer_struct.unpack(
+        file.read(_footer_struct.size)
+    )
+    if magic != BUNDLE_MAGIC:
+        raise ValueError("Not a story bundle")
+
+    file.seek(index_offset)
+    index = json.loads(file.read(index_length))
+    if index["format_version"] > BUNDLE_FORMAT_VERSION:
+        raise ValueError(
+            "Unsupported story bundle version {}".format(index["format_version"])
+        )
+    return index
+
+
+def read_bundle_header(bundle_path: str) -> dict:
+    """
+    Read the metadata of the story of a bundle (without its parts).
+
+    Returns:
+        dict: the story dictionary without "story_parts"
+    """
+    with open(bundle_path, "rb") as file:
+        story_dict = _read_index(file)["story"]
+    story_dict.pop("story_parts", None)
+    return story_dict
+
+
+class StoryBundle:
+    """
+    Read-only story bundle, memory-mapped.
+
+    Parameters:
+        path (str): the path of the bundle
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = open(path, "rb")
+        self._index = _read_index(self._file)
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._mmap)
+
+    def close(self) -> None:
+        """
+        Close the bundle (the assets read from it must not be used anymore).
+        """
+        self._view.release()
+        self._mmap.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def get_story_dict(self) -> dict:
+        """
+        Get the story dictionary (a copy, migrated to the current story format version).
+        """
+        return migrate_story_dict(
+            json.loads(json.dumps(self._index["story"])),
+            self._index.get("story_format_version", STORY_LOG_FORMAT_VERSION),
+        )
+
+    def get_asset_ids(self):
+        return list(self._index["assets"].keys())
+
+    def has_asset(self, asset_id: str) -> bool:
+        return asset_id in self._index["assets"]
+
+    def read_asset(self, asset_id: str) -> memoryview:
+        """
+        Get the content of an asset (slice of the memory-mapped bundle, no copy).
+        """
+        offset, length = self._index["assets"][asset_id]
+        return self._view[offset : offset + length]
+
+
+_open_bundles = {}
+open_bundles_lock = Lock()
+
+
+def open_bundle(path: str) -> StoryBundle:
+    """
+    Open a bundle (bundles stay open to serve their assets).
+    """
+    path = os.path.abspath(path)
+    with open_bundles_lock:
+        bundle = _open_bundles.get(path)
+        if bundle is None:
+            bundle = StoryBundle(path)
+            _open_bundles[path] = bundle
+        return bundle
@@ -0,0 +1,47 @@
+import os
+import tempfile
+
+
+def write_file_atomically(path: str, data: bytes, fsync: bool = True) -> None:
+    """
+    Write a file through a temporary file renamed over the destination.
+    A crash during the write leaves the previous version of the file intact.
+
+    Args:
+        path (str): the destination file path
+        data (bytes): the content of the file
+        fsync (bool): True to flush the content to the disk before the rename
+    """
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+
+    fd, temp_path = tempfile.mkstemp(
+        dir=directory, prefix="." + os.path.basename(path) + "."
+    )
+    try:
+        with os.fdopen(fd, "wb") as file:
+            file.write(data)
+            if fsync:
+                file.flush()
+                os.fsync(file.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def append_to_file(path: str, data: bytes, fsync: bool = True) -> None:
+    """
+    Append data at the end of a file.
+
+    Args:
+        path (str): the file path
+        data (bytes): the data to append
+        fsync (bool): True to flush the data to the disk before returning
+    """
+    with open(path, "ab") as file:
+        file.write(data)
+        if fsync:
+            file.flush()
+            os.fsync(file.fileno())
@@ -0,0 +1,160 @@
+import json
+import os
+
+from contextlib import contextmanager
+from threading import Lock
+from typing import List
+from storage.file_utils import write_file_atomically, append_to_file
+
+try:
+    import fcntl
+except ImportError:  # Windows: only the sessions of this process are synchronized
+    fcntl = None
+
+###############################################################################################
+# Idea store
+#
+# Append-only JSON lines file of the generated story ideas (one idea per line).
+# Appending is O(1) and the last ideas are read from the end of the file.
+###############################################################################################
+
+IDEAS_FILE_PATH = "out/previous_ideas.jsonl"
+LEGACY_IDEAS_FILE_PATH = "out/previous_ideas.json"
+# Number of ideas kept when the file is compacted (None -> keep all the ideas)
+IDEAS_RETENTION = 1000
+# File size (bytes) above which the file is compacted to the last IDEAS_RETENTION ideas
+IDEAS_COMPACTION_SIZE = 2 * 1024 * 1024
+
+_READ_BLOCK_SIZE = 64 * 1024
+
+ideas_lock = Lock()
+
+
+@contextmanager
+def _locked_store():
+    """
+    Lock the store for the threads of this process and the other processes.
+    """
+    with ideas_lock:
+        os.makedirs(os.path.dirname(IDEAS_FILE_PATH) or ".", exist_ok=True)
+        if fcntl is None:
+            yield
+            return
+
+        with open(IDEAS_FILE_PATH + ".lock", "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _encode_idea(idea: dict) -> bytes:
+    return json.dumps(idea, ensure_ascii=False).encode("utf-8") + b"\n"
+
+
+def _migrate_legacy_ideas() -> None:
+    """
+    Convert the legacy previous_ideas.json (a single JSON list) to the store (lock held).
+    """
+    if os.path.exists(IDEAS_FILE_PATH) or not os.path.exists(LEGACY_IDEAS_FILE_PATH):
+        return
+
+    try:
+        with open(LEGACY_IDEAS_FILE_PATH, "r") as f:
+            ideas = json.load(f)
+    except Exception as e:
+        print("Failed to read the previous ideas: {}".format(e))
+        ideas = []
+
+    if IDEAS_RETENTION is not None:
+        ideas = ideas[-IDEAS_RETENTION:]
+    write_file_atomically(IDEAS_FILE_PATH, b"".join(_encode_idea(i) for i in ideas))
+    os.remove(LEGACY_IDEAS_FILE_PATH)
+
+
+def _read_last_lines(filename: str, number_of_lines: int) -> List[bytes]:
+    """
+    Read the last complete lines of a file from its end.
+    """
+    if number_of_lines <= 0 or not os.path.exists(filename):
+        return []
+
+    with open(filename, "rb") as file:
+        file.seek(0, os.SEEK_END)
+        position = file.tell()
+        data = b""
+        # One more line than needed: the first one may be cut by the block boundary
+        while position > 0 and data.count(b"\n") <= number_of_lines:
+            read_size = min(_READ_BLOCK_SIZE, position)
+            position -= read_size
+            file.seek(position)
+            data = file.read(read_size) + data
+
+    lines = data.split(b"\n")
+    if position > 0:
+        lines = lines[1:]
+    lines = [line for line in lines if line.strip() != b""]
+    return lines[-number_of_lines:]
+
+
+def _ends_with_new_line(filename: str) -> bool:
+    if not os.path.exists(filename) or os.path.getsize(filename) == 0:
+        return True
+    with open(filename, "rb") as file:
+        file.seek(-1, os.SEEK_END)
+        return file.read(1) == b"\n"
+
+
+def _compact_store() -> None:
+    """
+    Keep only the last IDEAS_RETENTION ideas (lock held).
+    """
+    lines = _read_last_lines(IDEAS_FILE_PATH, IDEAS_RETENTION)
+    write_file_atomically(IDEAS_FILE_PATH, b"".join(line + b"\n" for line in lines))
+
+
+def append_idea(idea: dict) -> None:
+    """
+    Add an idea at the end of the store.
+
+    Args:
+        idea (dict): the idea (story information)
+    """
+    with _locked_store():
+        _migrate_legacy_ideas()
+        data = _encode_idea(idea)
+        if not _ends_with_new_line(IDEAS_FILE_PATH):
+            # Do not merge the idea with the incomplete line of an interrupted write
+            data = b"\n" + data
+        append_to_file(IDEAS_FILE_PATH, data, fsync=False)
+
+        if (
+            IDEAS_RETENTION is not None
+            and os.path.getsize(IDEAS_FILE_PATH) > IDEAS_COMPACTION_SIZE
+        ):
+            _compact_store()
+
+
+def read_last_ideas(number_of_ideas: int) -> List[dict]:
+    """
+    Read the last ideas of the store.
+
+    Args:
+        number_of_ideas (int): the maximum number of ideas to read
+
+    Returns:
+        List[dict]: the ideas, oldest first
+    """
+    with _locked_store():
+        _migrate_legacy_ideas()
+        lines = _read_last_lines(IDEAS_FILE_PATH, number_of_ideas)
+
+    ideas = []
+    for line in lines:
+        try:
+            ideas.append(json.loads(line))
+        except json.JSONDecodeError:
+            # Incomplete line (interrupted write)
+            continue
+    return ideas
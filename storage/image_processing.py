@@ -0,0 +1,171 @@
+import multiprocessing
+import os
+import time
+
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from threading import Lock
+from PIL import Image
+from metrics import metrics_add, metrics_observe
+
+###############################################################################################
+# Image processing
+#
+# The CPU-bound image work (decoding the generated images, resizing them into variants,
+# encoding, metadata extraction) runs in a pool of worker processes instead of the threads
+# that hold the API connections. The tasks read and write files (the temporary files of the
+# asset store): the results come back by file path and are added to the store by the caller.
+# The pool is sized with IMAGE_PROCESS_WORKERS (environment variable REVERIS_IMAGE_WORKERS,
+# 0 -> the tasks run in the calling thread). Its queue and processing times are reported
+# in the metrics (image_pool_queue_seconds, image_pool_task_seconds).
+###############################################################################################
+
+IMAGE_PROCESS_WORKERS = int(
+    os.environ.get("REVERIS_IMAGE_WORKERS", max(1, min(4, (os.cpu_count() or 2) - 1)))
+)
+
+_pool = None
+_pool_lock = Lock()
+
+
+###############################################################################################
+# Tasks (run in the worker processes: they only use their arguments and the files)
+###############################################################################################
+
+
+def _get_metadata(image: Image.Image) -> dict:
+    return {"width": image.width, "height": image.height, "mode": image.mode}
+
+
+def encode_jpeg_task(
+    source_path: str, output_path: str, quality: int = 100, subsampling: int = 0
+) -> dict:
+    """
+    Decode an image file (Example: a generated PNG) and encode it as a JPEG file.
+
+    Returns:
+        dict: {"path": output_path, "width", "height", "mode" (of the source)}
+    """
+    with Image.open(source_path) as image:
+        metadata = _get_metadata(image)
+        image = image.convert("RGB")
+        image.save(output_path, format="JPEG", quality=quality, subsampling=subsampling)
+    metadata["path"] = output_path
+    return metadata
+
+
+def resize_variants_task(
+    source_path: str, output_paths: dict, widths: dict, quality: int
+) -> dict:
+    """
+    Resize an image into JPEG variants (the variants not smaller than the image are skipped).
+
+    Args:
+        source_path (str): the image file
+        output_paths (dict): variant name -> output file path
+        widths (dict): variant name -> width in pixels (the height keeps the aspect ratio)
+        quality (int): the JPEG quality of the variants
+
+    Returns:
+        dict: variant name -> {"path", "width", "height"} of the written variants
+    """
+    variants = {}
+    with Image.open(source_path) as image:
+        # Only the needed DCT scale of a JPEG is decoded (at least twice the largest variant)
+        draft_width = 2 * max(widths.values())
+        image.draft("RGB", (draft_width, image.height * draft_width // image.width))
+        image = image.convert("RGB")
+        # Largest variant first: each variant is resized from the previous one
+        for name, width in sorted(
+            widths.items(), key=lambda item: item[1], reverse=True
+        ):
+            if width >= image.width:
+                continue
+            height = max(1, round(image.height * width / image.width))
+            image = image.resize((width, height), Image.LANCZOS)
+            image.save(
+                output_paths[name],
+                "JPEG",
+                quality=quality,
+                optimize=True,
+                progressive=True,
+            )
+            variants[name] = {
+                "path": output_paths[name],
+                "width": width,
+                "height": height,
+            }
+    return variants
+
+
+def _run_task(task: callable, args: tuple, kwargs: dict):
+    start_time = time.time()
+    result = task(*args, **kwargs)
+    return start_time, time.time() - start_time, result
+
+
+###############################################################################################
+# Pool
+###############################################################################################
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # Spawned workers: the parent threads (API calls, Streamlit) are not forked
+            _pool = ProcessPoolExecutor(
+                max_workers=IMAGE_PROCESS_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return _pool
+
+
+def _reset_pool() -> None:
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+
+def run_image_task(task: callable, *args, **kwargs):
+    """
+    Run an image task in the process pool and wait for its result.
+    The task runs in the calling thread if the pool is disabled or broken.
+
+    Args:
+        task (callable): a task of this module (Example: resize_variants_task)
+        *args, **kwargs: its arguments (file paths and plain values)
+
+    Returns:
+        the result of the task
+    """
+    submit_time = time.time()
+    if IMAGE_PROCESS_WORKERS > 0:
+        try:
+            future = _get_pool().submit(_run_task, task, args, kwargs)
+            start_time, duration, result = future.result()
+            metrics_observe(
+                "image_pool_queue_seconds", max(0, start_time - submit_time)
+            )
+            metrics_observe("image_pool_task_seconds", duration)
+            return result
+        except BrokenProcessPool as e:
+            # Ex: a worker killed by the system: the next tasks start a new pool
+            print(
+                "Image process pool broken ({}), running the task in-process".format(e)
+            )
+            metrics_add("image_pool_failures")
+            _reset_pool()
+
+    result = task(*args, **kwargs)
+    metrics_observe("image_pool_task_seconds", time.time() - submit_time)
+    return result
+
+
+def shutdown_image_pool() -> None:
+    """
+    Stop the worker processes (they are started again by the next task).
+    """
+    _reset_pool()
@@ -0,0 +1,268 @@
+import hashlib
+import os
+import random
+import re
+import sqlite3
+import struct
+import sys
+import time
+
+from typing import List, Tuple
+from metrics import metrics_add, metrics_observe
+from storage.sqlite_utils import get_thread_connection
+from storage.asset_store import has_asset, touch_asset
+
+###############################################################################################
+# Image prompt index
+#
+# The prompts of the generated images are indexed to reuse an image instead of generating a
+# new one for a near-identical prompt (the descriptions of the illustrations are often very
+# close within a story and across the replays of the same overview).
+# The similarity of two prompts is the Jaccard similarity of their sets of word shingles,
+# estimated with MinHash signatures (IMAGE_PROMPT_PERMUTATIONS hashes per prompt). The
+# signatures are split in bands (locality-sensitive hashing): only the prompts sharing a
+# band with the new prompt are compared. The image of the most similar prompt is reused when
+# the prompts are near-identical:
+#   - the similarity reaches IMAGE_REUSE_THRESHOLD (REVERIS_IMAGE_REUSE_THRESHOLD)
+#   - at most IMAGE_REUSE_MAX_CHANGED_WORDS words differ (REVERIS_IMAGE_REUSE_MAX_CHANGED_WORDS,
+#     estimated from the similarity and the length of the prompt)
+# A similarity alone does not tell near-identical prompts apart: replacing "red dragon" by
+# "small fox" keeps 0.8 in a 35 word prompt and more than 0.95 in the 100+ word descriptions
+# of the illustrator, while one replaced word costs more in a short prompt. The number of
+# changed words does not depend on the length. The estimate is noisy (MinHash): a prompt with
+# one changed word is not always reused, a wrong image is worse than a new one.
+# Hits are counted per prompt and in the metrics (image_reuse_hits, image_reuse_hit_rate):
+#   python -m storage.image_prompt_index stats
+###############################################################################################
+
+IMAGE_PROMPT_INDEX_DATABASE_PATH = "out/image_prompts.sqlite"
+IMAGE_REUSE_THRESHOLD = float(os.environ.get("REVERIS_IMAGE_REUSE_THRESHOLD", 0.9))
+IMAGE_REUSE_MAX_CHANGED_WORDS = float(
+    os.environ.get("REVERIS_IMAGE_REUSE_MAX_CHANGED_WORDS", 1)
+)
+# Number of words of a shingle
+IMAGE_PROMPT_SHINGLE_SIZE = 2
+# Number of MinHash functions = bands * rows per band
+IMAGE_PROMPT_PERMUTATIONS = 128
+IMAGE_PROMPT_BANDS = 32
+
+_IMAGE_PROMPT_SCHEMA = """
+CREATE TABLE IF NOT EXISTS image_prompts (
+    prompt_id INTEGER PRIMARY KEY,
+    style TEXT,
+    asset_id TEXT,
+    signature BLOB,
+    hits INTEGER DEFAULT 0,
+    created_time REAL
+);
+CREATE TABLE IF NOT EXISTS image_prompt_bands (
+    band INTEGER,
+    band_hash BLOB,
+    prompt_id INTEGER
+);
+CREATE INDEX IF NOT EXISTS image_prompt_bands_hash ON image_prompt_bands (band, band_hash);
+"""
+
+# Mersenne prime modulus of the hash functions ((a * x + b) mod p)
+_PRIME = (1 << 61) - 1
+# Fixed seed: the signatures stored in the database stay comparable
+_random = random.Random(8191)
+_PERMUTATIONS = [
+    (_random.randrange(1, _PRIME), _random.randrange(0, _PRIME))
+    for _ in range(IMAGE_PROMPT_PERMUTATIONS)
+]
+_ROWS_PER_BAND = IMAGE_PROMPT_PERMUTATIONS // IMAGE_PROMPT_BANDS
+_SIGNATURE_FORMAT = "<{}Q".format(IMAGE_PROMPT_PERMUTATIONS)
+
+
+def _get_connection() -> sqlite3.Connection:
+    return get_thread_connection(IMAGE_PROMPT_INDEX_DATABASE_PATH, _IMAGE_PROMPT_SCHEMA)
+
+
+def _get_shingles(prompt: str) -> set:
+    words = re.findall(r"\w+", prompt.lower())
+    if len(words) < IMAGE_PROMPT_SHINGLE_SIZE:
+        return {" ".join(words)}
+    return {
+        " ".join(words[i : i + IMAGE_PROMPT_SHINGLE_SIZE])
+        for i in range(len(words) - IMAGE_PROMPT_SHINGLE_SIZE + 1)
+    }
+
+
+def compute_prompt_signature(prompt: str) -> List[int]:
+    """
+    Compute the MinHash signature of a prompt.
+
+    Returns:
+        List[int]: the minimum of each hash function over the shingles of the prompt
+    """
+    hashes = [
+        int.from_bytes(
+            hashlib.blake2b(shingle.encode("utf-8"), digest_size=8).digest(), "little"
+        )
+        for shingle in _get_shingles(prompt)
+    ]
+    return [min((a * h + b) % _PRIME for h in hashes) for a, b in _PERMUTATIONS]
+
+
+def _get_band_hashes(signature: List[int]) -> List[bytes]:
+    return [
+        hashlib.blake2b(
+            struct.pack(
+                "<{}Q".format(_ROWS_PER_BAND),
+                *signature[band * _ROWS_PER_BAND : (band + 1) * _ROWS_PER_BAND],
+            ),
+            digest_size=8,
+        ).digest()
+        for band in range(IMAGE_PROMPT_BANDS)
+    ]
+
+
+def _get_similarity(signature: List[int], other_signature: List[int]) -> float:
+    equal = sum(1 for a, b in zip(signature, other_signature) if a == b)
+    return equal / IMAGE_PROMPT_PERMUTATIONS
+
+
+def _estimate_changed_words(similarity: float, shingles: int) -> float:
+    """
+    Estimate the number of words replaced between two prompts of about the same length.
+
+    Args:
+        similarity (float): the Jaccard similarity of their shingles
+        shingles (int): the number of shingles of one of the prompts
+    """
+    # |A - B| + |B - A| = (1 - J) / (1 + J) * (|A| + |B|)
+    different = (1 - similarity) / (1 + similarity) * 2 * shingles
+    # A replaced word changes IMAGE_PROMPT_SHINGLE_SIZE shingles of each prompt
+    return different / (2 * IMAGE_PROMPT_SHINGLE_SIZE)
+
+
+def find_similar_image(
+    prompt: str, style: str, threshold: float = None
+) -> Tuple[str, float]:
+    """
+    Find the image of the most similar indexed prompt.
+
+    Args:
+        prompt (str): the prompt of the image to generate
+        style (str): the style of the image (only the images of the same style are reused)
+        threshold (float): the minimum similarity (None -> IMAGE_REUSE_THRESHOLD), the prompts
+            must also differ by at most IMAGE_REUSE_MAX_CHANGED_WORDS words
+
+    Returns:
+        str: the asset id of the image (None if no prompt is similar enough)
+        float: the similarity of its prompt (0 if none)
+    """
+    if threshold is None:
+        threshold = IMAGE_REUSE_THRESHOLD
+    signature = compute_prompt_signature(prompt)
+    connection = _get_connection()
+
+    candidates = set()
+    for band, band_hash in enumerate(_get_band_hashes(signature)):
+        for row in connection.execute(
+            "SELECT prompt_id FROM image_prompt_bands WHERE band = ? AND band_hash = ?",
+            (band, band_hash),
+        ):
+            candidates.add(row["prompt_id"])
+
+    best = (None, None, 0.0)
+    for prompt_id in candidates:
+        row = connection.execute(
+            "SELECT asset_id, style, signature FROM image_prompts WHERE prompt_id = ?",
+            (prompt_id,),
+        ).fetchone()
+        if row is None or row["style"] != style:
+            continue
+        similarity = _get_similarity(
+            signature, struct.unpack(_SIGNATURE_FORMAT, row["signature"])
+        )
+        if similarity > best[2] and has_asset(row["asset_id"]):
+            best = (prompt_id, row["asset_id"], similarity)
+
+    prompt_id, asset_id, similarity = best
+    is_near_identical = (
+        similarity >= threshold
+        and _estimate_changed_words(similarity, len(_get_shingles(prompt)))
+        <= IMAGE_REUSE_MAX_CHANGED_WORDS
+    )
+    # The reused image is kept by the garbage collection until the story references it
+    if asset_id is None or not is_near_identical or not touch_asset(asset_id):
+        metrics_add("image_reuse_misses")
+        metrics_observe("image_reuse_hit_rate", 0)
+        return None, similarity
+
+    with connection:
+        connection.execute(
+            "UPDATE image_prompts SET hits = hits + 1 WHERE prompt_id = ?", (prompt_id,)
+        )
+    metrics_add("image_reuse_hits")
+    metrics_observe("image_reuse_hit_rate", 1)
+    metrics_observe("image_reuse_similarity", similarity)
+    return asset_id, similarity
+
+
+def add_image_prompt(prompt: str, style: str, asset_id: str) -> None:
+    """
+    Index the prompt of a generated image.
+
+    Args:
+        prompt (str): the prompt of the image
+        style (str): the style of the image
+        asset_id (str): the image in the asset store
+    """
+    signature = compute_prompt_signature(prompt)
+    connection = _get_connection()
+    with connection:
+        prompt_id = connection.execute(
+            "INSERT INTO image_prompts (style, asset_id, signature, created_time) VALUES (?, ?, ?, ?)",
+            (
+                style,
+                asset_id,
+                struct.pack(_SIGNATURE_FORMAT, *signature),
+                time.time(),
+            ),
+        ).lastrowid
+        connection.executemany(
+            "INSERT INTO image_prompt_bands (band, band_hash, prompt_id) VALUES (?, ?, ?)",
+            [
+                (band, band_hash, prompt_id)
+                for band, band_hash in enumerate(_get_band_hashes(signature))
+            ],
+        )
+
+
+def get_image_prompt_index_stats() -> dict:
+    """
+    Get the statistics of the index.
+
+    Returns:
+        dict: {"prompts": number of indexed prompts, "hits": number of reused images,
+        "reused_prompts": number of prompts whose image was reused}
+    """
+    row = (
+        _get_connection()
+        .execute(
+            "SELECT COUNT(*) AS prompts, COALESCE(SUM(hits), 0) AS hits, "
+            "COALESCE(SUM(hits > 0), 0) AS reused_prompts FROM image_prompts"
+        )
+        .fetchone()
+    )
+    return {
+        "prompts": row["prompts"],
+        "hits": row["hits"],
+        "reused_prompts": row["reused_prompts"],
+    }
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2 or sys.argv[1] != "stats":
+        print("Usage: python -m storage.image_prompt_index stats")
+        sys.exit(1)
+
+    stats = get_image_prompt_index_stats()
+    print(
+        "{} prompts indexed, {} images reused ({} prompts reused)".format(
+            stats["prompts"], stats["hits"], stats["reused_prompts"]
+        )
+    )
@@ -0,0 +1,91 @@
+import os
+import time
+
+from metrics import metrics_observe
+from storage.asset_store import get_temporary_asset_path, open_asset, put_asset_file
+from storage.image_processing import run_image_task, resize_variants_task
+
+###############################################################################################
+# Image variants
+#
+# Smaller copies of the generated images (1792x1024 HD JPEG), stored in the asset store next to
+# the original: a thumbnail (history) and a display size (story pages). The image modules
+# record them (image_variant_assets: variant name -> asset id) and the UI picks the smallest
+# variant at least as wide as its column, the original otherwise.
+# The variants are resized by the image process pool (see storage/image_processing.py).
+###############################################################################################
+
+# Variant name -> width in pixels (the height keeps the aspect ratio)
+IMAGE_VARIANT_WIDTHS = {"thumbnail": 320, "display": 1024}
+IMAGE_VARIANT_QUALITY = 85
+
+
+def make_image_variants(asset_id: str) -> dict:
+    """
+    Generate the variants of an image of the asset store.
+    The variants not smaller than the original are skipped.
+
+    Args:
+        asset_id (str): the id of the original image
+
+    Returns:
+        dict: variant name -> asset id of the variant (empty if the image is missing)
+    """
+    source = open_asset(asset_id)
+    if source is None:
+        return {}
+
+    start_time = time.perf_counter()
+    temporary_paths = []
+    if isinstance(source, memoryview):
+        # Asset served from a story bundle: the image process pool reads files
+        path = get_temporary_asset_path("jpg")
+        temporary_paths.append(path)
+        with open(path, "wb") as file:
+            file.write(source)
+        source = path
+    output_paths = {
+        name: get_temporary_asset_path("jpg") for name in IMAGE_VARIANT_WIDTHS
+    }
+    temporary_paths += list(output_paths.values())
+
+    try:
+        results = run_image_task(
+            resize_variants_task,
+            source,
+            output_paths,
+            IMAGE_VARIANT_WIDTHS,
+            IMAGE_VARIANT_QUALITY,
+        )
+        variants = {
+            name: put_asset_file(result["path"], "jpg")
+            for name, result in results.items()
+        }
+    finally:
+        for path in temporary_paths:
+            if os.path.exists(path):
+                os.remove(path)
+    metrics_observe("image_variants_seconds", time.perf_counter() - start_time)
+    return variants
+
+
+def select_image_variant(image_asset: str, variant_assets: dict, width: int) -> str:
+    """
+    Select the smallest variant of an image that is at least as wide as the display.
+
+    Args:
+        image_asset (str): the id of the original image
+        variant_assets (dict): variant name -> asset id (None -> original only)
+        width (int): the display width in pixels (None -> original)
+
+    Returns:
+        str: the id of the selected image
+    """
+    if width is None or not variant_assets:
+        return image_asset
+    for name, variant_width in sorted(
+        IMAGE_VARIANT_WIDTHS.items(), key=lambda item: item[1]
+    ):
+        if variant_width >= width and name in variant_assets:
+            return variant_assets[name]
+    return image_asset
@@ -0,0 +1,605 @@
+import argparse
+import io
+import os
+import shutil
+import sqlite3
+import subprocess
+import tempfile
+import time
+
+from datetime import datetime
+from typing import List
+from PIL import Image
+from storage.sqlite_utils import get_thread_connection
+from storage.story_log import read_story_dict, write_story_log
+from storage.persistence_queue import flush_saves, has_pending_saves
+from storage.story_catalog import (
+    is_catalog_built,
+    rebuild_catalog,
+    catalog_list_stories_by_last_use,
+    catalog_remove_story,
+    catalog_update_story,
+)
+from storage.story_search import search_remove_story
+from storage.image_variants import make_image_variants
+from storage.speech_cache import speech_cache_replace_asset
+from storage.speech_formats import SPEECH_FORMATS
+import storage.asset_store as asset_store
+from storage.asset_store import (
+    collect_asset_ids,
+    collect_garbage,
+    get_asset_extension,
+    get_asset_path,
+    put_asset_bytes,
+    set_asset_references,
+)
+
+###############################################################################################
+# Maintenance
+#
+# Retention of the story folders (out/stories) and of their assets:
+#   - recompression: the images and speeches of the stories that have been neither saved nor
+#     opened for MAINTENANCE_RECOMPRESS_AFTER_DAYS days are re-encoded to smaller files.
+#     The recompressed assets are new assets of the store: the story is rewritten to reference
+#     them (atomic rewrite of its log) before its references are updated, the previous assets
+#     (replaced in the speech cache too) are then reclaimed by the garbage collection of the
+#     store. The image and speech files of
+#     the legacy stories are moved to the store the same way and the images saved before the
+#     image variants get theirs (see storage/image_variants.py).
+#   - quota: while the stories and the store use more than MAINTENANCE_DISK_QUOTA bytes, the
+#     least recently used (saved or opened) story is removed with its catalog, search index
+#     and asset references.
+# A story file always references existing assets: an asset is only removed once no story
+# references it. Run it (Example: daily) with:
+#   python -m storage.maintenance run
+#   python -m storage.maintenance dry-run
+###############################################################################################
+
+MAINTENANCE_STORY_DIRECTORY = "out/stories"
+MAINTENANCE_DATABASE_PATH = "out/maintenance.sqlite"
+# Age (days since the last save or opening) of the stories whose assets are recompressed
+MAINTENANCE_RECOMPRESS_AFTER_DAYS = 30
+# Format ("jpg" or "webp") and quality of the recompressed images
+MAINTENANCE_IMAGE_FORMAT = "jpg"
+MAINTENANCE_IMAGE_QUALITY = 80
+# Bitrate of the recompressed speeches (needs ffmpeg, the speeches are kept otherwise)
+MAINTENANCE_SPEECH_BITRATE = "48k"
+# Maximum size (bytes) of the stories and the asset store (None -> no quota)
+MAINTENANCE_DISK_QUOTA = None
+if os.environ.get("REVERIS_DISK_QUOTA_GB"):
+    MAINTENANCE_DISK_QUOTA = int(float(os.environ["REVERIS_DISK_QUOTA_GB"]) * 1024**3)
+# Stories used during the last days are never evicted
+MAINTENANCE_MIN_IDLE_DAYS = 1
+
+_MAINTENANCE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS recompressed_assets (
+    source_asset_id TEXT PRIMARY KEY,
+    asset_id TEXT,
+    source_size INTEGER,
+    size INTEGER
+);
+CREATE INDEX IF NOT EXISTS recompressed_assets_asset ON recompressed_assets (asset_id);
+CREATE TABLE IF NOT EXISTS recompressed_stories (
+    path TEXT PRIMARY KEY,
+    last_used_time REAL
+);
+"""
+
+# Module keys of the assets and of the files of the legacy stories
+_ASSET_KEYS = [("image_asset", "image_path"), ("speech_asset", "speech_file_path")]
+_IMAGE_EXTENSIONS = ["jpg", "jpeg", "png", "webp"]
+_SPEECH_EXTENSIONS = ["mp3", "wav", "ogg", "opus", "aac", "flac"]
+
+
+def _get_connection() -> sqlite3.Connection:
+    return get_thread_connection(MAINTENANCE_DATABASE_PATH, _MAINTENANCE_SCHEMA)
+
+
+def _get_size(path: str) -> int:
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    size = 0
+    for folder, _, filenames in os.walk(path):
+        for filename in filenames:
+            file_path = os.path.join(folder, filename)
+            if not os.path.islink(file_path):
+                size += os.path.getsize(file_path)
+    return size
+
+
+def get_disk_usage() -> dict:
+    """
+    Get the disk usage of the stories and the asset store.
+
+    Returns:
+        dict: {"stories": bytes, "assets": bytes, "total": bytes}
+    """
+    usage = {"stories": 0, "assets": 0}
+    if os.path.exists(MAINTENANCE_STORY_DIRECTORY):
+        usage["stories"] = _get_size(MAINTENANCE_STORY_DIRECTORY)
+    if os.path.exists(asset_store.ASSET_STORE_PATH):
+        usage["assets"] = _get_size(asset_store.ASSET_STORE_PATH)
+    usage["total"] = usage["stories"] + usage["assets"]
+    return usage
+
+
+###############################################################################################
+# Recompression
+###############################################################################################
+
+
+def _recompress_image(data: bytes) -> bytes:
+    image = Image.open(io.BytesIO(data))
+    if image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+    output = io.BytesIO()
+    if MAINTENANCE_IMAGE_FORMAT == "webp":
+        image.save(output, "WEBP", quality=MAINTENANCE_IMAGE_QUALITY, method=6)
+    else:
+        image.save(
+            output,
+            "JPEG",
+            quality=MAINTENANCE_IMAGE_QUALITY,
+            subsampling="4:2:0",
+            optimize=True,
+        )
+    return output.getvalue()
+
+
+def _recompress_speech(path: str) -> bytes:
+    """
+    Re-encode a speech to a MP3 file of MAINTENANCE_SPEECH_BITRATE (None if ffmpeg is missing).
+    """
+    ffmpeg = shutil.which("ffmpeg")
+    if ffmpeg is None:
+        return None
+    fd, output_path = tempfile.mkstemp(suffix=".mp3")
+    os.close(fd)
+    try:
+        subprocess.run(
+            [ffmpeg, "-y", "-loglevel", "error", "-i", path, "-ac", "1"]
+            + ["-b:a", MAINTENANCE_SPEECH_BITRATE, output_path],
+            check=True,
+        )
+        with open(output_path, "rb") as file:
+            return file.read()
+    finally:
+        os.remove(output_path)
+
+
+def _recompress_file(path: str, extension: str) -> tuple:
+    """
+    Recompress an image or speech file.
+
+    Returns:
+        bytes: the recompressed content (None if it cannot be recompressed)
+        str: its extension
+    """
+    extension = extension.lower()
+    try:
+        if extension in _IMAGE_EXTENSIONS:
+            with open(path, "rb") as file:
+                data = _recompress_image(file.read())
+            return data, MAINTENANCE_IMAGE_FORMAT
+        if extension in _SPEECH_EXTENSIONS:
+            return _recompress_speech(path), "mp3"
+    except Exception as e:
+        print("Failed to recompress {}: {}".format(path, e))
+    return None, None
+
+
+def _recompress_asset(asset_id: str, report: dict, dry_run: bool) -> str:
+    """
+    Get the recompressed version of an asset of the store.
+
+    Returns:
+        str: the id of the recompressed asset (None -> keep the asset)
+    """
+    connection = _get_connection()
+    row = connection.execute(
+        "SELECT asset_id FROM recompressed_assets WHERE source_asset_id = ?",
+        (asset_id,),
+    ).fetchone()
+    if row is not None:
+        # Already recompressed for another story (or not smaller)
+        if row["asset_id"] == asset_id:
+            return None
+        if os.path.exists(get_asset_path(row["asset_id"])):
+            return row["asset_id"]
+    if (
+        connection.execute(
+            "SELECT 1 FROM recompressed_assets WHERE asset_id = ?", (asset_id,)
+        ).fetchone()
+        is not None
+    ):
+        return None
+
+    path = get_asset_path(asset_id)
+    if not os.path.exists(path):
+        return None
+    source_size = os.path.getsize(path)
+    data, extension = _recompress_file(path, get_asset_extension(asset_id))
+    if data is None:
+        return None
+    if len(data) >= source_size:
+        data, extension = None, None
+
+    report["recompressed_assets"] += data is not None
+    report["recompressed_bytes"] += 0 if data is None else source_size - len(data)
+    if dry_run:
+        return None
+
+    new_asset_id = asset_id if data is None else put_asset_bytes(data, extension)
+    with connection:
+        connection.execute(
+            "INSERT OR REPLACE INTO recompressed_assets (source_asset_id, asset_id, source_size, size) VALUES (?, ?, ?, ?)",
+            (asset_id, new_asset_id, source_size, source_size if data is None else len(data)),
+        )
+    return None if data is None else new_asset_id
+
+
+def _find_legacy_file(story_dir: str, path: str) -> str:
+    # The legacy paths are relative to the working directory of the app that saved them
+    for candidate in [path, os.path.join(story_dir, os.path.basename(path))]:
+        if os.path.isfile(candidate):
+            return candidate
+    return None
+
+
+def _move_legacy_file(story_dir: str, path: str, report: dict, dry_run: bool) -> tuple:
+    """
+    Move an image or speech file of a legacy story to the store (recompressed if smaller).
+
+    Returns:
+        str: the id of the asset (None -> keep the file)
+        str: the path of the moved file
+    """
+    file_path = _find_legacy_file(story_dir, path)
+    if file_path is None:
+        return None, None
+    source_size = os.path.getsize(file_path)
+    extension = os.path.splitext(file_path)[1][1:].lower()
+    data, new_extension = _recompress_file(file_path, extension)
+    if data is None or len(data) >= source_size:
+        with open(file_path, "rb") as file:
+            data, new_extension = file.read(), extension
+    else:
+        report["recompressed_assets"] += 1
+        report["recompressed_bytes"] += source_size - len(data)
+    if dry_run:
+        return None, None
+    return put_asset_bytes(data, new_extension), file_path
+
+
+def recompress_story(story_dir: str, dry_run: bool = False) -> dict:
+    """
+    Recompress the assets of a story and rewrite the story to reference them.
+
+    Args:
+        story_dir (str): the directory of the story
+        dry_run (bool): True to only estimate the reclaimed bytes
+
+    Returns:
+        dict: {"recompressed_assets": int, "recompressed_bytes": int (bytes saved by the recompression), "rewritten": bool}
+    """
+    report = {"recompressed_assets": 0, "recompressed_bytes": 0, "rewritten": False}
+    story_dict, _ = read_story_dict(story_dir)
+    if story_dict is None:
+        return report
+
+    changed = False
+    moved_files = []
+    # asset id -> recompressed asset id (the same asset can be referenced several times)
+    new_asset_ids = {}
+
+    def recompress(asset_id: str) -> str:
+        if asset_id not in new_asset_ids:
+            new_asset_ids[asset_id] = _recompress_asset(asset_id, report, dry_run)
+        return new_asset_ids[asset_id]
+
+    for part in story_dict["story_parts"]:
+        for module_dict in part:
+            for asset_key, path_key in _ASSET_KEYS:
+                asset_id = module_dict.get(asset_key)
+                if asset_id is not None:
+                    new_asset_id = recompress(asset_id)
+                elif module_dict.get(path_key) is not None:
+                    new_asset_id, file_path = _move_legacy_file(
+                        story_dir, module_dict[path_key], report, dry_run
+                    )
+                    if new_asset_id is not None:
+                        module_dict[path_key] = None
+                        moved_files.append(file_path)
+                else:
+                    continue
+                if new_asset_id is not None:
+                    module_dict[asset_key] = new_asset_id
+                    if asset_key == "speech_asset":
+                        # The recompressed speeches are MP3 files
+                        module_dict["speech_format"] = get_asset_extension(new_asset_id)
+                    changed = True
+
+            variant_assets = module_dict.get("image_variant_assets")
+            if variant_assets is not None:
+                for name, asset_id in variant_assets.items():
+                    new_asset_id = recompress(asset_id)
+                    if new_asset_id is not None:
+                        variant_assets[name] = new_asset_id
+                        changed = True
+            elif module_dict.get("image_asset") is not None and not dry_run:
+                variant_assets = make_image_variants(module_dict["image_asset"])
+                module_dict["image_variant_assets"] = variant_assets
+                changed = True
+                if story_dict.get("thumbnail_asset") is None:
+                    story_dict["thumbnail_asset"] = variant_assets.get(
+                        "thumbnail", module_dict["image_asset"]
+                    )
+
+    thumbnail_asset = story_dict.get("thumbnail_asset")
+    if new_asset_ids.get(thumbnail_asset) is not None:
+        story_dict["thumbnail_asset"] = new_asset_ids[thumbnail_asset]
+        changed = True
+
+    if dry_run or not changed:
+        report["rewritten"] = dry_run and report["recompressed_assets"] > 0
+        return report
+
+    # The new assets are referenced by the rewritten story before the previous ones are released
+    owner = os.path.normpath(story_dir)
+    metadata = {
+        key: value
+        for key, value in story_dict.items()
+        if key not in ["story_parts", "saved_time", "part_links", "checkpoints"]
+    }
+    write_story_log(
+        story_dir,
+        metadata,
+        story_dict["story_parts"],
+        story_dict["saved_time"],
+        story_dict.get("part_links"),
+        story_dict.get("checkpoints"),
+    )
+    set_asset_references(
+        owner,
+        collect_asset_ids([story_dict["story_parts"], story_dict.get("checkpoints")]),
+    )
+    catalog_update_story(owner, story_dict)
+    for asset_id, new_asset_id in new_asset_ids.items():
+        if new_asset_id is not None and get_asset_extension(asset_id) in SPEECH_FORMATS:
+            # The speech cache does not keep the original speech in the store either
+            speech_cache_replace_asset(asset_id, new_asset_id)
+    for file_path in moved_files:
+        if os.path.exists(file_path):
+            os.remove(file_path)
+    report["rewritten"] = True
+    return report
+
+
+def recompress_old_stories(
+    after_days: float = None, dry_run: bool = False, stories: List[dict] = None
+) -> dict:
+    """
+    Recompress the assets of the stories unused for some days.
+
+    Args:
+        after_days (float): the minimum number of days since the last use (None -> MAINTENANCE_RECOMPRESS_AFTER_DAYS)
+        dry_run (bool): True to only estimate the reclaimed bytes
+        stories (List[dict]): the stories of the catalog (see catalog_list_stories_by_last_use)
+
+    Returns:
+        dict: {"stories": int, "recompressed_assets": int, "recompressed_bytes": int}
+    """
+    if after_days is None:
+        after_days = MAINTENANCE_RECOMPRESS_AFTER_DAYS
+    if stories is None:
+        stories = catalog_list_stories_by_last_use()
+    limit_time = time.time() - after_days * 24 * 3600
+
+    report = {"stories": 0, "recompressed_assets": 0, "recompressed_bytes": 0}
+    connection = _get_connection()
+    for story in _get_maintained_stories(stories):
+        if story["last_used_time"] >= limit_time:
+            break
+        # The stories are recompressed once (until they are used again)
+        story_dir = story["path"]
+        row = connection.execute(
+            "SELECT last_used_time FROM recompressed_stories WHERE path = ?",
+            (story_dir,),
+        ).fetchone()
+        if row is not None and row["last_used_time"] == story["last_used_time"]:
+            continue
+        try:
+            story_report = recompress_story(story_dir, dry_run)
+        except Exception as e:
+            print("Failed to recompress the story {}: {}".format(story_dir, e))
+            continue
+        report["stories"] += story_report["rewritten"]
+        report["recompressed_assets"] += story_report["recompressed_assets"]
+        report["recompressed_bytes"] += story_report["recompressed_bytes"]
+        if not dry_run:
+            with connection:
+                connection.execute(
+                    "INSERT OR REPLACE INTO recompressed_stories (path, last_used_time) VALUES (?, ?)",
+                    (story_dir, story["last_used_time"]),
+                )
+    return report
+
+
+###############################################################################################
+# Quota
+###############################################################################################
+
+
+def _get_maintained_stories(stories: List[dict]) -> List[dict]:
+    # Only the story folders of the app (not the demo stories and the bundles)
+    story_directory = os.path.normpath(MAINTENANCE_STORY_DIRECTORY)
+    return [
+        story
+        for story in stories
+        if os.path.dirname(story["path"]) == story_directory
+        and os.path.isdir(story["path"])
+        and not has_pending_saves(story["path"])
+    ]
+
+
+def _get_exclusive_assets_size(owner: str) -> int:
+    # Size of the assets referenced by this story only
+    connection = asset_store._get_connection()
+    row = connection.execute(
+        """
+        SELECT COALESCE(SUM(assets.size), 0) AS size FROM asset_references
+        JOIN assets ON assets.asset_id = asset_references.asset_id
+        WHERE asset_references.owner = ? AND assets.reference_count = 1
+        """,
+        (owner,),
+    ).fetchone()
+    return row["size"]
+
+
+def evict_story(story_dir: str) -> None:
+    """
+    Remove a story folder with its catalog, search index and asset references
+    (its assets are reclaimed by the next garbage collection of the store).
+    """
+    owner = os.path.normpath(story_dir)
+    catalog_remove_story(owner)
+    search_remove_story(owner)
+    set_asset_references(owner, [])
+    shutil.rmtree(story_dir, ignore_errors=True)
+
+
+def enforce_disk_quota(
+    quota: int = None, dry_run: bool = False, stories: List[dict] = None
+) -> dict:
+    """
+    Evict the least recently used stories until the stories and the asset store fit in the quota.
+
+    Args:
+        quota (int): the maximum size in bytes (None -> MAINTENANCE_DISK_QUOTA)
+        dry_run (bool): True to only report the evicted stories
+        stories (List[dict]): the stories of the catalog (see catalog_list_stories_by_last_use)
+
+    Returns:
+        dict: {"evicted_stories": [paths], "evicted_bytes": int (estimated)}
+    """
+    if quota is None:
+        quota = MAINTENANCE_DISK_QUOTA
+    report = {"evicted_stories": [], "evicted_bytes": 0}
+    if quota is None:
+        return report
+    if stories is None:
+        stories = catalog_list_stories_by_last_use()
+
+    usage = get_disk_usage()["total"]
+    limit_time = time.time() - MAINTENANCE_MIN_IDLE_DAYS * 24 * 3600
+    for story in _get_maintained_stories(stories):
+        if usage <= quota or story["last_used_time"] >= limit_time:
+            break
+        story_dir = story["path"]
+        size = _get_size(story_dir) + _get_exclusive_assets_size(story_dir)
+        if not dry_run:
+            evict_story(story_dir)
+        report["evicted_stories"].append(story_dir)
+        report["evicted_bytes"] += size
+        usage -= size
+    return report
+
+
+###############################################################################################
+# Maintenance run
+###############################################################################################
+
+
+def run_maintenance(
+    recompress_after_days: float = None, quota: int = None, dry_run: bool = False
+) -> dict:
+    """
+    Recompress the old stories, enforce the disk quota and reclaim the unreferenced assets.
+
+    Args:
+        recompress_after_days (float): see recompress_old_stories (None -> MAINTENANCE_RECOMPRESS_AFTER_DAYS)
+        quota (int): see enforce_disk_quota (None -> MAINTENANCE_DISK_QUOTA)
+        dry_run (bool): True to only report what would be done (the reclaimed bytes are estimated)
+
+    Returns:
+        dict: the report of the run (the reclaimed bytes are measured on the disk)
+    """
+    start_time = time.perf_counter()
+    # The stories saved by this process are written before they are read
+    flush_saves()
+    if not is_catalog_built():
+        rebuild_catalog()
+
+    usage_before = get_disk_usage()
+    stories = catalog_list_stories_by_last_use()
+    report = {"time": datetime.now().isoformat(), "dry_run": dry_run}
+    report["recompression"] = recompress_old_stories(
+        recompress_after_days, dry_run, stories
+    )
+    report["quota"] = enforce_disk_quota(quota, dry_run, stories)
+    report["garbage_collection"] = collect_garbage(dry_run=dry_run)
+    report["usage_before"] = usage_before
+    report["usage_after"] = get_disk_usage()
+    if dry_run:
+        report["reclaimed_bytes"] = (
+            report["recompression"]["recompressed_bytes"]
+            + report["quota"]["evicted_bytes"]
+        )
+    else:
+        report["reclaimed_bytes"] = (
+            usage_before["total"] - report["usage_after"]["total"]
+        )
+    report["duration_seconds"] = time.perf_counter() - start_time
+    return report
+
+
+def _print_report(report: dict) -> None:
+    recompression = report["recompression"]
+    quota = report["quota"]
+    print(
+        "{} stories recompressed ({} assets, {} bytes saved)".format(
+            recompression["stories"],
+            recompression["recompressed_assets"],
+            recompression["recompressed_bytes"],
+        )
+    )
+    print(
+        "{} stories evicted ({} bytes)".format(
+            len(quota["evicted_stories"]), quota["evicted_bytes"]
+        )
+    )
+    for path in quota["evicted_stories"]:
+        print("  " + path)
+    print(
+        "{} unreferenced assets removed ({} bytes)".format(
+            report["garbage_collection"]["removed_assets"],
+            report["garbage_collection"]["reclaimed_bytes"],
+        )
+    )
+    print(
+        "{}{} bytes reclaimed ({} -> {} bytes)".format(
+            "(dry run, estimated) " if report["dry_run"] else "",
+            report["reclaimed_bytes"],
+            report["usage_before"]["total"],
+            report["usage_after"]["total"],
+        )
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Recompress the old stories and enforce the disk quota of out/stories"
+    )
+    parser.add_argument("command", choices=["run", "dry-run"])
+    parser.add_argument(
+        "--recompress-after-days", type=float, default=MAINTENANCE_RECOMPRESS_AFTER_DAYS
+    )
+    parser.add_argument(
+        "--quota-gb", type=float, default=None, help="disk quota of the stories and assets"
+    )
+    args = parser.parse_args()
+
+    quota = None if args.quota_gb is None else int(args.quota_gb * 1024**3)
+    _print_report(
+        run_maintenance(args.recompress_after_days, quota, args.command == "dry-run")
+    )
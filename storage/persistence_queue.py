@@ -0,0 +1,134 @@
+import atexit
+import time
+
+from collections import OrderedDict
+from threading import Condition, Thread, current_thread
+from metrics import metrics_add, metrics_observe
+
+###############################################################################################
+# Persistence queue
+#
+# Write-behind saves: Story.save_to_file queues the save of the story and returns, the reader
+# does not wait for the story files. A writer thread runs the queued saves one at a time, in
+# the order of their first request, PERSISTENCE_FLUSH_DELAY seconds after it: the saves of a
+# story requested meanwhile are coalesced into one (the save writes the latest state of the
+# story). A save requested while the same story is being written runs after it.
+# The pending saves are flushed before a story is loaded again and when the process exits.
+###############################################################################################
+
+# Time (seconds) a save waits in the queue to be coalesced with the next saves of its story
+PERSISTENCE_FLUSH_DELAY = 0.5
+
+_condition = Condition()
+# key -> {"save": callable, "time": time of the first request}
+_pending_saves = OrderedDict()
+_running_keys = set()
+_flush_requests = 0
+_writer_thread = None
+
+
+def _start_writer() -> None:
+    global _writer_thread
+    if _writer_thread is None:
+        _writer_thread = Thread(target=_write_saves, daemon=True)
+        _writer_thread.start()
+
+
+def queue_save(key: str, save: callable) -> None:
+    """
+    Queue the save of a story.
+
+    Args:
+        key (str): the key of the saved story (Example: its working folder)
+        save (callable): writes the story (called without arguments by the writer thread)
+    """
+    with _condition:
+        save_request = _pending_saves.get(key)
+        if save_request is None:
+            _pending_saves[key] = {"save": save, "time": time.time()}
+        else:
+            save_request["save"] = save
+            metrics_add("persistence_saves_coalesced")
+        metrics_add("persistence_saves_queued")
+        _start_writer()
+        _condition.notify_all()
+
+
+def _write_saves() -> None:
+    while True:
+        with _condition:
+            if len(_pending_saves) == 0:
+                _condition.wait()
+                continue
+            key, save_request = next(iter(_pending_saves.items()))
+            delay = save_request["time"] + PERSISTENCE_FLUSH_DELAY - time.time()
+            if delay > 0 and _flush_requests == 0:
+                _condition.wait(delay)
+                continue
+            del _pending_saves[key]
+            _running_keys.add(key)
+
+        metrics_observe("persistence_queue_seconds", time.time() - save_request["time"])
+        try:
+            save_request["save"]()
+        except Exception as e:
+            print("Failed to save {}: {}".format(key, e))
+        finally:
+            with _condition:
+                _running_keys.discard(key)
+                _condition.notify_all()
+
+
+def has_pending_saves(key: str = None) -> bool:
+    """
+    Return whether saves are queued or being written.
+
+    Args:
+        key (str): the key of a story (None -> any story)
+    """
+    with _condition:
+        return _is_pending(key)
+
+
+def _is_pending(key: str) -> bool:
+    if key is None:
+        return len(_pending_saves) > 0 or len(_running_keys) > 0
+    return key in _pending_saves or key in _running_keys
+
+
+def flush_saves(key: str = None, timeout: float = None) -> bool:
+    """
+    Write the queued saves now and wait for them.
+
+    Args:
+        key (str): wait for the saves of this story only (None -> all the saves)
+        timeout (float): the maximum waiting time in seconds (None -> no limit)
+
+    Returns:
+        bool: True if the saves have been written, False after the timeout
+    """
+    global _flush_requests
+    if current_thread() is _writer_thread:
+        # A save cannot wait for the writer thread that runs it
+        return not has_pending_saves(key)
+    end_time = None if timeout is None else time.time() + timeout
+    with _condition:
+        _flush_requests += 1
+        _condition.notify_all()
+        try:
+            while True:
+                if not _is_pending(key):
+                    return True
+                if end_time is None:
+                    _condition.wait()
+                else:
+                    remaining = end_time - time.time()
+                    if remaining <= 0:
+                        return False
+                    _condition.wait(remaining)
+        finally:
+            _flush_requests -= 1
+
+
+# The queued saves are written before the process exits
+atexit.register(flush_saves)
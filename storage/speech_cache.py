@@ -0,0 +1,207 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+import unicodedata
+
+from metrics import metrics_add, metrics_observe
+from storage.sqlite_utils import get_thread_connection
+from storage.asset_store import (
+    get_asset_extension,
+    get_asset_path,
+    has_asset,
+    add_asset_references,
+    remove_asset_references,
+)
+
+###############################################################################################
+# Speech cache
+#
+# The synthesized speeches are reused when the same text is read again (story regenerated,
+# text repeated across branches or translations). The cache maps a hash of
+# (normalized text, voice, model, format) to the speech in the asset store.
+# The cache owns a reference to its speeches (owner SPEECH_CACHE_OWNER) so that the garbage
+# collection of the store keeps them when no story uses them anymore. Above
+# SPEECH_CACHE_MAX_SIZE bytes, the least recently used speeches leave the cache. A speech
+# replaced in the stories (recompressed by storage/maintenance.py) is replaced in the cache too,
+# so that the cache does not keep the original.
+# Hits and misses are reported in the metrics (speech_cache_hits, speech_cache_misses, and
+# speech_cache_hit_rate: its mean is the hit rate).
+###############################################################################################
+
+SPEECH_CACHE_DATABASE_PATH = "out/speech_cache.sqlite"
+SPEECH_CACHE_OWNER = "speech_cache"
+# Total size (bytes) of the cached speeches (0 -> no cache)
+SPEECH_CACHE_MAX_SIZE = (
+    int(os.environ.get("REVERIS_SPEECH_CACHE_MB", 512)) * 1024 * 1024
+)
+
+_SPEECH_CACHE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS cached_speeches (
+    cache_key TEXT PRIMARY KEY,
+    asset_id TEXT,
+    size INTEGER,
+    last_used_time REAL
+);
+CREATE INDEX IF NOT EXISTS cached_speeches_last_used ON cached_speeches (last_used_time);
+"""
+
+
+def _get_connection() -> sqlite3.Connection:
+    return get_thread_connection(SPEECH_CACHE_DATABASE_PATH, _SPEECH_CACHE_SCHEMA)
+
+
+def normalize_speech_text(text: str) -> str:
+    """
+    Normalize a text for the cache: the texts read the same way have the same key
+    (Unicode normalization, whitespace).
+    """
+    return " ".join(unicodedata.normalize("NFC", text).split())
+
+
+def get_speech_cache_key(text: str, voice: str, model: str, audio_format: str) -> str:
+    """
+    Get the cache key of a speech.
+
+    Args:
+        text (str): the text read
+        voice (str): the voice (Example: "nova")
+        model (str): the text to speech model (Example: "tts-1")
+        audio_format (str): the audio format (Example: "mp3")
+    """
+    key = json.dumps([normalize_speech_text(text), voice, model, audio_format])
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+
+def speech_cache_get(cache_key: str) -> str:
+    """
+    Get a cached speech.
+
+    Returns:
+        str: the asset id of the speech (None if it is not cached)
+    """
+    if SPEECH_CACHE_MAX_SIZE <= 0:
+        return None
+    connection = _get_connection()
+    row = connection.execute(
+        "SELECT asset_id FROM cached_speeches WHERE cache_key = ?", (cache_key,)
+    ).fetchone()
+    if row is None or not has_asset(row["asset_id"]):
+        metrics_add("speech_cache_misses")
+        metrics_observe("speech_cache_hit_rate", 0)
+        return None
+
+    with connection:
+        connection.execute(
+            "UPDATE cached_speeches SET last_used_time = ? WHERE cache_key = ?",
+            (time.time(), cache_key),
+        )
+    metrics_add("speech_cache_hits")
+    metrics_observe("speech_cache_hit_rate", 1)
+    return row["asset_id"]
+
+
+def speech_cache_put(cache_key: str, asset_id: str) -> None:
+    """
+    Add a synthesized speech to the cache (the least recently used speeches are evicted).
+
+    Args:
+        cache_key (str): the key of the speech (see get_speech_cache_key)
+        asset_id (str): the speech in the asset store
+    """
+    if SPEECH_CACHE_MAX_SIZE <= 0:
+        return
+    size = os.path.getsize(get_asset_path(asset_id))
+    connection = _get_connection()
+    with connection:
+        previous = connection.execute(
+            "SELECT asset_id FROM cached_speeches WHERE cache_key = ?", (cache_key,)
+        ).fetchone()
+        connection.execute(
+            "INSERT OR REPLACE INTO cached_speeches (cache_key, asset_id, size, last_used_time) VALUES (?, ?, ?, ?)",
+            (cache_key, asset_id, size, time.time()),
+        )
+    if previous is not None and previous["asset_id"] != asset_id:
+        _release_assets([previous["asset_id"]])
+    add_asset_references(SPEECH_CACHE_OWNER, [asset_id])
+    evict_speeches()
+
+
+def _release_assets(asset_ids: list) -> None:
+    # The speeches still cached under another key (same audio) keep their reference
+    connection = _get_connection()
+    released = [
+        asset_id
+        for asset_id in asset_ids
+        if connection.execute(
+            "SELECT 1 FROM cached_speeches WHERE asset_id = ?", (asset_id,)
+        ).fetchone()
+        is None
+    ]
+    remove_asset_references(SPEECH_CACHE_OWNER, released)
+
+
+def speech_cache_replace_asset(asset_id: str, new_asset_id: str) -> None:
+    """
+    Replace a cached speech by another version (Example: recompressed by the maintenance).
+    The speech leaves the cache if the new version has another format.
+
+    Args:
+        asset_id (str): the replaced speech
+        new_asset_id (str): the new version of the speech
+    """
+    connection = _get_connection()
+    if get_asset_extension(new_asset_id) == get_asset_extension(asset_id):
+        size = os.path.getsize(get_asset_path(new_asset_id))
+        with connection:
+            replaced = connection.execute(
+                "UPDATE cached_speeches SET asset_id = ?, size = ? WHERE asset_id = ?",
+                (new_asset_id, size, asset_id),
+            ).rowcount
+        if replaced > 0:
+            add_asset_references(SPEECH_CACHE_OWNER, [new_asset_id])
+    else:
+        with connection:
+            connection.execute(
+                "DELETE FROM cached_speeches WHERE asset_id = ?", (asset_id,)
+            )
+    _release_assets([asset_id])
+
+
+def evict_speeches(max_size: int = None) -> int:
+    """
+    Evict the least recently used speeches until the cache fits its maximum size.
+    The evicted speeches stay in the asset store while stories reference them.
+
+    Args:
+        max_size (int): the maximum total size in bytes (None -> SPEECH_CACHE_MAX_SIZE)
+
+    Returns:
+        int: the number of evicted speeches
+    """
+    if max_size is None:
+        max_size = SPEECH_CACHE_MAX_SIZE
+    connection = _get_connection()
+    total_size = connection.execute(
+        "SELECT COALESCE(SUM(size), 0) AS total FROM cached_speeches"
+    ).fetchone()["total"]
+    if total_size <= max_size:
+        return 0
+
+    evicted = []
+    for row in connection.execute(
+        "SELECT cache_key, asset_id, size FROM cached_speeches ORDER BY last_used_time"
+    ).fetchall():
+        if total_size <= max_size:
+            break
+        evicted.append(row)
+        total_size -= row["size"]
+    with connection:
+        connection.executemany(
+            "DELETE FROM cached_speeches WHERE cache_key = ?",
+            [(row["cache_key"],) for row in evicted],
+        )
+    _release_assets([row["asset_id"] for row in evicted])
+    metrics_add("speech_cache_evictions", len(evicted))
+    return len(evicted)
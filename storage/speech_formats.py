@@ -0,0 +1,175 @@
+import io
+import os
+import shutil
+import struct
+import subprocess
+import wave
+
+from typing import List, Union
+
+###############################################################################################
+# Speech formats
+#
+# Audio format of the synthesized speeches, per deployment:
+#   - REVERIS_SPEECH_FORMAT: the response format asked to the provider (SPEECH_FORMATS: the
+#     formats that pygame plays, "mp3" by default; "opus" is the most compact)
+#   - REVERIS_SPEECH_BITRATE: the speeches are transcoded locally to this bitrate before
+#     they are stored (Example: "32k", needs ffmpeg; unset -> stored as received)
+# The format of a speech is the extension of its asset and is recorded in its module.
+# Only the MP3 speeches can be played while they are synthesized (see speech_streams.py).
+###############################################################################################
+
+# Format -> ffmpeg encoder arguments
+_ENCODERS = {
+    "mp3": ["-c:a", "libmp3lame", "-f", "mp3"],
+    "opus": ["-c:a", "libopus", "-f", "ogg"],
+    "flac": ["-c:a", "flac", "-f", "flac"],
+    "wav": ["-c:a", "pcm_s16le", "-f", "wav"],
+}
+SPEECH_FORMATS = list(_ENCODERS)
+# Format -> MIME type (Example: the HTML audio players)
+_MIME_TYPES = {
+    "mp3": "audio/mp3",
+    "opus": "audio/ogg",
+    "flac": "audio/flac",
+    "wav": "audio/wav",
+}
+# Formats without bitrate (never transcoded)
+_LOSSLESS_FORMATS = ["flac", "wav"]
+
+SPEECH_FORMAT = os.environ.get("REVERIS_SPEECH_FORMAT", "mp3").lower()
+SPEECH_BITRATE = os.environ.get("REVERIS_SPEECH_BITRATE") or None
+if SPEECH_FORMAT not in SPEECH_FORMATS:
+    raise ValueError(
+        "Unsupported speech format {} (supported: {})".format(
+            SPEECH_FORMAT, ", ".join(SPEECH_FORMATS)
+        )
+    )
+
+_ffmpeg_warning_printed = False
+
+
+def get_speech_format(path: str) -> str:
+    """
+    Get the format of a speech from its asset id or file path (Example: "opus").
+    """
+    return os.path.splitext(path)[1][1:].lower()
+
+
+def get_speech_mime_type(audio_format: str) -> str:
+    """
+    Get the MIME type of a speech format (Example: "audio/ogg" for "opus").
+    """
+    return _MIME_TYPES.get(audio_format, "audio/mp3")
+
+
+def get_speech_settings_key() -> str:
+    """
+    Get the key of the speech settings (the speeches of different settings differ).
+
+    Returns:
+        str: the format and the bitrate of the stored speeches (Example: "opus" or "mp3@32k")
+    """
+    if should_transcode_speeches():
+        return "{}@{}".format(SPEECH_FORMAT, SPEECH_BITRATE)
+    return SPEECH_FORMAT
+
+
+def _get_ffmpeg() -> str:
+    global _ffmpeg_warning_printed
+    ffmpeg = shutil.which("ffmpeg")
+    if ffmpeg is None and not _ffmpeg_warning_printed:
+        _ffmpeg_warning_printed = True
+        print("ffmpeg is missing: the speeches are neither transcoded nor merged")
+    return ffmpeg
+
+
+def should_transcode_speeches() -> bool:
+    return SPEECH_BITRATE is not None and SPEECH_FORMAT not in _LOSSLESS_FORMATS
+
+
+def transcode_speech(source_path: str, output_path: str) -> bool:
+    """
+    Transcode a synthesized speech to SPEECH_BITRATE (mono, same format).
+
+    Returns:
+        bool: True if the speech has been transcoded (False if ffmpeg is missing)
+    """
+    ffmpeg = _get_ffmpeg()
+    if ffmpeg is None:
+        return False
+    subprocess.run(
+        [ffmpeg, "-y", "-loglevel", "error", "-i", source_path, "-ac", "1"]
+        + _ENCODERS[SPEECH_FORMAT]
+        + ["-b:a", SPEECH_BITRATE, output_path],
+        check=True,
+    )
+    return True
+
+
+def concatenate_speeches(
+    source_paths: List[str], output_path: str, audio_format: str
+) -> bool:
+    """
+    Concatenate speech files into one file (decoded and encoded again).
+
+    Returns:
+        bool: True if the file has been written (False if ffmpeg is missing)
+    """
+    ffmpeg = _get_ffmpeg()
+    if ffmpeg is None:
+        return False
+    inputs = []
+    for path in source_paths:
+        inputs += ["-i", path]
+    streams = "".join("[{}:a]".format(i) for i in range(len(source_paths)))
+    subprocess.run(
+        [ffmpeg, "-y", "-loglevel", "error"]
+        + inputs
+        + [
+            "-filter_complex",
+            "{}concat=n={}:v=0:a=1[a]".format(streams, len(source_paths)),
+            "-map",
+            "[a]",
+        ]
+        + _ENCODERS[audio_format]
+        + [output_path],
+        check=True,
+    )
+    return True
+
+
+def get_speech_duration(data: Union[bytes, memoryview], audio_format: str) -> float:
+    """
+    Read the duration (seconds) of an Opus, FLAC or WAV speech from its headers
+    (MP3: see audio_tracks.read_mp3_frames).
+
+    Raises:
+        ValueError: if the duration cannot be read
+    """
+    data = bytes(data)
+    if audio_format == "wav":
+        with wave.open(io.BytesIO(data)) as file:
+            # The header of a streamed WAV file may not have the real length
+            frame_size = file.getsampwidth() * file.getnchannels()
+            frames = len(file.readframes(file.getnframes())) // frame_size
+            return frames / file.getframerate()
+    if audio_format == "flac":
+        # STREAMINFO: sample rate (20 bits), channels, bits per sample, total samples (36 bits)
+        if data[:4] != b"fLaC":
+            raise ValueError("Not a FLAC file")
+        value = int.from_bytes(data[18:26], "big")
+        return (value & ((1 << 36) - 1)) / (value >> 44)
+    if audio_format == "opus":
+        # Granule position (48 kHz samples) of the last Ogg page minus the pre-skip
+        head = data.find(b"OpusHead")
+        last_page = data.rfind(b"OggS")
+        while last_page > 0 and data[last_page + 4] != 0:
+            # "OggS" inside a packet (not followed by the stream version 0)
+            last_page = data.rfind(b"OggS", 0, last_page)
+        if head < 0 or last_page < 0:
+            raise ValueError("Not an Ogg Opus file")
+        pre_skip = struct.unpack("<H", data[head + 10 : head + 12])[0]
+        granule = struct.unpack("<q", data[last_page + 6 : last_page + 14])[0]
+        return (granule - pre_skip) / 48000
+    raise ValueError("Unsupported speech format {}".format(audio_format))
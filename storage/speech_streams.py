@@ -0,0 +1,110 @@
+import time
+
+from threading import Condition
+from metrics import metrics_observe
+from storage.audio_tracks import read_mp3_frames
+from storage.speech_formats import SPEECH_FORMAT
+
+###############################################################################################
+# Speech streams
+#
+# A speech is played while it is synthesized: the audio chunks received from the API are
+# appended to a growable buffer (SpeechStream) that the player reads meanwhile. The player
+# plays the stream as a sequence of MP3 segments (complete frames): the first one as soon as
+# SPEECH_STREAM_FIRST_SEGMENT seconds of audio are received, then all the audio received
+# while the previous segment plays. Once the synthesis is done, the speech is an asset of the
+# store as before (the stream is only kept in memory). Only the MP3 speeches are streamed.
+###############################################################################################
+
+# Stream the speeches (False -> a speech can only be played once synthesized)
+SPEECH_STREAMING = SPEECH_FORMAT == "mp3"
+# Audio (seconds) received before the playback starts, then minimum duration of the next segments
+SPEECH_STREAM_FIRST_SEGMENT = 0.25
+SPEECH_STREAM_MIN_SEGMENT = 1.0
+
+
+class SpeechStream:
+    """
+    Speech being synthesized, readable while it is written.
+
+    Parameters:
+        asset_id (str): the id of the speech in the asset store once finished (None -> not finished or failed)
+    """
+
+    def __init__(self):
+        self._data = bytearray()
+        self._condition = Condition()
+        self._finished = False
+        self._failed = False
+        self._start_time = time.time()
+        self.asset_id = None
+
+    def write(self, chunk: bytes) -> None:
+        """
+        Append an audio chunk (called by the synthesis thread).
+        """
+        with self._condition:
+            if len(self._data) == 0:
+                metrics_observe(
+                    "speech_stream_first_chunk_seconds", time.time() - self._start_time
+                )
+            self._data += chunk
+            self._condition.notify_all()
+
+    def finish(self, asset_id: str) -> None:
+        """
+        Mark the synthesis as done.
+
+        Args:
+            asset_id (str): the id of the speech in the asset store
+        """
+        with self._condition:
+            self.asset_id = asset_id
+            self._finished = True
+            self._condition.notify_all()
+
+    def fail(self) -> None:
+        """
+        Mark the synthesis as failed (Ex: cancelled): the readers stop after the received audio.
+        """
+        with self._condition:
+            self._failed = True
+            self._condition.notify_all()
+
+    def is_finished(self) -> bool:
+        return self._finished
+
+    def is_failed(self) -> bool:
+        return self._failed
+
+    def iter_segments(self):
+        """
+        Iterate over the audio of the stream as playable MP3 segments (waits for the audio).
+
+        Yields:
+            bytes: the complete MP3 frames received since the previous segment
+        """
+        position = 0
+        segment_duration = SPEECH_STREAM_FIRST_SEGMENT
+        while True:
+            with self._condition:
+                while True:
+                    done = self._finished or self._failed
+                    # Copy of the received audio only (the buffer keeps growing)
+                    data = bytes(self._data[position:])
+                    frames, samples, sample_rate = read_mp3_frames(
+                        data, file_start=position == 0, partial=True
+                    )
+                    if done or (
+                        sample_rate is not None
+                        and samples / sample_rate >= segment_duration
+                    ):
+                        break
+                    self._condition.wait()
+
+            if len(frames) > 0:
+                yield data[frames[0][0] : frames[-1][1]]
+                position += frames[-1][1]
+            if done:
+                return
+            segment_duration = SPEECH_STREAM_MIN_SEGMENT
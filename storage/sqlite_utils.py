@@ -0,0 +1,34 @@
+import os
+import sqlite3
+
+from threading import local
+
+_thread_connections = local()
+
+
+def get_thread_connection(database_path: str, schema: str) -> sqlite3.Connection:
+    """
+    Get the connection of the current thread to a SQLite database (created on first use).
+    SQLite connections can not be shared between threads.
+
+    Args:
+        database_path (str): the path of the database
+        schema (str): the SQL script that creates the tables (run when the connection is created)
+
+    Returns:
+        sqlite3.Connection: the connection (rows can be accessed by column name)
+    """
+    connections = getattr(_thread_connections, "connections", None)
+    if connections is None:
+        connections = {}
+        _thread_connections.connections = connections
+
+    connection = connections.get(database_path)
+    if connection is None:
+        os.makedirs(os.path.dirname(database_path) or ".", exist_ok=True)
+        connection = sqlite3.connect(database_path, timeout=30)
+        connection.row_factory = sqlite3.Row
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.executescript(schema)
+        connections[database_path] = connection
+    return connection
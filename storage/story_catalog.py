@@ -0,0 +1,384 @@
+import os
+import sqlite3
+import sys
+
+from datetime import datetime
+from typing import List, Optional, Tuple
+from storage.story_log import read_story_header
+from storage.bundle_format import BUNDLE_EXTENSION, read_bundle_header
+from storage.sqlite_utils import get_thread_connection
+
+###############################################################################################
+# Story catalog
+#
+# SQLite index of the stories shown in the history (title, time, language, overview, thumbnail)
+# and of the time each story was last opened (see storage/maintenance.py).
+# Story.save_to_file keeps it up to date. A story saved in several places (Example: a bundle
+# and the folder of the story continued from it) is listed once: its last saved copy.
+# The history table keeps that copy and the last use (save or opening) of each story, so
+# that a page of the history is an index range scan (keyset paging on (last_used_time, id))
+# whatever the size of the library.
+# Rebuild it from the story folders with:
+#   python -m storage.story_catalog rebuild
+###############################################################################################
+
+CATALOG_PATH = "out/catalog.sqlite"
+STORY_DIRECTORIES = ["demo_story", "out/stories", "out/bundles"]
+
+_CATALOG_SCHEMA = """
+CREATE TABLE IF NOT EXISTS stories (
+    path TEXT PRIMARY KEY,
+    id TEXT,
+    title TEXT,
+    saved_time REAL,
+    lang TEXT,
+    overview TEXT
+);
+CREATE INDEX IF NOT EXISTS stories_saved_time ON stories (saved_time DESC);
+CREATE INDEX IF NOT EXISTS stories_id ON stories (id, saved_time);
+CREATE TABLE IF NOT EXISTS story_thumbnails (
+    path TEXT PRIMARY KEY,
+    asset_id TEXT
+);
+CREATE TABLE IF NOT EXISTS story_opens (
+    path TEXT PRIMARY KEY,
+    opened_time REAL
+);
+CREATE TABLE IF NOT EXISTS story_history (
+    id TEXT PRIMARY KEY,
+    path TEXT,
+    last_used_time REAL
+);
+CREATE INDEX IF NOT EXISTS story_history_last_used ON story_history (last_used_time DESC, id DESC);
+CREATE TABLE IF NOT EXISTS catalog_info (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+# Catalogs built before the history table need a rebuild
+_BUILT_KEY = "built_with_history"
+
+
+def _get_connection() -> sqlite3.Connection:
+    return get_thread_connection(CATALOG_PATH, _CATALOG_SCHEMA)
+
+
+def _normalize_path(path: str) -> str:
+    return os.path.normpath(path)
+
+
+def _story_row(path: str, story_header: dict) -> tuple:
+    title_dict = story_header["title"] or {}
+    title = title_dict.get("displayed_text") or title_dict.get("text") or ""
+
+    lang = story_header["target_lang"]
+    if lang is None:
+        lang = "en"
+
+    saved_time = datetime.fromisoformat(story_header["saved_time"]).timestamp()
+    return (
+        _normalize_path(path),
+        story_header["id"],
+        title,
+        saved_time,
+        lang,
+        story_header["overview"],
+    )
+
+
+def _update_thumbnail(
+    connection: sqlite3.Connection, path: str, story_header: dict
+) -> None:
+    thumbnail_asset = story_header.get("thumbnail_asset")
+    if thumbnail_asset is None:
+        connection.execute(
+            "DELETE FROM story_thumbnails WHERE path = ?", (_normalize_path(path),)
+        )
+    else:
+        connection.execute(
+            "INSERT OR REPLACE INTO story_thumbnails (path, asset_id) VALUES (?, ?)",
+            (_normalize_path(path), thumbnail_asset),
+        )
+
+
+def _get_story_id(connection: sqlite3.Connection, path: str) -> Optional[str]:
+    row = connection.execute(
+        "SELECT id FROM stories WHERE path = ?", (_normalize_path(path),)
+    ).fetchone()
+    return None if row is None else row["id"]
+
+
+def _refresh_history(connection: sqlite3.Connection, story_id: Optional[str]) -> None:
+    # Recompute the history entry of a story from its copies
+    if story_id is None:
+        return
+    copies = connection.execute(
+        """
+        SELECT stories.path, saved_time, COALESCE(story_opens.opened_time, 0) AS opened_time
+        FROM stories LEFT JOIN story_opens ON stories.path = story_opens.path
+        WHERE stories.id = ?
+        """,
+        (story_id,),
+    ).fetchall()
+    if len(copies) == 0:
+        connection.execute("DELETE FROM story_history WHERE id = ?", (story_id,))
+        return
+
+    last_copy = max(copies, key=lambda row: (row["saved_time"], row["path"]))
+    last_used_time = max(max(row["saved_time"], row["opened_time"]) for row in copies)
+    connection.execute(
+        "INSERT OR REPLACE INTO story_history (id, path, last_used_time) VALUES (?, ?, ?)",
+        (story_id, last_copy["path"], last_used_time),
+    )
+
+
+def catalog_update_story(path: str, story_header: dict) -> None:
+    """
+    Add or update a story of the catalog.
+
+    Args:
+        path (str): the directory (or bundle) of the story
+        story_header (dict): the story dictionary (the parts are not needed)
+    """
+    connection = _get_connection()
+    with connection:
+        previous_id = _get_story_id(connection, path)
+        connection.execute(
+            "INSERT OR REPLACE INTO stories (path, id, title, saved_time, lang, overview) VALUES (?, ?, ?, ?, ?, ?)",
+            _story_row(path, story_header),
+        )
+        _update_thumbnail(connection, path, story_header)
+        _refresh_history(connection, story_header["id"])
+        if previous_id != story_header["id"]:
+            _refresh_history(connection, previous_id)
+
+
+def catalog_remove_story(path: str) -> None:
+    """
+    Remove a story from the catalog (Ex: its folder has been deleted).
+    """
+    connection = _get_connection()
+    with connection:
+        story_id = _get_story_id(connection, path)
+        connection.execute(
+            "DELETE FROM stories WHERE path = ?", (_normalize_path(path),)
+        )
+        connection.execute(
+            "DELETE FROM story_opens WHERE path = ?", (_normalize_path(path),)
+        )
+        connection.execute(
+            "DELETE FROM story_thumbnails WHERE path = ?", (_normalize_path(path),)
+        )
+        _refresh_history(connection, story_id)
+
+
+def catalog_mark_story_opened(path: str, opened_time: float = None) -> None:
+    """
+    Record that a reader opened a story.
+
+    Args:
+        path (str): the directory (or bundle) of the story
+        opened_time (float): the time of the opening (timestamp, None -> now)
+    """
+    if opened_time is None:
+        opened_time = datetime.now().timestamp()
+    connection = _get_connection()
+    with connection:
+        connection.execute(
+            "INSERT OR REPLACE INTO story_opens (path, opened_time) VALUES (?, ?)",
+            (_normalize_path(path), opened_time),
+        )
+        _refresh_history(connection, _get_story_id(connection, path))
+
+
+def catalog_list_stories_by_last_use() -> List[dict]:
+    """
+    List the stories of the catalog, least recently used (saved or opened) first.
+
+    Returns:
+        List[dict]: the stories in the following format:
+        [
+            {
+                "path": "out/stories/story_id",
+                "last_used_time": time of the last save or opening (timestamp)
+            },
+            ...
+        ]
+    """
+    rows = _get_connection().execute(
+        """
+        SELECT stories.path, MAX(stories.saved_time, COALESCE(story_opens.opened_time, 0)) AS last_used_time
+        FROM stories LEFT JOIN story_opens ON stories.path = story_opens.path
+        ORDER BY last_used_time
+        """
+    )
+    return [
+        {"path": row["path"], "last_used_time": row["last_used_time"]} for row in rows
+    ]
+
+
+# Last saved copy of a story: no other copy saved later (or at the same time, with a greater path)
+_LAST_COPY_CONDITION = """
+NOT EXISTS (
+    SELECT 1 FROM stories AS newer WHERE newer.id = stories.id AND (
+        newer.saved_time > stories.saved_time
+        OR (newer.saved_time = stories.saved_time AND newer.path > stories.path)
+    )
+)
+"""
+
+
+def is_catalog_built() -> bool:
+    """
+    Return whether the catalog has been built from the story folders.
+    (Stories saved before the first build are not enough to list the history.)
+    """
+    row = (
+        _get_connection()
+        .execute("SELECT value FROM catalog_info WHERE key = ?", (_BUILT_KEY,))
+        .fetchone()
+    )
+    return row is not None
+
+
+def rebuild_catalog(directories: List[str] = None) -> int:
+    """
+    Rebuild the catalog from the story folders and bundles.
+
+    Args:
+        directories (List[str]): the directories that contain the story folders and bundles (None -> STORY_DIRECTORIES)
+
+    Returns:
+        int: the number of indexed stories
+    """
+    if directories is None:
+        directories = STORY_DIRECTORIES
+
+    rows = []
+    headers = {}
+    for directory_path in directories:
+        if not os.path.exists(directory_path):
+            continue
+
+        for name in os.listdir(directory_path):
+            story_dir = os.path.join(directory_path, name)
+            is_bundle = name.endswith(BUNDLE_EXTENSION)
+            if not os.path.isdir(story_dir) and not is_bundle:
+                continue
+            try:
+                if is_bundle:
+                    story_header = read_bundle_header(story_dir)
+                else:
+                    story_header = read_story_header(story_dir)
+            except Exception as e:
+                print("Failed to read the story {}: {}".format(story_dir, e))
+                continue
+            if story_header is not None:
+                rows.append(_story_row(story_dir, story_header))
+                headers[story_dir] = story_header
+
+    connection = _get_connection()
+    with connection:
+        connection.execute("DELETE FROM stories")
+        connection.execute("DELETE FROM story_thumbnails")
+        connection.executemany(
+            "INSERT OR REPLACE INTO stories (path, id, title, saved_time, lang, overview) VALUES (?, ?, ?, ?, ?, ?)",
+            rows,
+        )
+        for story_dir, story_header in headers.items():
+            _update_thumbnail(connection, story_dir, story_header)
+        connection.execute("DELETE FROM story_history")
+        connection.execute(
+            """
+            INSERT INTO story_history (id, path, last_used_time)
+            SELECT stories.id, stories.path, (
+                SELECT MAX(MAX(copies.saved_time, COALESCE(story_opens.opened_time, 0)))
+                FROM stories AS copies LEFT JOIN story_opens ON copies.path = story_opens.path
+                WHERE copies.id = stories.id
+            )
+            FROM stories WHERE {}
+            """.format(
+                _LAST_COPY_CONDITION
+            )
+        )
+        connection.execute(
+            "INSERT OR REPLACE INTO catalog_info (key, value) VALUES (?, ?)",
+            (_BUILT_KEY, datetime.now().isoformat()),
+        )
+    return len(rows)
+
+
+def catalog_count_stories() -> int:
+    """
+    Count the stories of the history (on demand: it scans the whole history table).
+    """
+    return (
+        _get_connection().execute("SELECT COUNT(*) FROM story_history").fetchone()[0]
+    )
+
+
+def catalog_list_stories(
+    limit: int = 10, after: Optional[Tuple[float, str]] = None
+) -> List[dict]:
+    """
+    List the stories of the catalog, most recently used (saved or opened) first
+    (the last saved copy of each story).
+
+    Args:
+        limit (int): the maximum number of stories
+        after (Tuple[float, str]): the cursor of the last story of the previous page (None -> first page)
+
+    Returns:
+        List[dict]: the stories in the following format:
+        [
+            {
+                "title": "Title of the story",
+                "datetime": saved time (timestamp),
+                "overview": "Overview of the story",
+                "lang": "en",
+                "path": "out/stories/story_id",
+                "thumbnail_asset": asset id of the thumbnail (None -> no image),
+                "cursor": (last_used_time, id) to pass as `after` to get the next stories
+            },
+            ...
+        ]
+    """
+    query = """
+        SELECT story_history.id, story_history.last_used_time, stories.path, title, saved_time, lang, overview,
+            story_thumbnails.asset_id AS thumbnail_asset
+        FROM story_history
+        JOIN stories ON stories.path = story_history.path
+        LEFT JOIN story_thumbnails ON stories.path = story_thumbnails.path
+        {}
+        ORDER BY story_history.last_used_time DESC, story_history.id DESC LIMIT ?
+        """
+    if after is None:
+        rows = _get_connection().execute(query.format(""), (limit,))
+    else:
+        rows = _get_connection().execute(
+            query.format(
+                "WHERE (story_history.last_used_time, story_history.id) < (?, ?)"
+            ),
+            (after[0], after[1], limit),
+        )
+    return [
+        {
+            "title": row["title"],
+            "datetime": row["saved_time"],
+            "overview": row["overview"],
+            "lang": row["lang"],
+            "path": row["path"],
+            "thumbnail_asset": row["thumbnail_asset"],
+            "cursor": (row["last_used_time"], row["id"]),
+        }
+        for row in rows
+    ]
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2 or sys.argv[1] != "rebuild":
+        print("Usage: python -m storage.story_catalog rebuild")
+        sys.exit(1)
+
+    number_of_stories = rebuild_catalog()
+    print("{} stories indexed in {}".format(number_of_stories, CATALOG_PATH))
@@ -0,0 +1,521 @@
+import json
+import os
+
+from typing import List, Tuple
+from storage.file_utils import write_file_atomically, append_to_file
+from storage.story_serializer import (
+    StorySerializer,
+    get_serializer,
+    get_log_filenames,
+)
+
+###############################################################################################
+# Story log
+#
+# A story is stored as an append-only log of records (story.jsonl, see storage/story_serializer.py
+# for the other encodings):
+#   {"op":"header","time":...,"format":...,"format_version":1,"metadata":{...}}
+#   {"op":"part","time":...,"part":0,"modules":[...]}           -> (re)place a part
+#   {"op":"module","time":...,"part":0,"module":2,"data":{...}} -> replace a module
+#   {"op":"meta","time":...,"metadata":{...}}                   -> replace the metadata
+#   {"op":"link","time":...,"part":3,"parent":1,"choice":2}     -> (re)link a part in the story tree
+#   {"op":"checkpoint","time":...,"key":"1:2/image/0","data":...} -> result of a generation unit
+# Saving a part appends a record. A compaction rewrites the log as the header and
+# one record per part through a temporary file renamed over the log.
+#
+# The parts form a tree: a part hangs off its parent part and the index of the choice of the
+# parent it continues (story_dict["part_links"]: part index -> [parent, choice]). The parts
+# without link (linear stories) continue the previous part and its selected choice.
+#
+# The checkpoints are the results of the units (texts, descriptions, images, speeches...) of
+# the parts being generated, keyed by an idempotency key: "<parent>:<choice>/<unit>"
+# ("root/<unit>" for the first part). A generation interrupted by a crash resumes from them
+# (see Story._run_checkpointed). The compactions only keep the checkpoints of unfinished parts.
+#
+# format_version is the version of the story dictionary. Stories written with an older
+# version (legacy story.json -> version 0) are upgraded on read by the migrations
+# (see register_story_migration) and rewritten on their next save.
+###############################################################################################
+
+LEGACY_STORY_FILENAME = "story.json"
+STORY_LOG_FORMAT = "reveris-story-log"
+STORY_LOG_FORMAT_VERSION = 3
+LEGACY_STORY_FORMAT_VERSION = 0
+# Flush every write to the disk (a crash never loses a saved part)
+STORY_LOG_FSYNC = True
+# Minimum number of appended records before a compaction
+STORY_LOG_COMPACTION_MIN_RECORDS = 32
+
+
+###############################################################################################
+# Migrations
+###############################################################################################
+
+# format version -> function that upgrades a story dictionary to the next version
+_migrations = {}
+
+
+def register_story_migration(from_version: int):
+    """
+    Register the migration of the story dictionaries of a format version to the next one.
+
+    Args:
+        from_version (int): the upgraded version (the function returns a version from_version + 1 dictionary)
+    """
+
+    def register(function):
+        _migrations[from_version] = function
+        return function
+
+    return register
+
+
+def migrate_story_dict(story_dict: dict, format_version: int) -> dict:
+    """
+    Upgrade a story dictionary to STORY_LOG_FORMAT_VERSION.
+
+    Args:
+        story_dict (dict): the story dictionary (Story.to_dict format of its version)
+        format_version (int): the version of the dictionary
+    """
+    if format_version > STORY_LOG_FORMAT_VERSION:
+        raise ValueError(
+            f"The story format version {format_version} is newer than this version of Reveris"
+        )
+    while format_version < STORY_LOG_FORMAT_VERSION:
+        story_dict = _migrations[format_version](story_dict)
+        format_version += 1
+    return story_dict
+
+
+@register_story_migration(0)
+def _migrate_legacy_story(story_dict: dict) -> dict:
+    """
+    Legacy story.json -> story log: budget overruns and asset store references.
+    """
+    story_dict.setdefault("budget_overruns", [])
+    for part in story_dict["story_parts"]:
+        for module_dict in part:
+            if module_dict["type"] == "TextModule":
+                module_dict.setdefault("speech_asset", None)
+            elif module_dict["type"] == "ImageModule":
+                module_dict.setdefault("image_asset", None)
+    return story_dict
+
+
+@register_story_migration(1)
+def _migrate_linear_story(story_dict: dict) -> dict:
+    """
+    Linear story -> story tree: every part continues the previous one.
+    """
+    story_dict.setdefault("part_links", [])
+    return story_dict
+
+
+@register_story_migration(2)
+def _migrate_story_without_checkpoints(story_dict: dict) -> dict:
+    story_dict.setdefault("checkpoints", {})
+    return story_dict
+
+
+###############################################################################################
+# Log files
+###############################################################################################
+
+
+def _get_log_serializer(directory: str) -> StorySerializer:
+    """
+    Get the serializer of the story log of a directory (the deployment serializer first).
+
+    Returns:
+        StorySerializer: the serializer or None if the directory does not contain a story log
+    """
+    serializer = get_serializer()
+    if os.path.exists(os.path.join(directory, serializer.filename)):
+        return serializer
+    for filename, name in get_log_filenames().items():
+        if os.path.exists(os.path.join(directory, filename)):
+            return get_serializer(name)
+    return None
+
+
+def get_story_log_path(directory: str) -> str:
+    """
+    Get the path of the story log of a directory (existing log or log of the deployment serializer).
+    """
+    serializer = _get_log_serializer(directory) or get_serializer()
+    return os.path.join(directory, serializer.filename)
+
+
+def has_story_log(directory: str) -> bool:
+    return _get_log_serializer(directory) is not None
+
+
+def has_story_file(directory: str) -> bool:
+    """
+    Return whether the directory contains a story (log or legacy story.json).
+    """
+    return has_story_log(directory) or os.path.exists(
+        os.path.join(directory, LEGACY_STORY_FILENAME)
+    )
+
+
+def make_meta_record(metadata: dict, saved_time: str) -> dict:
+    return {"op": "meta", "time": saved_time, "metadata": metadata}
+
+
+def make_part_record(part_index: int, modules: List[dict], saved_time: str) -> dict:
+    return {"op": "part", "time": saved_time, "part": part_index, "modules": modules}
+
+
+def make_module_record(
+    part_index: int, module_index: int, module: dict, saved_time: str
+) -> dict:
+    return {
+        "op": "module",
+        "time": saved_time,
+        "part": part_index,
+        "module": module_index,
+        "data": module,
+    }
+
+
+def make_link_record(
+    part_index: int, parent_index: int, choice_index: int, saved_time: str
+) -> dict:
+    return {
+        "op": "link",
+        "time": saved_time,
+        "part": part_index,
+        "parent": parent_index,
+        "choice": choice_index,
+    }
+
+
+def make_checkpoint_record(key: str, data, saved_time: str) -> dict:
+    return {"op": "checkpoint", "time": saved_time, "key": key, "data": data}
+
+
+def needs_compaction(number_of_records: int, number_of_parts: int) -> bool:
+    """
+    Return whether the log should be compacted.
+    The threshold grows with the story so that the compaction cost stays constant per saved part.
+
+    Args:
+        number_of_records (int): the number of records of the log (after the header, without the link records)
+        number_of_parts (int): the number of parts of the story
+    """
+    return number_of_records >= max(
+        STORY_LOG_COMPACTION_MIN_RECORDS, 2 * number_of_parts
+    )
+
+
+def write_story_log(
+    directory: str,
+    metadata: dict,
+    parts: List[List[dict]],
+    saved_time: str,
+    part_links: list = None,
+    checkpoints: dict = None,
+) -> None:
+    """
+    Write the whole story as a compacted log with the deployment serializer
+    (atomic temporary file and rename).
+    The other story files of the directory (legacy story.json, log of another serializer)
+    are removed once the log is written.
+
+    Args:
+        directory (str): the directory of the story
+        metadata (dict): the story metadata (Story.to_dict without the parts and the saved time)
+        parts (List[List[dict]]): the serialized parts of the story
+        saved_time (str): the save time (ISO format)
+        part_links (list): the [parent, choice] link of each part (None or missing -> previous part)
+        checkpoints (dict): the checkpoints of the parts being generated (idempotency key -> result)
+    """
+    serializer = get_serializer()
+    header = {
+        "op": "header",
+        "time": saved_time,
+        "format": STORY_LOG_FORMAT,
+        "format_version": STORY_LOG_FORMAT_VERSION,
+        "metadata": metadata,
+    }
+    records = [header]
+    for i, part in enumerate(parts):
+        records.append(make_part_record(i, part, saved_time))
+        link = get_part_link(part_links, i)
+        if link is not None:
+            records.append(make_link_record(i, link[0], link[1], saved_time))
+    for key, data in (checkpoints or {}).items():
+        records.append(make_checkpoint_record(key, data, saved_time))
+    write_file_atomically(
+        os.path.join(directory, serializer.filename),
+        b"".join(serializer.encode_record(record) for record in records),
+        fsync=STORY_LOG_FSYNC,
+    )
+
+    for filename in [LEGACY_STORY_FILENAME] + list(get_log_filenames().keys()):
+        path = os.path.join(directory, filename)
+        if filename != serializer.filename and os.path.exists(path):
+            os.remove(path)
+
+
+def get_part_link(part_links: list, part_index: int) -> list:
+    """
+    Get the explicit [parent, choice] link of a part (None -> the part continues the previous one).
+    """
+    if part_links is None or part_index >= len(part_links):
+        return None
+    return part_links[part_index]
+
+
+def _set_part_link(part_links: list, record: dict) -> None:
+    part_index = record["part"]
+    while len(part_links) <= part_index:
+        part_links.append(None)
+    part_links[part_index] = [record["parent"], record["choice"]]
+
+
+def append_story_records(directory: str, records: List[dict]) -> None:
+    """
+    Append records at the end of the story log.
+
+    Args:
+        directory (str): the directory of the story
+        records (List[dict]): the records to append
+    """
+    if len(records) == 0:
+        return
+    serializer = _get_log_serializer(directory) or get_serializer()
+    append_to_file(
+        os.path.join(directory, serializer.filename),
+        b"".join(serializer.encode_record(record) for record in records),
+        fsync=STORY_LOG_FSYNC,
+    )
+
+
+###############################################################################################
+# Reading
+###############################################################################################
+
+
+def _read_header_record(serializer: StorySerializer, frame, directory: str) -> dict:
+    operation, _, _, payload = frame
+    record = serializer.decode_record(payload)
+    if operation != "header" or record["format"] != STORY_LOG_FORMAT:
+        raise ValueError(f"{directory} does not contain a story log")
+    return record
+
+
+def _apply_record(story_dict: dict, record: dict) -> None:
+    operation = record["op"]
+    parts = story_dict["story_parts"]
+    if operation == "part":
+        part_index = record["part"]
+        if part_index == len(parts):
+            parts.append(record["modules"])
+        else:
+            parts[part_index] = record["modules"]
+    elif operation == "module":
+        parts[record["part"]][record["module"]] = record["data"]
+    elif operation == "meta":
+        story_dict.update(record["metadata"])
+    elif operation == "link":
+        _set_part_link(story_dict.setdefault("part_links", []), record)
+    elif operation == "checkpoint":
+        story_dict.setdefault("checkpoints", {})[record["key"]] = record["data"]
+    else:
+        raise ValueError(f"Unknown story log record {operation}")
+    story_dict["saved_time"] = record["time"]
+
+
+def _new_log_info(serializer: StorySerializer) -> dict:
+    return {
+        "records": 0,
+        "corrupted_tail": False,
+        "format_version": STORY_LOG_FORMAT_VERSION,
+        "serializer": serializer.name,
+    }
+
+
+def read_story_log(directory: str) -> Tuple[dict, dict]:
+    """
+    Read a story log and replay its records.
+
+    Args:
+        directory (str): the directory of the story
+
+    Returns:
+        dict: the story dictionary (Story.to_dict format)
+        dict: information about the log:
+            {
+                "records": number of records of the log (after the header, without the link records),
+                "corrupted_tail": True if the last record is incomplete (ignored),
+                "format_version": format version of the log (the dictionary is migrated),
+                "serializer": name of the serializer of the log
+            }
+    """
+    serializer = _get_log_serializer(directory)
+    log_info = _new_log_info(serializer)
+    story_dict = None
+    for frame in serializer.iter_frames(
+        os.path.join(directory, serializer.filename), log_info
+    ):
+        if story_dict is None:
+            header = _read_header_record(serializer, frame, directory)
+            log_info["format_version"] = header["format_version"]
+            story_dict = dict(header["metadata"])
+            story_dict["saved_time"] = header["time"]
+            story_dict["story_parts"] = []
+            continue
+
+        _apply_record(story_dict, serializer.decode_record(frame[3]))
+        if frame[0] != "link":
+            log_info["records"] += 1
+
+    if story_dict is None:
+        raise ValueError(f"{directory} contains an empty story log")
+    story_dict = migrate_story_dict(story_dict, log_info["format_version"])
+    return story_dict, log_info
+
+
+class EncodedPart:
+    """
+    Records of a part kept encoded by read_story_log_lazily (see decode_part_records).
+    """
+
+    __slots__ = ("serializer", "records")
+
+    def __init__(self, serializer: StorySerializer):
+        self.serializer = serializer
+        self.records = []
+
+
+def read_story_log_lazily(directory: str) -> Tuple[dict, dict]:
+    """
+    Read a story log without decoding its parts.
+    Only the header, the metadata, the link and the checkpoint records are decoded: the records of each part are
+    kept encoded (see decode_part_records). The logs of an older format version are read
+    with read_story_log (migrated).
+
+    Args:
+        directory (str): the directory of the story
+
+    Returns:
+        dict: the story dictionary (Story.to_dict format) where each part is an EncodedPart
+            (or a list of serialized modules for an older format version)
+        dict: information about the log (see read_story_log)
+    """
+    serializer = _get_log_serializer(directory)
+    log_info = _new_log_info(serializer)
+    story_dict = None
+    encoded_parts = []
+    part_links = []
+    checkpoints = {}
+    for frame in serializer.iter_frames(
+        os.path.join(directory, serializer.filename), log_info
+    ):
+        operation, time, part_index, payload = frame
+        if story_dict is None:
+            header = _read_header_record(serializer, frame, directory)
+            if header["format_version"] != STORY_LOG_FORMAT_VERSION:
+                return read_story_log(directory)
+            story_dict = dict(header["metadata"])
+        elif operation == "meta":
+            story_dict.update(serializer.decode_record(payload)["metadata"])
+            log_info["records"] += 1
+        elif operation == "link":
+            _set_part_link(part_links, serializer.decode_record(payload))
+        elif operation == "checkpoint":
+            record = serializer.decode_record(payload)
+            checkpoints[record["key"]] = record["data"]
+            log_info["records"] += 1
+        elif operation == "part" or operation == "module":
+            if operation == "part":
+                if part_index == len(encoded_parts):
+                    encoded_parts.append(None)
+                encoded_parts[part_index] = EncodedPart(serializer)
+            encoded_parts[part_index].records.append(payload)
+            log_info["records"] += 1
+        else:
+            raise ValueError(f"Unknown story log record {operation}")
+        story_dict["saved_time"] = time
+
+    if story_dict is None:
+        raise ValueError(f"{directory} contains an empty story log")
+    story_dict["story_parts"] = encoded_parts
+    story_dict["part_links"] = part_links
+    story_dict["checkpoints"] = checkpoints
+    return story_dict, log_info
+
+
+def decode_part_records(encoded_part: EncodedPart) -> List[dict]:
+    """
+    Decode a part kept encoded by read_story_log_lazily.
+
+    Args:
+        encoded_part (EncodedPart): the records of the part (a part record followed by its module records)
+
+    Returns:
+        List[dict]: the serialized modules of the part
+    """
+    if not isinstance(encoded_part, EncodedPart):
+        # Part of a migrated story (already decoded)
+        return encoded_part
+
+    modules = None
+    for payload in encoded_part.records:
+        record = encoded_part.serializer.decode_record(payload)
+        if record["op"] == "part":
+            modules = record["modules"]
+        else:
+            modules[record["module"]] = record["data"]
+    return modules
+
+
+def read_story_dict(directory: str) -> Tuple[dict, dict]:
+    """
+    Read a story from a directory (story log or legacy story.json).
+
+    Args:
+        directory (str): the directory of the story
+
+    Returns:
+        dict: the story dictionary (Story.to_dict format) or None if the story does not exist
+        dict: information about the log (see read_story_log) or None for a legacy story
+    """
+    if has_story_log(directory):
+        return read_story_log(directory)
+
+    legacy_filename = os.path.join(directory, LEGACY_STORY_FILENAME)
+    if os.path.exists(legacy_filename):
+        with open(legacy_filename, "r") as file:
+            story_dict = json.load(file)
+        return migrate_story_dict(story_dict, LEGACY_STORY_FORMAT_VERSION), None
+
+    return None, None
+
+
+def read_story_header(directory: str) -> dict:
+    """
+    Read the metadata of a story without decoding its parts.
+
+    Args:
+        directory (str): the directory of the story
+
+    Returns:
+        dict: the story dictionary without the parts, links and checkpoints or None if the story does not exist
+    """
+    if not has_story_log(directory):
+        story_dict, _ = read_story_dict(directory)
+        if story_dict is not None:
+            story_dict.pop("story_parts", None)
+            story_dict.pop("part_links", None)
+            story_dict.pop("checkpoints", None)
+        return story_dict
+
+    story_dict, _ = read_story_log_lazily(directory)
+    story_dict.pop("story_parts", None)
+    story_dict.pop("part_links", None)
+    story_dict.pop("checkpoints", None)
+    return story_dict
@@ -0,0 +1,293 @@
+import os
+import re
+import sqlite3
+import sys
+import time
+
+from datetime import datetime
+from typing import Dict, List
+from storage.sqlite_utils import get_thread_connection
+from storage.story_log import read_story_dict
+from storage.bundle_format import BUNDLE_EXTENSION, StoryBundle
+
+###############################################################################################
+# Story search
+#
+# Full-text index (SQLite FTS5 inverted index) of the titles, overviews and part texts
+# (original and translated) of the stories. Story.save_to_file indexes the saved parts
+# incrementally: one document per part and one for the title and overview.
+# Rebuild it from the story folders with:
+#   python -m storage.story_search rebuild
+###############################################################################################
+
+SEARCH_INDEX_PATH = "out/search.sqlite"
+STORY_DIRECTORIES = ["demo_story", "out/stories", "out/bundles"]
+# Maximum number of results of a search
+SEARCH_RESULTS_LIMIT = 10
+# Weights of the title, overview and text columns in the ranking (bm25)
+SEARCH_COLUMN_WEIGHTS = (10.0, 4.0, 1.0)
+
+# part = -1 -> document of the title and the overview
+_SEARCH_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS story_documents USING fts5(
+    path UNINDEXED,
+    part UNINDEXED,
+    title,
+    overview,
+    text,
+    tokenize = "unicode61 remove_diacritics 2",
+    prefix = "2 3"
+);
+CREATE TABLE IF NOT EXISTS search_stories (
+    path TEXT PRIMARY KEY,
+    title TEXT,
+    lang TEXT
+);
+CREATE TABLE IF NOT EXISTS search_info (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+# Keys of the serialized modules that contain displayed texts
+_TEXT_KEYS = ["text", "displayed_text", "choice_text", "displayed_choice_text"]
+_word_pattern = re.compile(r"\w+", re.UNICODE)
+
+
+def _get_connection() -> sqlite3.Connection:
+    return get_thread_connection(SEARCH_INDEX_PATH, _SEARCH_SCHEMA)
+
+
+def _normalize_path(path: str) -> str:
+    return os.path.normpath(path)
+
+
+def _collect_texts(obj, texts: List[str]) -> None:
+    if isinstance(obj, dict):
+        for key, value in obj.items():
+            if key in _TEXT_KEYS and isinstance(value, str):
+                texts.append(value)
+            else:
+                _collect_texts(value, texts)
+    elif isinstance(obj, list):
+        for value in obj:
+            _collect_texts(value, texts)
+
+
+def _get_text(obj) -> str:
+    texts = []
+    _collect_texts(obj, texts)
+    # The translated text is often the same as the original one
+    return "\n".join(dict.fromkeys(texts))
+
+
+def search_index_story(
+    path: str, metadata: dict, parts: Dict[int, List[dict]], replace: bool = False
+) -> None:
+    """
+    Index a story (or only some of its parts).
+
+    Args:
+        path (str): the directory (or bundle) of the story
+        metadata (dict): the story metadata (Story.to_dict without the parts)
+        parts (Dict[int, List[dict]]): part index -> serialized part, for the new or modified parts
+        replace (bool): True to remove the other parts from the index (Ex: the whole story is given)
+    """
+    path = _normalize_path(path)
+    title = _get_text(metadata["title"])
+    lang = metadata["target_lang"] or "en"
+
+    connection = _get_connection()
+    with connection:
+        if replace:
+            connection.execute("DELETE FROM story_documents WHERE path = ?", (path,))
+        else:
+            connection.executemany(
+                "DELETE FROM story_documents WHERE path = ? AND part = ?",
+                [(path, part_index) for part_index in [-1] + list(parts.keys())],
+            )
+
+        documents = [(path, -1, title, metadata["overview"] or "", "")]
+        documents += [
+            (path, part_index, "", "", _get_text(part))
+            for part_index, part in parts.items()
+        ]
+        connection.executemany(
+            "INSERT INTO story_documents (path, part, title, overview, text) VALUES (?, ?, ?, ?, ?)",
+            documents,
+        )
+        connection.execute(
+            "INSERT OR REPLACE INTO search_stories (path, title, lang) VALUES (?, ?, ?)",
+            (path, title.split("\n")[-1], lang),
+        )
+
+
+def search_remove_story(path: str) -> None:
+    """
+    Remove a story from the index (Ex: its folder has been deleted).
+    """
+    path = _normalize_path(path)
+    connection = _get_connection()
+    with connection:
+        connection.execute("DELETE FROM story_documents WHERE path = ?", (path,))
+        connection.execute("DELETE FROM search_stories WHERE path = ?", (path,))
+
+
+def _to_match_query(query: str) -> str:
+    """
+    Convert a user query to a FTS5 query: all the words, the last one as a prefix
+    (Example: "dragon mag" -> '"dragon" "mag"*').
+    """
+    words = _word_pattern.findall(query)
+    if len(words) == 0:
+        return None
+    terms = ['"{}"'.format(word) for word in words]
+    terms[-1] += "*"
+    return " ".join(terms)
+
+
+def search_stories(query: str, limit: int = SEARCH_RESULTS_LIMIT) -> List[dict]:
+    """
+    Search the stories, best match first.
+
+    Args:
+        query (str): the searched words (the last word can be incomplete)
+        limit (int): the maximum number of results
+
+    Returns:
+        List[dict]: the stories in the following format:
+        [
+            {
+                "title": "Title of the story",
+                "lang": "en",
+                "path": "out/stories/story_id",
+                "score": ranking score (lower is better)
+            },
+            ...
+        ]
+    """
+    match_query = _to_match_query(query)
+    if match_query is None:
+        return []
+
+    title_weight, overview_weight, text_weight = SEARCH_COLUMN_WEIGHTS
+    connection = _get_connection()
+    # A story is ranked by its best document: get the best documents until
+    # enough stories are found (top-N sort of the matching documents)
+    number_of_documents = 4 * limit
+    while True:
+        rows = connection.execute(
+            """
+            SELECT path, bm25(story_documents, 0, 0, ?, ?, ?) AS score
+            FROM story_documents WHERE story_documents MATCH ? ORDER BY score LIMIT ?
+            """,
+            (
+                title_weight,
+                overview_weight,
+                text_weight,
+                match_query,
+                number_of_documents,
+            ),
+        ).fetchall()
+        scores = {}
+        for row in rows:
+            if row["path"] not in scores:
+                scores[row["path"]] = row["score"]
+        if len(scores) >= limit or len(rows) < number_of_documents:
+            break
+        number_of_documents *= 4
+
+    scores = dict(list(scores.items())[:limit])
+    results = []
+    for path, score in scores.items():
+        story = connection.execute(
+            "SELECT title, lang FROM search_stories WHERE path = ?", (path,)
+        ).fetchone()
+        if story is not None:
+            results.append(
+                {
+                    "title": story["title"],
+                    "lang": story["lang"],
+                    "path": path,
+                    "score": score,
+                }
+            )
+    return results
+
+
+def is_search_index_built() -> bool:
+    row = (
+        _get_connection()
+        .execute("SELECT value FROM search_info WHERE key = 'built'")
+        .fetchone()
+    )
+    return row is not None
+
+
+def rebuild_search_index(directories: List[str] = None) -> int:
+    """
+    Rebuild the index from the story folders and bundles.
+
+    Args:
+        directories (List[str]): the directories that contain the stories (None -> STORY_DIRECTORIES)
+
+    Returns:
+        int: the number of indexed stories
+    """
+    if directories is None:
+        directories = STORY_DIRECTORIES
+
+    connection = _get_connection()
+    with connection:
+        connection.execute("DELETE FROM story_documents")
+        connection.execute("DELETE FROM search_stories")
+
+    number_of_stories = 0
+    for directory_path in directories:
+        if not os.path.exists(directory_path):
+            continue
+        for name in os.listdir(directory_path):
+            path = os.path.join(directory_path, name)
+            try:
+                if name.endswith(BUNDLE_EXTENSION):
+                    with StoryBundle(path) as bundle:
+                        story_dict = bundle.get_story_dict()
+                elif os.path.isdir(path):
+                    story_dict, _ = read_story_dict(path)
+                else:
+                    continue
+            except Exception as e:
+                print("Failed to read the story {}: {}".format(path, e))
+                continue
+            if story_dict is None:
+                continue
+
+            parts = dict(enumerate(story_dict.pop("story_parts")))
+            search_index_story(path, story_dict, parts, replace=True)
+            number_of_stories += 1
+
+    with connection:
+        connection.execute(
+            "INSERT OR REPLACE INTO search_info (key, value) VALUES ('built', ?)",
+            (datetime.now().isoformat(),),
+        )
+    return number_of_stories
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 2 and sys.argv[1] == "rebuild":
+        number_of_stories = rebuild_search_index()
+        print("{} stories indexed in {}".format(number_of_stories, SEARCH_INDEX_PATH))
+    elif len(sys.argv) >= 3 and sys.argv[1] == "query":
+        start_time = time.perf_counter()
+        results = search_stories(" ".join(sys.argv[2:]))
+        duration = time.perf_counter() - start_time
+        for result in results:
+            print("{:8.3f}  {}  ({})".format(result["score"], result["title"], result["path"]))
+        print("{} results in {:.2f} ms".format(len(results), 1000 * duration))
+    else:
+        print(
+            "Usage: python -m storage.story_search rebuild\n"
+            "       python -m storage.story_search query <words>"
+        )
+        sys.exit(1)
@@ -0,0 +1,240 @@
+import json
+import os
+import re
+import struct
+
+from typing import Iterator, Tuple
+
+try:
+    import msgpack
+except ImportError:  # Only needed by the binary serializers
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:  # Only needed by the compressed serializer
+    zstandard = None
+
+###############################################################################################
+# Story serializers
+#
+# Encoding of the records of the story log (see storage/story_log.py), chosen per deployment
+# with STORY_SERIALIZER (environment variable REVERIS_STORY_SERIALIZER):
+#   "json"         -> story.jsonl: one compact JSON record per line (default, readable)
+#   "msgpack"      -> story.rvs: length-prefixed msgpack records (pip install msgpack)
+#   "msgpack+zstd" -> story.rvs: msgpack records compressed with zstd (pip install msgpack zstandard)
+# Each record is framed with its operation, time and part index: the log can be scanned
+# without decoding the records. A story saved with another serializer is still read and
+# rewritten with the deployment serializer on its next save.
+###############################################################################################
+
+STORY_SERIALIZER = os.environ.get("REVERIS_STORY_SERIALIZER", "json")
+STORY_ZSTD_LEVEL = 3
+
+# A frame: (operation, time, part index or None, encoded record)
+Frame = Tuple[str, str, int, bytes]
+
+
+class StorySerializer:
+    """
+    Encoding of the story log records.
+
+    Parameters:
+        name (str): the name of the serializer (Example: "json")
+        filename (str): the name of the story log file
+    """
+
+    name = None
+    filename = None
+
+    def encode_record(self, record: dict) -> bytes:
+        raise NotImplementedError
+
+    def decode_record(self, payload: bytes) -> dict:
+        raise NotImplementedError
+
+    def iter_frames(self, path: str, log_info: dict) -> Iterator[Frame]:
+        """
+        Iterate over the records of a log file without decoding them.
+        An incomplete last record (crash during an append) is skipped and
+        log_info["corrupted_tail"] is set to True.
+
+        Args:
+            path (str): the log file
+            log_info (dict): information about the log (updated)
+
+        Yields:
+            Frame: (operation, time, part index or None, encoded record)
+        """
+        raise NotImplementedError
+
+
+class JsonLinesSerializer(StorySerializer):
+    name = "json"
+    filename = "story.jsonl"
+
+    # The records start with their operation, time and part (see story_log.make_*_record)
+    _prefix_pattern = re.compile(
+        rb'^\{"op":"(\w+)","time":"([^"]*)"(?:,"part":(\d+))?'
+    )
+
+    def encode_record(self, record: dict) -> bytes:
+        return (
+            json.dumps(record, separators=(",", ":"), ensure_ascii=False).encode(
+                "utf-8"
+            )
+            + b"\n"
+        )
+
+    def decode_record(self, payload: bytes) -> dict:
+        return json.loads(payload)
+
+    def iter_frames(self, path: str, log_info: dict) -> Iterator[Frame]:
+        with open(path, "rb") as file:
+            lines = iter(file)
+            line = next(lines, None)
+            while line is not None:
+                next_line = next(lines, None)
+                match = self._prefix_pattern.match(line)
+                if next_line is None and (match is None or not line.endswith(b"\n")):
+                    # A crash may have happened during the last append. A complete record
+                    # without its line end is kept, but the next append would be glued to
+                    # it: the tail is reported and the next save rewrites the log
+                    log_info["corrupted_tail"] = True
+                    try:
+                        json.loads(line)
+                    except json.JSONDecodeError:
+                        return
+                if match is None:
+                    raise ValueError(f"Corrupted record in the story log {path}")
+
+                part_index = match.group(3)
+                yield (
+                    match.group(1).decode("utf-8"),
+                    match.group(2).decode("utf-8"),
+                    None if part_index is None else int(part_index),
+                    line,
+                )
+                line = next_line
+
+
+class MsgpackSerializer(StorySerializer):
+    """
+    Frame: operation (uint8) | flags (uint8) | part (int32, -1 -> none) |
+           time length (uint16) | record length (uint32) | time (utf-8) | record
+    """
+
+    name = "msgpack"
+    filename = "story.rvs"
+
+    _operations = ["header", "part", "module", "meta", "link", "checkpoint"]
+    _frame_struct = struct.Struct("<BBiHI")
+    _FLAG_ZSTD = 1
+
+    def __init__(self, compress: bool = False):
+        if msgpack is None:
+            raise RuntimeError("The msgpack story serializer needs: pip install msgpack")
+        if compress and zstandard is None:
+            raise RuntimeError(
+                "The msgpack+zstd story serializer needs: pip install zstandard"
+            )
+        self.compress = compress
+        if compress:
+            self.name = "msgpack+zstd"
+            self._compressor = zstandard.ZstdCompressor(level=STORY_ZSTD_LEVEL)
+
+    def encode_record(self, record: dict) -> bytes:
+        payload = msgpack.packb(record, use_bin_type=True)
+        flags = 0
+        if self.compress:
+            payload = self._compressor.compress(payload)
+            flags |= self._FLAG_ZSTD
+
+        time = record["time"].encode("utf-8")
+        part_index = record.get("part")
+        return (
+            self._frame_struct.pack(
+                self._operations.index(record["op"]),
+                flags,
+                -1 if part_index is None else part_index,
+                len(time),
+                len(payload),
+            )
+            + time
+            + payload
+        )
+
+    def decode_record(self, payload: bytes) -> dict:
+        flags, payload = payload[0], payload[1:]
+        if flags & self._FLAG_ZSTD:
+            if zstandard is None:
+                raise RuntimeError("Reading this story needs: pip install zstandard")
+            payload = zstandard.ZstdDecompressor().decompress(payload)
+        return msgpack.unpackb(payload, raw=False)
+
+    def iter_frames(self, path: str, log_info: dict) -> Iterator[Frame]:
+        with open(path, "rb") as file:
+            data = file.read()
+
+        offset = 0
+        header_size = self._frame_struct.size
+        while offset < len(data):
+            if offset + header_size > len(data):
+                log_info["corrupted_tail"] = True
+                return
+            operation, flags, part_index, time_length, length = (
+                self._frame_struct.unpack_from(data, offset)
+            )
+            start = offset + header_size
+            end = start + time_length + length
+            if end > len(data):
+                log_info["corrupted_tail"] = True
+                return
+
+            time = data[start : start + time_length].decode("utf-8")
+            # The flags are kept with the record (decode_record)
+            payload = bytes([flags]) + data[start + time_length : end]
+            yield (
+                self._operations[operation],
+                time,
+                None if part_index < 0 else part_index,
+                payload,
+            )
+            offset = end
+
+
+_serializers = {}
+
+
+def get_serializer(name: str = None) -> StorySerializer:
+    """
+    Get a story serializer.
+
+    Args:
+        name (str): "json", "msgpack" or "msgpack+zstd" (None -> STORY_SERIALIZER)
+    """
+    if name is None:
+        name = STORY_SERIALIZER
+    serializer = _serializers.get(name)
+    if serializer is None:
+        if name == "json":
+            serializer = JsonLinesSerializer()
+        elif name == "msgpack":
+            serializer = MsgpackSerializer()
+        elif name == "msgpack+zstd":
+            serializer = MsgpackSerializer(compress=True)
+        else:
+            raise ValueError(f"Unknown story serializer {name}")
+        _serializers[name] = serializer
+    return serializer
+
+
+def get_log_filenames() -> dict:
+    """
+    Get the story log file name of each encoding: file name -> serializer name.
+    (The compressed and uncompressed msgpack logs share their file name: the flags are per record)
+    """
+    return {
+        JsonLinesSerializer.filename: "json",
+        MsgpackSerializer.filename: "msgpack",
+    }
@@ -1,7 +1,7 @@
 import random
 import string
 import os
-import json
+import time
 
 from typing import Tuple, List
 from story.story_modules import (
@@ -12,18 +12,63 @@ from story.story_modules import (
     TextModule,
     canBeSpeechSynthesized,
 )
-from agents.agent_utils import query_in_parallel
-from story.story_part import StoryPart
+from agents.agent_utils import query_in_background
+from story.story_part import StoryPart, LazyStoryParts, StoryPath
 from datetime import datetime
-from openaiAPI import API_BATCH_DELAY, API_MAX_BATCH_SPEECHES
+from threading import RLock, Thread
+from metrics import metrics_add, metrics_observe
+from storage.story_log import (
+    write_story_log,
+    append_story_records,
+    make_meta_record,
+    make_part_record,
+    make_module_record,
+    make_link_record,
+    make_checkpoint_record,
+    get_part_link,
+    needs_compaction,
+    STORY_LOG_FORMAT_VERSION,
+)
+from storage.story_serializer import get_serializer
+from storage.persistence_queue import queue_save, flush_saves
+from storage.story_catalog import catalog_update_story
+from storage.story_search import search_index_story
+from storage.speech_streams import SPEECH_STREAMING
+from storage.asset_store import (
+    collect_asset_ids,
+    add_asset_references,
+    set_asset_references,
+    import_assets,
+)
+from openaiAPI import (
+    API_BATCH_DELAY,
+    API_MAX_BATCH_SPEECHES,
+    PRIORITY_INTERACTIVE,
+    PRIORITY_BACKGROUND,
+    provider_context,
+    get_provider_context,
+    CancellationToken,
+    GenerationCancelledError,
+)
 
 ERRORCODE_NO_ERROR = 0
 ERRORCODE_WAITING_FOR_USER_INPUT = 1
 ERRORCODE_STORY_COMPLETE = 2
 ERRORCODE_TEXT_GENERATION_ERROR = 3
 ERRORCODE_IMAGE_GENERATION_ERROR = 4
+ERRORCODE_GENERATION_CANCELLED = 5
 
 WORKING_FOLDER = "out/stories/"
+# Maximum time (seconds) a reader waits for the images and speeches of a part, per deployment
+# (environment variable REVERIS_PART_LATENCY_BUDGET, unset -> wait for all of them).
+# The late assets are added to the part in the background.
+PART_LATENCY_BUDGET = (
+    float(os.environ["REVERIS_PART_LATENCY_BUDGET"])
+    if os.environ.get("REVERIS_PART_LATENCY_BUDGET")
+    else None
+)
+# Write the saves in the background (see storage/persistence_queue.py)
+SAVE_WRITE_BEHIND = True
 
 
 class Story:
@@ -36,6 +81,8 @@ class Story:
         target_lang=None,
         story_length=3,
         id=None,
+        part_latency_budget=PART_LATENCY_BUDGET,
+        reuse_similar_images=True,
     ):
         """
         Story class.
@@ -48,13 +95,47 @@ class Story:
             target_lang (str): the language of the story (None -> english, Example: "FR")
             story_length (int): the number of parts of the story
             id (str): the id of the story
+            part_latency_budget (float): the maximum time (seconds) to wait for the images and speeches of a part (None -> no limit)
+            reuse_similar_images (bool): True to reuse the images of near-identical prompts (see storage/image_prompt_index.py)
         """
         self._overview = overview
         self._story_max_length = story_length
         self._need_illustration = need_illustration
         self._generate_speeches = generate_speeches
-        self._story_parts = []
+        self._reuse_similar_images = reuse_similar_images
+        # Image of the story in the history (thumbnail variant of its first image)
+        self._thumbnail_asset = None
+        self._story_parts = LazyStoryParts()
+        # Story tree: [parent, choice] link of each stored part (None -> continues the previous part)
+        self._part_links = []
+        # Last part of the current branch (None -> the last stored part)
+        self._active_part = None
+        self._path_cache = (None, [])
         self._story_part_index = 0
+        self._generation_cancel_token = None
+        self._part_latency_budget = part_latency_budget
+        self._pending_asset_jobs = []
+        self._budget_overruns = []
+        self._backfill_threads = []
+        # Cancellation tokens of the asset jobs that outlive their part (see _backfill_late_assets)
+        self._backfill_cancel_tokens = []
+        # Held by the saves and the changes of the parts, links and checkpoints: the backfill
+        # threads save while the script thread changes the story (reentrant: the changes call
+        # the helpers that take it)
+        self._save_lock = RLock()
+
+        # Persistence state (see save_to_file)
+        self._persisted_parts = 0
+        self._persisted_metadata = None
+        self._log_records = 0
+        self._dirty_parts = set()
+        self._dirty_modules = set()
+        self._dirty_links = set()
+        # Results of the units of the parts being generated (see _run_checkpointed)
+        self._checkpoints = {}
+        self._pending_part_key = None
+        # Bundle the story was opened from: its assets are copied to the store by the first save
+        self._source_bundle = None
 
         if target_lang is not None and target_lang.lower() == "en":
             target_lang = None
@@ -104,21 +185,86 @@ class Story:
         """
         self._need_illustration = need_illustration
 
-    def input_user_answer(self, user_choice: ChoiceModule):
+    def cancel_generation(self):
+        """
+        Cancel the running generation (if any).
+        Its queued provider calls are dropped and the in-flight ones are aborted when possible.
+        The assets of the delivered parts keep being generated (see cancel_background_assets).
+        """
+        cancel_token = self._generation_cancel_token
+        if cancel_token is not None:
+            print("Cancelling the generation...")
+            cancel_token.cancel()
+
+    def cancel_background_assets(self):
+        """
+        Cancel the assets of the delivered parts still being generated in the background
+        (late images, streamed speeches), Ex: the reader quits or moves to another branch.
+        """
+        cancel_tokens = [job["cancel_token"] for job in self._pending_asset_jobs]
+        cancel_tokens += self._backfill_cancel_tokens
+        cancel_tokens = [
+            cancel_token
+            for cancel_token in cancel_tokens
+            if not cancel_token.is_cancelled()
+        ]
+        if len(cancel_tokens) > 0:
+            print("Cancelling the background assets...")
+        for cancel_token in cancel_tokens:
+            cancel_token.cancel()
+
+    def input_user_answer(self, user_choice: ChoiceModule, part_position: int = None):
         """
         Input the user choice in the story.
+        The choice of a previous part can also be changed: the story continues on the branch of
+        the new choice. The other branches are kept and the parts already generated for a choice
+        are served again without generating them (see generate_next_parts).
+
+        Args:
+            user_choice (ChoiceModule): the choice of the user
+            part_position (int): the position of the part in the current branch (None -> the last part)
         """
-        if self.is_waiting_for_user_input():
-            possible_choices = self._story_parts[-1][-1]
+        story_path = self._get_path()
+        if part_position is None:
+            if not self.is_waiting_for_user_input():
+                return
+            part_position = len(story_path) - 1
+        if part_position < len(story_path) - 1:
+            # The reader leaves the branch: its late assets are not needed anymore
+            self.cancel_background_assets()
+        part_index = story_path[part_position]
+        part = self._story_parts[part_index]
+        possible_choices = part[-1]
+        if not isinstance(possible_choices, PossibleChoicesModule):
+            return
+
+        with self._save_lock:
+            # The next part of a linear story keeps the branch of the previous choice
+            child_index = part_index + 1
+            if (
+                child_index < len(self._story_parts)
+                and get_part_link(self._part_links, child_index) is None
+            ):
+                self._set_part_link(
+                    child_index, part_index, self._get_choice_index(child_index)
+                )
+
             possible_choices.set_user_choice(user_choice)
+            self._mark_module_dirty(part_index, len(part) - 1)
+
+            self._set_active_part(part_index)
+            self._follow_explored_branch()
+        # The parts after the choice are handed to the reader again
+        self._story_part_index = min(self._story_part_index, part_position + 1)
 
     def is_waiting_for_user_input(self) -> bool:
         """
         Return whether the story is waiting for user input.
         """
-        if len(self._story_parts) == 0:
+        story_path = self._get_path()
+        if len(story_path) == 0:
             return False
-        last_module = self._story_parts[-1][-1]
+        last_module = self._story_parts[story_path[-1]][-1]
         if isinstance(last_module, PossibleChoicesModule):
             return not last_module.has_selected_choice()
         return False
@@ -139,16 +285,104 @@ class Story:
         Returns:
             str: the generated story
         """
-        return "\n".join([part.to_prompt_string() for part in self._story_parts])
+        return "\n".join([part.to_prompt_string() for part in self.get_story_parts()])
 
-    def get_story_parts(self) -> List[StoryPart]:
+    def get_story_parts(self) -> StoryPath:
         """
-        Get the formatted story.
+        Get the formatted story (the parts of the current branch).
 
         Returns:
             list of modules that compose the story
         """
-        return self._story_parts
+        return StoryPath(self._story_parts, self._get_path())
+
+    def _get_path(self) -> List[int]:
+        """
+        Get the indexes of the stored parts of the current branch (first part first).
+        """
+        leaf_index = self._active_part
+        if leaf_index is None:
+            leaf_index = len(self._story_parts) - 1
+        key = (leaf_index, len(self._story_parts))
+        if self._path_cache[0] != key:
+            story_path = []
+            part_index = leaf_index
+            while part_index is not None and part_index >= 0:
+                story_path.append(part_index)
+                part_index = self._get_parent_index(part_index)
+            story_path.reverse()
+            self._path_cache = (key, story_path)
+        return self._path_cache[1]
+
+    def _set_active_part(self, part_index: int):
+        """
+        Set the last part of the current branch.
+        """
+        if part_index == len(self._story_parts) - 1:
+            part_index = None
+        self._active_part = part_index
+
+    def _get_parent_index(self, part_index: int) -> int:
+        link = get_part_link(self._part_links, part_index)
+        if link is None:
+            return part_index - 1 if part_index > 0 else None
+        return link[0]
+
+    def _get_choice_index(self, part_index: int) -> int:
+        """
+        Get the index of the choice of its parent that a part continues (None -> no choice).
+        """
+        link = get_part_link(self._part_links, part_index)
+        if link is None:
+            # Linear story: the part continues the selected choice of the previous part
+            parent_index = self._get_parent_index(part_index)
+            if parent_index is None:
+                return None
+            return self._get_selected_choice_index(parent_index)
+        return link[1]
+
+    def _get_selected_choice_index(self, part_index: int) -> int:
+        last_module = self._story_parts[part_index][-1]
+        if isinstance(last_module, PossibleChoicesModule):
+            return last_module.get_selected_choice_index()
+        return None
+
+    def _set_part_link(self, part_index: int, parent_index: int, choice_index: int):
+        with self._save_lock:
+            while len(self._part_links) <= part_index:
+                self._part_links.append(None)
+            self._part_links[part_index] = [parent_index, choice_index]
+            self._dirty_links.add(part_index)
+
+    def _find_child(self, parent_index: int, choice_index: int) -> int:
+        """
+        Find the stored part that continues a choice of a part.
+
+        Returns:
+            int: the index of the part or None if the choice has not been explored
+        """
+        for part_index in range(len(self._story_parts) - 1, parent_index, -1):
+            if (
+                self._get_parent_index(part_index) == parent_index
+                and self._get_choice_index(part_index) == choice_index
+            ):
+                return part_index
+        return None
+
+    def _follow_explored_branch(self):
+        """
+        Extend the current branch with the stored parts of the selected choices.
+        """
+        part_index = self._get_path()[-1]
+        while True:
+            choice_index = self._get_selected_choice_index(part_index)
+            if choice_index is None:
+                break
+            child_index = self._find_child(part_index, choice_index)
+            if child_index is None:
+                break
+            part_index = child_index
+        self._set_active_part(part_index)
 
     def _get_story_part_index(self) -> int:
         """
@@ -159,6 +393,268 @@ class Story:
         """
         return self._story_part_index
 
+    def _start_asset_job(
+        self,
+        name: str,
+        function: callable,
+        args_list: List[List],
+        max_parallel_queries: int,
+        on_result: callable = None,
+        wait: bool = True,
+    ):
+        """
+        Start generating assets (images, speeches) of the part being generated in the background.
+        The part waits for them within its latency budget.
+
+        Args:
+            name (str): the name of the job (Example: "images")
+            function (callable): the function to query
+            args_list (List[List[]]): the list of list of arguments to pass to the function
+            max_parallel_queries (int): the maximum number of parallel queries
+            on_result (callable(int, object)): called with the index and the result of each call as soon as it finishes
+            wait (bool): False to deliver the part without waiting for the job (Ex: streamed speeches)
+        """
+        context = get_provider_context().copy()
+        # Token of the job: cancelled with the generation until the part is delivered,
+        # then with the background assets (see _backfill_late_assets)
+        cancel_token = CancellationToken()
+        generation_cancel_token = context.cancel_token
+        if generation_cancel_token is not None:
+            generation_cancel_token.add_callback(cancel_token.cancel)
+        context.cancel_token = cancel_token
+        thread = query_in_background(
+            function=function,
+            args_list=args_list,
+            max_parallel_queries=max_parallel_queries,
+            time_between_queries=API_BATCH_DELAY,
+            on_result=on_result,
+            context=context,
+        )
+        self._pending_asset_jobs.append(
+            {
+                "name": name,
+                "thread": thread,
+                "context": context,
+                "wait": wait,
+                "cancel_token": cancel_token,
+                "generation_cancel_token": generation_cancel_token,
+            }
+        )
+
+    def _wait_for_asset_jobs(self, part_start_time: float) -> List[dict]:
+        """
+        Wait for the asset jobs of the part within the latency budget.
+
+        Args:
+            part_start_time (float): the time when the generation of the part started
+
+        Returns:
+            List[dict]: the jobs that are still running after the budget (and the jobs not waited for)
+        """
+        jobs = self._pending_asset_jobs
+        self._pending_asset_jobs = []
+
+        budget = self._part_latency_budget
+        for job in jobs:
+            if not job["wait"]:
+                continue
+            if budget is None:
+                job["thread"].join()
+            else:
+                remaining = part_start_time + budget - time.time()
+                job["thread"].join(max(0, remaining))
+
+        return [job for job in jobs if job["thread"].is_alive()]
+
+    def _backfill_late_assets(
+        self, late_jobs: List[dict], part_index: int, part_start_time: float
+    ):
+        """
+        Record the budget overrun and let the late assets finish in the background.
+        The modules are patched as the assets arrive and the story is saved when all are done.
+
+        Args:
+            late_jobs (List[dict]): the jobs still running after the budget (or not waited for)
+            part_index (int): the index of the delivered part
+            part_start_time (float): the time when the generation of the part started
+        """
+        elapsed = time.time() - part_start_time
+        overrun = None
+        overrun_jobs = [job for job in late_jobs if job["wait"]]
+        if len(overrun_jobs) > 0:
+            overrun = {
+                "part_index": part_index,
+                "budget": self._part_latency_budget,
+                "late_jobs": [job["name"] for job in overrun_jobs],
+                "backfill_time": None,
+            }
+            self._budget_overruns.append(overrun)
+            metrics_add("part_budget_overruns")
+            print(
+                "Part {} delivered after {:.1f}s without its {} (budget: {}s)".format(
+                    part_index,
+                    elapsed,
+                    ", ".join(overrun["late_jobs"]),
+                    overrun["budget"],
+                )
+            )
+
+        for job in overrun_jobs:
+            # Nobody is waiting for the late assets anymore
+            # (the streamed speeches keep their priority: they are being played)
+            job["context"].priority = PRIORITY_BACKGROUND
+
+        # The late assets outlive the generation: only cancel_background_assets cancels them
+        # (Ex: the reader quits, not when the reader picks the next choice)
+        cancel_tokens = []
+        for job in late_jobs:
+            if job["generation_cancel_token"] is not None:
+                job["generation_cancel_token"].remove_callback(job["cancel_token"].cancel)
+            cancel_tokens.append(job["cancel_token"])
+        self._backfill_cancel_tokens += cancel_tokens
+
+        def backfill():
+            for job in late_jobs:
+                job["thread"].join()
+            for cancel_token in cancel_tokens:
+                self._backfill_cancel_tokens.remove(cancel_token)
+            # The assets received before a cancellation are already in the modules: saved too
+            self._mark_part_dirty(part_index)
+            if any(cancel_token.is_cancelled() for cancel_token in cancel_tokens):
+                print("Late assets of part {} cancelled".format(part_index))
+            else:
+                backfill_time = time.time() - part_start_time
+                if overrun is not None:
+                    overrun["backfill_time"] = backfill_time
+                    metrics_observe("part_backfill_seconds", backfill_time)
+                print(
+                    "Late assets of part {} backfilled after {:.1f}s".format(
+                        part_index, backfill_time
+                    )
+                )
+            self.save_to_file()
+
+        backfill_thread = Thread(target=backfill, daemon=True)
+        backfill_thread.start()
+        self._backfill_threads.append(backfill_thread)
+
+    def _get_part_key(self, parent_index: int, choice_index: int) -> str:
+        """
+        Get the idempotency key of the generation of a part: its parent part and choice.
+        """
+        if parent_index is None:
+            return "root"
+        return "{}:{}".format(parent_index, choice_index)
+
+    def _get_unit_key(self, unit: str) -> str:
+        """
+        Get the idempotency key of a unit of the part being generated (Example: "3:1/image/0").
+        """
+        return self._pending_part_key + "/" + unit
+
+    def _run_checkpointed(self, key: str, function: callable, *args, **kwargs):
+        """
+        Run a unit of the generation of a part (a paid provider call) once.
+        Its result is checkpointed in the story log before being returned: a generation
+        interrupted by a crash or a cancellation gets it back instead of paying again.
+
+        Args:
+            key (str): the idempotency key of the unit (see _get_unit_key)
+            function (callable): the unit, returns a JSON serializable result (None -> failure, not checkpointed)
+
+        Returns:
+            the result of the unit
+        """
+        if key in self._checkpoints:
+            metrics_add("checkpoint_hits")
+            return self._checkpoints[key]
+
+        result = function(*args, **kwargs)
+        if result is not None:
+            self._set_checkpoint(key, result)
+        return result
+
+    def _run_checkpointed_asset(
+        self, key: str, asset_key: str, function: callable, *args
+    ) -> str:
+        """
+        Run a unit that generates an asset once (see _run_checkpointed).
+        The asset is referenced by its checkpoint (not collected by the asset store gc).
+
+        Args:
+            key (str): the idempotency key of the unit
+            asset_key (str): the key of the asset in the checkpoint (Example: "image_asset")
+            function (callable): the unit, returns the asset id (None -> failure)
+
+        Returns:
+            str: the asset id
+        """
+
+        def run_unit():
+            asset_id = function(*args)
+            return None if asset_id is None else {asset_key: asset_id}
+
+        checkpoint = self._run_checkpointed(key, run_unit)
+        return None if checkpoint is None else checkpoint[asset_key]
+
+    def _set_checkpoint(self, key: str, data):
+        with self._save_lock:
+            if self._pending_part_key is None or not key.startswith(
+                self._pending_part_key + "/"
+            ):
+                # Late asset of a delivered part: it is saved with the part
+                return
+            self._checkpoints[key] = data
+            if self._persisted_metadata is not None:
+                directory = self.get_working_folder()
+                record = make_checkpoint_record(key, data, datetime.now().isoformat())
+                append_story_records(directory, [record])
+                self._log_records += 1
+                add_asset_references(
+                    os.path.normpath(directory), collect_asset_ids(record)
+                )
+                return
+
+        # The story has not been saved yet: the checkpoints are written with it
+        self.save_to_file(wait=True)
+
+    def _drop_checkpoints(self, part_key: str):
+        """
+        Forget the checkpoints of a generated part (the compaction removes them from the log).
+        """
+        with self._save_lock:
+            self._checkpoints = {
+                key: data
+                for key, data in self._checkpoints.items()
+                if not key.startswith(part_key + "/")
+            }
+
+    def _drop_completed_checkpoints(self):
+        """
+        Forget the checkpoints of the parts generated since (Ex: loaded from the log).
+        """
+        for part_key in {key.split("/")[0] for key in self._checkpoints}:
+            if part_key == "root":
+                completed = len(self._story_parts) > 0
+            else:
+                parent_index, choice_index = part_key.split(":")
+                completed = (
+                    self._find_child(
+                        int(parent_index),
+                        None if choice_index == "None" else int(choice_index),
+                    )
+                    is not None
+                )
+            if completed:
+                self._drop_checkpoints(part_key)
+
+    def has_pending_assets(self) -> bool:
+        """
+        Return whether assets of delivered parts are still being generated in the background.
+        """
+        self._backfill_threads = [t for t in self._backfill_threads if t.is_alive()]
+        return len(self._backfill_threads) > 0
+
     def _generate_idea(self) -> bool:
         """
         Generate a new story idea.
@@ -184,10 +680,18 @@ class Story:
         """
         raise NotImplementedError
 
-    def _generate_next_modules(self) -> Tuple[int, List[StoryModules]]:
+    def _generate_next_modules(
+        self, cancel_token: CancellationToken
+    ) -> Tuple[int, List[StoryModules]]:
         """
         Generate the next part of the story.
 
+        Args:
+            cancel_token (CancellationToken): the cancellation token of the generation
+
+        Raises:
+            GenerationCancelledError: if the generation has been cancelled
+
         Returns:
             int: error code:
                 - 0 if no error,
@@ -204,10 +708,16 @@ class Story:
         """
         raise NotImplementedError
 
-    def generate_next_parts(self) -> Tuple[int, List[StoryPart]]:
+    def generate_next_parts(
+        self, cancel_token: CancellationToken = None
+    ) -> Tuple[int, List[StoryPart]]:
         """
         Generate the next parts of the story.
 
+        Args:
+            cancel_token (CancellationToken): the cancellation token of the generation
+                (None -> a new token, cancelled by cancel_generation)
+
         Returns:
             int: error code:
                 - 0 if no error,
@@ -220,87 +730,342 @@ class Story:
                 (image generation)
                 - 4 image generation error
 
+                - 5 the generation has been cancelled
+
             List[StoryPart]: The generated part of the story.
         """
+        if cancel_token is None:
+            cancel_token = CancellationToken()
+        self._generation_cancel_token = cancel_token
+
+        # A reader is waiting for the next part: its provider calls go before background work
+        with provider_context(priority=PRIORITY_INTERACTIVE, cancel_token=cancel_token):
+            try:
+                return self._generate_next_parts(cancel_token)
+            except GenerationCancelledError:
+                print("The generation has been cancelled.")
+                return ERRORCODE_GENERATION_CANCELLED, None
+            finally:
+                self._generation_cancel_token = None
+
+    def _generate_next_parts(
+        self, cancel_token: CancellationToken
+    ) -> Tuple[int, List[StoryPart]]:
         resulting_parts = None
-        if self._get_story_part_index() >= len(self._story_parts):
-            error_code, modules = self._generate_next_modules()
+        story_path = self._get_path()
+        if self._get_story_part_index() >= len(story_path):
+            part_start_time = time.time()
+            self._pending_asset_jobs = []
+            parent_index = story_path[-1] if len(story_path) > 0 else None
+            choice_index = (
+                None
+                if parent_index is None
+                else self._get_selected_choice_index(parent_index)
+            )
+            part_key = self._get_part_key(parent_index, choice_index)
+            self._pending_part_key = part_key
+            error_code, modules = self._generate_next_modules(cancel_token)
 
             if error_code == ERRORCODE_NO_ERROR:
                 # Translate the necessary modules
+                def translate_module(module: isTranslatable) -> dict:
+                    module.set_translation(target_lang=self._target_lang)
+                    return module.to_dict()
+
                 if self._target_lang is not None:
                     print("Translating the story...")
-                    for module in modules:
+                    for i, module in enumerate(modules):
+                        cancel_token.raise_if_cancelled()
                         if isinstance(module, isTranslatable):
-                            module.set_translation(target_lang=self._target_lang)
+                            modules[i] = StoryModules.from_dict(
+                                self._run_checkpointed(
+                                    self._get_unit_key("translation/{}".format(i)),
+                                    translate_module,
+                                    module,
+                                )
+                            )
 
-                def generate_module_speech(module: canBeSpeechSynthesized):
-                    module.generate_speech(working_folder=self.get_working_folder())
+                def generate_module_speech(key: str, module: canBeSpeechSynthesized):
+                    module.set_speech_asset(
+                        self._run_checkpointed_asset(
+                            key, "speech_asset", module.generate_speech
+                        )
+                    )
 
                 need_speech_generation = []
                 # Generate the speeches
                 if self._generate_speeches:
                     print("Generating the speeches...")
-                    for module in modules:
+                    for i, module in enumerate(modules):
                         if isinstance(module, canBeSpeechSynthesized):
-                            need_speech_generation.append(module)
-
-                args = [[module] for module in need_speech_generation]
-                query_in_parallel(
-                    function=generate_module_speech,
-                    args_list=args,
-                    max_parallel_queries=API_MAX_BATCH_SPEECHES,
-                    time_between_queries=API_BATCH_DELAY,
-                )
+                            need_speech_generation.append(
+                                [self._get_unit_key("speech/{}".format(i)), module]
+                            )
+
+                args = need_speech_generation
+                if len(args) > 0:
+                    # Streamed speeches are played while they are synthesized: the part does
+                    # not wait for them. Once it is delivered, they are cancelled with the
+                    # background assets only (quit, other branch), not by the next choice
+                    self._start_asset_job(
+                        name="speeches",
+                        function=generate_module_speech,
+                        args_list=args,
+                        max_parallel_queries=API_MAX_BATCH_SPEECHES,
+                        wait=not SPEECH_STREAMING,
+                    )
+
+                late_jobs = self._wait_for_asset_jobs(part_start_time)
+                cancel_token.raise_if_cancelled()
 
                 resulting_parts = [StoryPart(modules)]
-                self._story_parts.extend(resulting_parts)
+                with self._save_lock:
+                    # The part hangs off the last part of the branch and its selected choice
+                    part_index = len(self._story_parts)
+                    if parent_index is not None:
+                        self._set_part_link(part_index, parent_index, choice_index)
+                    self._story_parts.extend(resulting_parts)
+                    self._set_active_part(part_index)
+                    self._pending_part_key = None
+                    self._drop_checkpoints(part_key)
+
+                if len(late_jobs) > 0:
+                    self._backfill_late_assets(late_jobs, part_index, part_start_time)
 
             self.save_to_file()
             self._story_part_index += 1
         else:
-            len_generated_story = len(self._story_parts)
-
-            resulting_parts = self._story_parts[
-                self._story_part_index : len_generated_story
-            ]
-            self._story_part_index = len_generated_story
+            # Parts already generated (loaded story or explored branch): no provider call
+            resulting_parts = self.get_story_parts()[self._story_part_index :]
+            self._story_part_index = len(story_path)
             error_code = ERRORCODE_NO_ERROR
+            if (
+                len(self._dirty_modules) > 0
+                or self._get_metadata_dict() != self._persisted_metadata
+            ):
+                # Save the choice that led to the branch
+                self.save_to_file()
 
         return error_code, resulting_parts
 
-    def save_to_file(self):
+    def _mark_part_dirty(self, part_index: int):
+        """
+        Mark a saved part as modified (Ex: assets added in the background).
+        The part is written again by the next save.
+        """
+        with self._save_lock:
+            self._story_parts.pin(part_index)
+            self._dirty_parts.add(part_index)
+
+    def _mark_module_dirty(self, part_index: int, module_index: int):
+        """
+        Mark a module of a saved part as modified (Ex: the user choice).
+        The module is written again by the next save.
+        """
+        with self._save_lock:
+            self._story_parts.pin(part_index)
+            self._dirty_modules.add((part_index, module_index))
+
+    def _set_persisted_state(self, log_info: dict):
+        """
+        Set the persistence state of a story loaded from its working folder.
+
+        Args:
+            log_info (dict): the information about the story log (None -> the story must be rewritten)
+        """
+        self._persisted_parts = len(self._story_parts)
+        self._persisted_metadata = self._get_metadata_dict()
+        if (
+            log_info is None
+            or log_info["corrupted_tail"]
+            or log_info["format_version"] != STORY_LOG_FORMAT_VERSION
+            or log_info["serializer"] != get_serializer().name
+        ):
+            # Legacy story, incomplete last record, older format or other serializer:
+            # the next save compacts the story
+            self._persisted_metadata = None
+        else:
+            self._log_records = log_info["records"]
+
+    def save_to_file(self, wait: bool = False):
         """
         Save the story to file.
+        The save is queued and written in the background by the persistence queue
+        (see storage/persistence_queue.py): the consecutive saves of the story are coalesced.
+
+        Args:
+            wait (bool): True to return once the story is written
         """
-        directory = self.get_working_folder()
-        os.makedirs(directory, exist_ok=True)
+        if not SAVE_WRITE_BEHIND:
+            self._write_to_file()
+            return
+        key = os.path.normpath(self.get_working_folder())
+        queue_save(key, self._write_to_file)
+        if wait:
+            flush_saves(key)
 
-        filename = directory + "/story.json"
-        story_dict = self.to_dict()
-        with open(filename, "w") as file:
-            json.dump(story_dict, file, indent=4)
+    def _write_to_file(self):
+        """
+        Write the story to file.
+        The new parts and the modified parts, modules and metadata are appended to the story log
+        (constant cost per part). The log is compacted from time to time.
+        The catalog and the search index are updated with the saved parts.
+        A story opened from a bundle is saved in its working folder with the assets of the bundle.
+        """
+        with self._save_lock:
+            directory = self.get_working_folder()
+            os.makedirs(directory, exist_ok=True)
 
-    def to_dict(self) -> dict:
+            if self._source_bundle is not None:
+                # The saved story must not depend on the bundle (opened by this process only)
+                import_assets(self._source_bundle, self._source_bundle.get_asset_ids())
+                self._source_bundle = None
+
+            saved_time = datetime.now().isoformat()
+            metadata = self._get_metadata_dict()
+
+            if self._persisted_metadata is None or needs_compaction(
+                self._log_records, len(self._story_parts)
+            ):
+                parts = [
+                    self._story_parts.get_part_dict(i)
+                    for i in range(len(self._story_parts))
+                ]
+                write_story_log(
+                    directory,
+                    metadata,
+                    parts,
+                    saved_time,
+                    self._part_links,
+                    self._checkpoints,
+                )
+                self._log_records = len(self._story_parts) + len(self._checkpoints)
+                indexed_parts = dict(enumerate(parts))
+                set_asset_references(
+                    os.path.normpath(directory),
+                    collect_asset_ids([parts, self._checkpoints]),
+                )
+            else:
+                records = []
+                if metadata != self._persisted_metadata:
+                    records.append(make_meta_record(metadata, saved_time))
+
+                for part_index in sorted(self._dirty_parts):
+                    if part_index < self._persisted_parts:
+                        records.append(
+                            make_part_record(
+                                part_index,
+                                self._story_parts.get_part_dict(part_index),
+                                saved_time,
+                            )
+                        )
+
+                for part_index, module_index in sorted(self._dirty_modules):
+                    if (
+                        part_index < self._persisted_parts
+                        and part_index not in self._dirty_parts
+                    ):
+                        module = self._story_parts[part_index][module_index]
+                        records.append(
+                            make_module_record(
+                                part_index, module_index, module.to_dict(), saved_time
+                            )
+                        )
+
+                for part_index in sorted(self._dirty_links):
+                    if part_index < self._persisted_parts:
+                        link = self._part_links[part_index]
+                        records.append(
+                            make_link_record(part_index, link[0], link[1], saved_time)
+                        )
+
+                for part_index in range(self._persisted_parts, len(self._story_parts)):
+                    records.append(
+                        make_part_record(
+                            part_index,
+                            self._story_parts.get_part_dict(part_index),
+                            saved_time,
+                        )
+                    )
+                    link = get_part_link(self._part_links, part_index)
+                    if link is not None:
+                        records.append(
+                            make_link_record(part_index, link[0], link[1], saved_time)
+                        )
+
+                append_story_records(directory, records)
+                # The link records are not counted (see needs_compaction)
+                self._log_records += len(
+                    [record for record in records if record["op"] != "link"]
+                )
+                indexed_parts = {
+                    record["part"]: self._story_parts.get_part_dict(record["part"])
+                    for record in records
+                    if record["op"] in ["part", "module"]
+                }
+                # The references of a story only grow between two compactions
+                add_asset_references(
+                    os.path.normpath(directory), collect_asset_ids(records)
+                )
+
+            self._persisted_parts = len(self._story_parts)
+            self._persisted_metadata = metadata
+            self._dirty_parts = set()
+            self._dirty_modules = set()
+            self._dirty_links = set()
+
+            try:
+                catalog_update_story(directory, dict(metadata, saved_time=saved_time))
+            except Exception as e:
+                print("Failed to update the story catalog: {}".format(e))
+            try:
+                search_index_story(
+                    directory,
+                    metadata,
+                    indexed_parts,
+                    replace=len(indexed_parts) == len(self._story_parts),
+                )
+            except Exception as e:
+                print("Failed to update the search index: {}".format(e))
+
+    def _get_metadata_dict(self) -> dict:
         """
-        Convert the story to a dictionary.
+        Get the metadata of the story (the dictionary of the story without the parts and the saved time).
 
         Returns:
-            dict: the dictionary that represents the story
+            dict: the metadata of the story
         """
-        story_dict = {
+        return {
             "id": self.id,
-            "saved_time": datetime.now().isoformat(),
             "title": (
                 self._title_module.to_dict() if self._title_module is not None else None
             ),
             "overview": self._overview,
             "need_illustration": self._need_illustration,
             "generate_speeches": self._generate_speeches,
+            "reuse_similar_images": self._reuse_similar_images,
             "target_lang": self._target_lang,
             "story_length": self._story_max_length,
-            "story_parts": [part.to_dict() for part in self._story_parts],
+            "budget_overruns": [dict(overrun) for overrun in self._budget_overruns],
+            "active_part": self._active_part,
+            "thumbnail_asset": self._thumbnail_asset,
         }
+
+    def to_dict(self) -> dict:
+        """
+        Convert the story to a dictionary.
+
+        Returns:
+            dict: the dictionary that represents the story
+        """
+        story_dict = self._get_metadata_dict()
+        story_dict["saved_time"] = datetime.now().isoformat()
+        story_dict["story_parts"] = [
+            self._story_parts.get_part_dict(i) for i in range(len(self._story_parts))
+        ]
+        story_dict["part_links"] = [
+            None if link is None else list(link) for link in self._part_links
+        ]
         return story_dict
 
     @staticmethod
@@ -0,0 +1,141 @@
+import os
+import sys
+
+from story.story_type.ai_story import AIStory
+from storage.asset_store import (
+    compute_asset_id,
+    import_assets,
+    open_asset,
+    collect_asset_ids,
+)
+from storage.bundle_format import BUNDLE_EXTENSION, StoryBundle, write_bundle
+from storage.story_catalog import catalog_update_story
+from storage.story_search import search_index_story
+
+###############################################################################################
+# Story bundle commands
+#
+# Export a story (folder and its assets) as a single bundle file and import it back:
+#   python -m story.story_bundle export out/stories/story_id out/bundles/story_id.rvb
+#   python -m story.story_bundle import out/bundles/story_id.rvb
+# A bundle can also be opened directly (AIStory.load_story), its assets are then
+# served from the memory-mapped bundle.
+###############################################################################################
+
+BUNDLE_DIRECTORY = "out/bundles"
+
+# Legacy module keys (file path) -> asset store keys
+_LEGACY_ASSET_KEYS = {"image_path": "image_asset", "speech_file_path": "speech_asset"}
+
+
+def _resolve_legacy_path(path: str, story_directory: str) -> str:
+    """
+    Find the file of a legacy module (the demo stories reference out/stories/...).
+    """
+    if os.path.exists(path):
+        return path
+    path = os.path.join(story_directory, os.path.basename(path))
+    if os.path.exists(path):
+        return path
+    return None
+
+
+def _convert_legacy_assets(module_dict: dict, story_directory: str, assets: dict):
+    """
+    Add the files of a legacy module to the bundle assets and reference them by id.
+    """
+    for path_key, asset_key in _LEGACY_ASSET_KEYS.items():
+        path = module_dict.get(path_key)
+        if path is None or module_dict.get(asset_key) is not None:
+            continue
+        path = _resolve_legacy_path(path, story_directory)
+        if path is None:
+            print("Missing story file {}".format(module_dict[path_key]))
+            continue
+
+        with open(path, "rb") as file:
+            data = file.read()
+        asset_id = compute_asset_id(data, path.rsplit(".", 1)[-1])
+        assets[asset_id] = data
+        module_dict[asset_key] = asset_id
+        module_dict[path_key] = None
+
+
+def export_story_bundle(story_directory: str, bundle_path: str = None) -> str:
+    """
+    Export a story as a bundle (listed in the history with the other stories).
+
+    Args:
+        story_directory (str): the story to export (directory or bundle)
+        bundle_path (str): the path of the bundle (None -> BUNDLE_DIRECTORY/story_id.rvb)
+
+    Returns:
+        str: the path of the bundle
+    """
+    story = AIStory.load_story(story_directory)
+    if story is None:
+        raise ValueError("No story in {}".format(story_directory))
+    if bundle_path is None:
+        bundle_path = os.path.join(BUNDLE_DIRECTORY, story.id + BUNDLE_EXTENSION)
+
+    story_dict = story.to_dict()
+    assets = {}
+    for part in story_dict["story_parts"]:
+        for module_dict in part:
+            _convert_legacy_assets(module_dict, story_directory, assets)
+
+    for asset_id in collect_asset_ids(story_dict):
+        if asset_id in assets:
+            continue
+        asset = open_asset(asset_id)
+        if asset is None:
+            print("Missing asset {}".format(asset_id))
+            continue
+        assets[asset_id] = asset
+
+    write_bundle(bundle_path, story_dict, assets)
+    try:
+        catalog_update_story(bundle_path, story_dict)
+        search_index_story(
+            bundle_path,
+            story_dict,
+            dict(enumerate(story_dict["story_parts"])),
+            replace=True,
+        )
+    except Exception as e:
+        print("Failed to index the story bundle: {}".format(e))
+    return bundle_path
+
+
+def import_story_bundle(bundle_path: str) -> str:
+    """
+    Import a bundle: its assets are added to the asset store and the story is saved
+    in its working folder (replacing a story with the same id).
+
+    Args:
+        bundle_path (str): the path of the bundle
+
+    Returns:
+        str: the directory of the imported story
+    """
+    with StoryBundle(bundle_path) as bundle:
+        import_assets(bundle, bundle.get_asset_ids())
+        story_dict = bundle.get_story_dict()
+
+    story = AIStory.from_dict(story_dict)
+    story.save_to_file(wait=True)
+    return story.get_working_folder()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 3 and sys.argv[1] == "import":
+        print("Story imported in {}".format(import_story_bundle(sys.argv[2])))
+    elif len(sys.argv) in [3, 4] and sys.argv[1] == "export":
+        bundle_path = sys.argv[3] if len(sys.argv) == 4 else None
+        print("Story exported to {}".format(export_story_bundle(sys.argv[2], bundle_path)))
+    else:
+        print(
+            "Usage: python -m story.story_bundle export <story directory> [<bundle path>]\n"
+            "       python -m story.story_bundle import <bundle path>"
+        )
+        sys.exit(1)
@@ -1,11 +1,47 @@
 from typing import List
 from agents.translationAgent import query_translation
 from agents.voiceAgent import query_speech
+from storage.asset_store import get_asset_path, open_asset
+from storage.image_variants import select_image_variant
+from storage.speech_streams import SPEECH_STREAMING, SpeechStream
+from storage.speech_formats import get_speech_format
 
 
+# Type tag (the "type" of the serialized modules) -> module class
+_module_types = {}
+
+
+def register_module(type_tag: str):
+    """
+    Register a module class for StoryModules.from_dict.
+    The type tag is saved with the modules: it must never change.
+    (A reloaded class replaces the previous one, Ex: Streamlit reloading the modules)
+
+    Args:
+        type_tag (str): the type tag of the class (Example: "TextModule")
+    """
+
+    def register(module_class):
+        module_class.TYPE_TAG = type_tag
+        _module_types[type_tag] = module_class
+        return module_class
+
+    return register
+
+
+def get_module_type(type_tag: str) -> type:
+    """
+    Get the class of a registered module type (None if the type is unknown).
+    """
+    return _module_types.get(type_tag)
+
+
+# The modules and their mixins use __slots__ (no per-instance __dict__):
+# the mixins declare no slot and each module class declares all its attributes.
 class StoryModules:
-    def __init__(self):
-        pass
+    __slots__ = ()
+
+    TYPE_TAG = None
 
     def to_prompt_string(self):
         raise NotImplementedError
@@ -15,15 +51,17 @@ class StoryModules:
 
     @staticmethod
     def from_dict(module_dict):
-        classes = globals()
         module_type = module_dict["type"]
-        if module_type not in classes:
+        module_class = _module_types.get(module_type)
+        if module_class is None:
             raise ValueError(f"Unknown module type {module_type}")
 
-        return classes[module_type].from_dict(module_dict)
+        return module_class.from_dict(module_dict)
 
 
 class HasDisplayableText:
+    __slots__ = ()
+
     def __init__(self):
         self._displayed_text = None
 
@@ -43,8 +81,7 @@ class HasDisplayableText:
 
 
 class isTranslatable:
-    def __init__(self):
-        pass
+    __slots__ = ()
 
     def set_translation(self, target_lang: str):
         """
@@ -57,9 +94,7 @@ class isTranslatable:
 
 
 class HasDisplayableAndIsTranslatableText(HasDisplayableText, isTranslatable):
-    def __init__(self):
-        super(HasDisplayableText, self).__init__()
-        super(isTranslatable, self).__init__()
+    __slots__ = ()
 
     def set_translation(self, target_lang: str):
         if target_lang is None:
@@ -72,30 +107,98 @@ class HasDisplayableAndIsTranslatableText(HasDisplayableText, isTranslatable):
 
 
 class canBeSpeechSynthesized:
+    """
+    The speech is an asset of the asset store (speech_asset).
+    Stories saved before the asset store reference the speech file directly (speech_file_path).
+    While it is synthesized, the speech can be played from its stream (see storage/speech_streams.py).
+    Its audio format (Example: "mp3", "opus") is recorded with it (see storage/speech_formats.py).
+    """
+
+    __slots__ = ()
+
     def __init__(self):
         self._speech_file_path = None
-        pass
+        self._speech_asset = None
+        self._speech_stream = None
+        self._speech_format = None
 
     def _get_speech_text(self):
         raise NotImplementedError
 
-    def generate_speech(self, working_folder: str = "out"):
+    def generate_speech(self):
         """
-        Generate the speech of the text and save it in the working folder
+        Generate the speech of the text and add it to the asset store
+
+        Returns:
+            str: the asset id of the speech
         """
-        filename = query_speech(self._get_speech_text(), working_folder=working_folder)
-        self._speech_file_path = filename
+        stream = SpeechStream() if SPEECH_STREAMING else None
+        self._speech_stream = stream
+        try:
+            self.set_speech_asset(query_speech(self._get_speech_text(), stream=stream))
+        except Exception:
+            # Ex: cancelled before the synthesis started: the readers of the stream stop
+            if stream is not None:
+                stream.fail()
+            raise
+        finally:
+            self._speech_stream = None
+        return self._speech_asset
+
+    def get_speech_stream(self):
+        """
+        Get the stream of the speech being synthesized.
+
+        Returns:
+            SpeechStream: the stream (None -> the speech is not being synthesized)
+        """
+        return self._speech_stream
 
     def has_speech_generated(self):
-        return self._speech_file_path is not None
+        return self._speech_asset is not None or self._speech_file_path is not None
 
     def get_speech_file_path(self):
+        if self._speech_asset is not None:
+            return get_asset_path(self._speech_asset)
+        return self._speech_file_path
+
+    def get_speech(self):
+        """
+        Get the speech for playback.
+
+        Returns:
+            str | memoryview: the speech file path or its content (Ex: asset served from a story bundle)
+        """
+        if self._speech_asset is not None:
+            return open_asset(self._speech_asset)
         return self._speech_file_path
 
     def set_speech_file_path(self, speech_file_path):
         self._speech_file_path = speech_file_path
+        self._update_speech_format()
 
+    def get_speech_asset(self):
+        return self._speech_asset
 
+    def set_speech_asset(self, speech_asset):
+        self._speech_asset = speech_asset
+        self._update_speech_format()
+
+    def _update_speech_format(self):
+        speech = self._speech_asset or self._speech_file_path
+        self._speech_format = None if speech is None else get_speech_format(speech)
+
+    def get_speech_format(self):
+        """
+        Get the audio format of the speech.
+
+        Returns:
+            str: the format (Example: "mp3"), None if there is no speech
+        """
+        return self._speech_format
+
+
+@register_module("TextModule")
 class TextModule(
     StoryModules, HasDisplayableAndIsTranslatableText, canBeSpeechSynthesized
 ):
@@ -107,6 +210,15 @@ class TextModule(
         displayed_text (str): the text to display
     """
 
+    __slots__ = (
+        "text",
+        "_displayed_text",
+        "_speech_file_path",
+        "_speech_asset",
+        "_speech_stream",
+        "_speech_format",
+    )
+
     def __init__(self, text: str, displayed_text: str = None):
         """
         Text module
@@ -114,9 +226,7 @@ class TextModule(
         Args:
             text (str): the text to display
         """
-        super(StoryModules, self).__init__()
-        super(HasDisplayableAndIsTranslatableText, self).__init__()
-        super(canBeSpeechSynthesized, self).__init__()
+        canBeSpeechSynthesized.__init__(self)
         self.text = text
         self.set_displayed_text(displayed_text)
 
@@ -135,10 +245,12 @@ class TextModule(
     # Override from StoryModules
     def to_dict(self):
         return {
-            "type": "TextModule",
+            "type": self.TYPE_TAG,
             "text": self.text,
             "displayed_text": self._displayed_text,
-            "speech_file_path": self.get_speech_file_path(),
+            "speech_file_path": self._speech_file_path,
+            "speech_asset": self._speech_asset,
+            "speech_format": self._speech_format,
         }
 
     # Override from StoryModules
@@ -146,35 +258,82 @@ class TextModule(
     def from_dict(module_dict):
         text_module = TextModule(module_dict["text"], module_dict["displayed_text"])
         text_module.set_speech_file_path(module_dict["speech_file_path"])
+        text_module.set_speech_asset(module_dict.get("speech_asset"))
+        if module_dict.get("speech_format") is not None:
+            text_module._speech_format = module_dict["speech_format"]
         return text_module
 
 
+@register_module("ImageModule")
 class ImageModule(StoryModules):
     """
     Image module
 
     Parameters:
-        image_path (str): the path to the image
+        image_path (str): the path to the image (stories saved before the asset store)
+        image_asset (str): the id of the image in the asset store (original)
+        image_variant_assets (dict): the smaller variants of the image (see storage/image_variants.py)
     """
 
-    def __init__(self, image_path: str):
+    __slots__ = ("image_path", "image_asset", "image_variant_assets")
+
+    def __init__(
+        self, image_path: str, image_asset: str = None, image_variant_assets: dict = None
+    ):
         """
         Image module
 
         Args:
             image_path (str): the path to the image
+            image_asset (str): the id of the image in the asset store
+            image_variant_assets (dict): variant name -> asset id (Example: {"thumbnail": "3f1c...9a2b.jpg"})
         """
-        super(StoryModules, self).__init__()
         self.image_path = image_path
+        self.image_asset = image_asset
+        self.image_variant_assets = image_variant_assets
 
     def set_image_path(self, image_path):
         self.image_path = image_path
 
+    def set_image_asset(self, image_asset):
+        self.image_asset = image_asset
+
+    def get_image_asset(self):
+        return self.image_asset
+
+    def set_image_variant_assets(self, image_variant_assets):
+        self.image_variant_assets = image_variant_assets
+
+    def get_image_variant_assets(self):
+        return self.image_variant_assets
+
     def get_image_path(self):
+        if self.image_asset is not None:
+            return get_asset_path(self.image_asset)
+        return self.image_path
+
+    def get_image(self, width: int = None):
+        """
+        Get the image for display.
+
+        Args:
+            width (int): the display width in pixels: the smallest variant that fits is returned (None -> original)
+
+        Returns:
+            str | memoryview: the image file path or its content (Ex: asset served from a story bundle)
+        """
+        if self.image_asset is not None:
+            asset_id = select_image_variant(
+                self.image_asset, self.image_variant_assets, width
+            )
+            image = open_asset(asset_id)
+            if image is None and asset_id != self.image_asset:
+                image = open_asset(self.image_asset)
+            return image
         return self.image_path
 
     def has_image_path(self):
-        return self.image_path is not None
+        return self.image_asset is not None or self.image_path is not None
 
     # Override from StoryModules
     def to_prompt_string(self):
@@ -183,16 +342,23 @@ class ImageModule(StoryModules):
     # Override from StoryModules
     def to_dict(self):
         return {
-            "type": "ImageModule",
+            "type": self.TYPE_TAG,
             "image_path": self.image_path,
+            "image_asset": self.image_asset,
+            "image_variant_assets": self.image_variant_assets,
         }
 
     # Override from StoryModules
     @staticmethod
     def from_dict(module_dict):
-        return ImageModule(module_dict["image_path"])
+        return ImageModule(
+            module_dict["image_path"],
+            module_dict.get("image_asset"),
+            module_dict.get("image_variant_assets"),
+        )
 
 
+@register_module("ChoiceModule")
 class ChoiceModule(StoryModules, HasDisplayableAndIsTranslatableText):
     """
     Choice module
@@ -202,6 +368,8 @@ class ChoiceModule(StoryModules, HasDisplayableAndIsTranslatableText):
         displayed_choice_text (str): the displayed choice text
     """
 
+    __slots__ = ("choice_text", "_displayed_text")
+
     def __init__(self, choice_text: str, displayed_choice_text: str = None):
         """
         Choice module
@@ -209,8 +377,6 @@ class ChoiceModule(StoryModules, HasDisplayableAndIsTranslatableText):
         Args:
             choice (str): the choice text
         """
-        super(StoryModules, self).__init__()
-        super(HasDisplayableAndIsTranslatableText, self).__init__()
         self.choice_text = choice_text
         self.set_displayed_text(displayed_choice_text)
 
@@ -232,7 +398,7 @@ class ChoiceModule(StoryModules, HasDisplayableAndIsTranslatableText):
     # Override from StoryModules
     def to_dict(self):
         return {
-            "type": "ChoiceModule",
+            "type": self.TYPE_TAG,
             "choice_text": self.choice_text,
             "displayed_choice_text": self._displayed_text,
         }
@@ -246,6 +412,7 @@ class ChoiceModule(StoryModules, HasDisplayableAndIsTranslatableText):
         return choice_module
 
 
+@register_module("PossibleChoicesModule")
 class PossibleChoicesModule(StoryModules, isTranslatable):
     """
     Possible choices module
@@ -256,13 +423,13 @@ class PossibleChoicesModule(StoryModules, isTranslatable):
         selected_choice (ChoiceModule): the selected choice
     """
 
+    __slots__ = ("choices", "selected", "selected_choice")
+
     def __init__(self, choices: List[ChoiceModule]):
         """
         Args:
             choices (list[ChoiceModule]): the list of choices
         """
-        super(StoryModules, self).__init__()
-        super(isTranslatable, self).__init__()
         self.choices = choices
         self.selected = False
         self.selected_choice = None
@@ -287,6 +454,20 @@ class PossibleChoicesModule(StoryModules, isTranslatable):
             return None
         return self.selected_choice
 
+    def get_selected_choice_index(self):
+        """
+        Get the index of the selected choice
+
+        Returns:
+            int: the index of the selected choice in the choices or None if no choice has been selected
+        """
+        if not self.has_selected_choice():
+            return None
+        for index, choice in enumerate(self.choices):
+            if choice == self.selected_choice:
+                return index
+        return None
+
     def set_user_choice(self, user_choice):
         """
         Args:
@@ -310,7 +491,7 @@ class PossibleChoicesModule(StoryModules, isTranslatable):
     # Override from StoryModules
     def to_dict(self):
         return {
-            "type": "PossibleChoicesModule",
+            "type": self.TYPE_TAG,
             "choices": [choice.to_dict() for choice in self.choices],
             "selected": self.selected,
             "selected_choice": (
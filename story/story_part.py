@@ -1,3 +1,6 @@
+from collections import OrderedDict
+from collections.abc import MutableSequence, Sequence
+from threading import Lock
 from typing import List
 from story.story_modules import StoryModules
 
@@ -20,3 +23,141 @@ class StoryPart:
 
     def to_dict(self) -> dict:
         return [module.to_dict() for module in self._modules]
+
+
+# Number of decoded parts kept in memory by a lazily loaded story
+# (the parts modified in memory always stay decoded)
+STORY_PART_CACHE_SIZE = 16
+
+
+class LazyStoryParts(MutableSequence):
+    """
+    Parts of a story decoded on first access.
+    A part is decoded from its source (serialized modules, or any format read by decode_part_source)
+    and kept in a LRU cache of STORY_PART_CACHE_SIZE parts. The parts that may be modified
+    in memory are pinned: the last part, the inserted parts and the pinned parts (see pin).
+
+    Parameters:
+        part_sources (list): the sources of the parts
+        decode_part_source (callable): source -> list of serialized modules (None -> the sources are serialized modules)
+    """
+
+    def __init__(self, part_sources: list = None, decode_part_source: callable = None):
+        # Each entry is [source, pinned part]
+        self._entries = [[source, None] for source in (part_sources or [])]
+        self._decode_part_source = decode_part_source
+        self._cache = OrderedDict()
+        # The parts are also accessed by the background jobs of the story (Ex: backfill)
+        self._lock = Lock()
+
+    def _decode_modules(self, source) -> List[dict]:
+        if self._decode_part_source is None:
+            return source
+        return self._decode_part_source(source)
+
+    def _get_part(self, index: int) -> StoryPart:
+        with self._lock:
+            return self._get_part_locked(index)
+
+    def _get_part_locked(self, index: int) -> StoryPart:
+        entry = self._entries[index]
+        if entry[1] is not None:
+            return entry[1]
+
+        part = self._cache.get(index)
+        if part is not None:
+            self._cache.move_to_end(index)
+            return part
+
+        part = StoryPart(
+            [StoryModules.from_dict(module) for module in self._decode_modules(entry[0])]
+        )
+        if index == len(self._entries) - 1:
+            entry[1] = part
+            return part
+
+        self._cache[index] = part
+        while len(self._cache) > STORY_PART_CACHE_SIZE:
+            self._cache.popitem(last=False)
+        return part
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self._get_part(i) for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self._entries)
+        if not 0 <= index < len(self._entries):
+            raise IndexError("story part index out of range")
+        return self._get_part(index)
+
+    def __setitem__(self, index, part: StoryPart):
+        with self._lock:
+            self._entries[index] = [None, part]
+            self._cache.clear()
+
+    def __delitem__(self, index):
+        with self._lock:
+            del self._entries[index]
+            self._cache.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def insert(self, index: int, part: StoryPart):
+        with self._lock:
+            self._entries.insert(index, [None, part])
+            self._cache.clear()
+
+    def pin(self, index: int) -> None:
+        """
+        Keep a part decoded (Ex: before modifying it).
+        """
+        part = self[index]
+        with self._lock:
+            self._entries[index][1] = part
+            self._cache.pop(index, None)
+
+    def is_decoded(self, index: int) -> bool:
+        return self._entries[index][1] is not None or index in self._cache
+
+    def get_part_dict(self, index: int) -> List[dict]:
+        """
+        Get a serialized part (without decoding it if it is not decoded yet).
+        """
+        with self._lock:
+            entry = self._entries[index]
+            if entry[1] is None and index not in self._cache:
+                source = entry[0]
+            else:
+                source = None
+        if source is not None:
+            return self._decode_modules(source)
+        return self._get_part(index).to_dict()
+
+
+class StoryPath(Sequence):
+    """
+    Parts of a branch of the story: a read-only view of the stored parts (decoded on access).
+
+    Parameters:
+        story_parts (LazyStoryParts): the stored parts of the story
+        part_indexes (List[int]): the indexes of the parts of the branch in the stored parts
+    """
+
+    def __init__(self, story_parts: LazyStoryParts, part_indexes: List[int]):
+        self._story_parts = story_parts
+        self._part_indexes = part_indexes
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self._story_parts[i] for i in self._part_indexes[index]]
+        return self._story_parts[self._part_indexes[index]]
+
+    def __len__(self):
+        return len(self._part_indexes)
+
+    def get_part_index(self, position: int) -> int:
+        """
+        Get the index in the stored parts of the part at a position of the branch.
+        """
+        return self._part_indexes[position]
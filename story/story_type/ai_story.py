@@ -1,8 +1,8 @@
-import json
 import os
 
 from story.story import (
     Story,
+    PART_LATENCY_BUDGET,
     ERRORCODE_NO_ERROR,
     ERRORCODE_STORY_COMPLETE,
     ERRORCODE_WAITING_FOR_USER_INPUT,
@@ -16,8 +16,19 @@ from agents.writerAgent import (
 from agents.illustratorAgent import (
     query_suggested_illustrations,
     query_illustration_complete_description,
+    query_illustration,
 )
 from agents.ideaAgent import generate_title_overview_story
+from storage.story_log import (
+    has_story_log,
+    read_story_dict,
+    read_story_log_lazily,
+    decode_part_records,
+)
+from storage.bundle_format import is_bundle_path, open_bundle
+from storage.persistence_queue import flush_saves
+from storage.asset_store import register_asset_source
+from storage.image_variants import make_image_variants
 from typing import Tuple, List
 from story.story_modules import (
     StoryModules,
@@ -26,12 +37,10 @@ from story.story_modules import (
     ChoiceModule,
     PossibleChoicesModule,
 )
-from story.story_part import StoryPart
-from agents.agent_utils import query_in_parallel
+from story.story_part import LazyStoryParts
 from openaiAPI import (
-    query_openai_image_generation,
     API_MAX_BATCH_IMAGES,
-    API_BATCH_DELAY,
+    CancellationToken,
 )
 
 
@@ -45,6 +54,8 @@ class AIStory(Story):
         target_lang=None,
         story_length=3,
         id=None,
+        part_latency_budget=PART_LATENCY_BUDGET,
+        reuse_similar_images=True,
     ):
         super().__init__(
             title=title,
@@ -54,6 +65,8 @@ class AIStory(Story):
             target_lang=target_lang,
             story_length=story_length,
             id=id,
+            part_latency_budget=part_latency_budget,
+            reuse_similar_images=reuse_similar_images,
         )
 
     def _generate_idea(self) -> bool:
@@ -84,6 +97,8 @@ class AIStory(Story):
             sucess = self._generate_idea()
             if not sucess:
                 return ERRORCODE_TEXT_GENERATION_ERROR, None
+            # The idea is saved before generating the part
+            self.save_to_file()
 
         generated_part = []
         # We need to generate the introduction first
@@ -92,7 +107,11 @@ class AIStory(Story):
             # Generate the story introduction
             ###
             print("Generating the story introduction ...")
-            introduction = query_story_introduction(self._overview)
+            introduction = self._run_checkpointed(
+                self._get_unit_key("introduction"),
+                query_story_introduction,
+                self._overview,
+            )
 
             if introduction is None:
                 print("Failed to generate the introduction.")
@@ -107,7 +126,9 @@ class AIStory(Story):
             # Generate the story extension
             ###
             print("Generating the story ...")
-            extension = query_story_continuation(
+            extension = self._run_checkpointed(
+                self._get_unit_key("continuation"),
+                query_story_continuation,
                 self._overview,
                 story,
                 current_story_length + 1,
@@ -130,7 +151,9 @@ class AIStory(Story):
             # Generate the end
             ###
             print("Generating the end of the story ...")
-            end = query_story_end(self._overview, story)
+            end = self._run_checkpointed(
+                self._get_unit_key("end"), query_story_end, self._overview, story
+            )
 
             if end is None:
                 print("Failed to generate the end.")
@@ -140,7 +163,9 @@ class AIStory(Story):
 
         return ERRORCODE_NO_ERROR, generated_part
 
-    def _generate_next_modules(self) -> Tuple[int, List[StoryModules]]:
+    def _generate_next_modules(
+        self, cancel_token: CancellationToken
+    ) -> Tuple[int, List[StoryModules]]:
         generated_modules = []
         text_code_error, generated_output = self._generate_text_next_part()
 
@@ -152,14 +177,17 @@ class AIStory(Story):
         working_folder = self.get_working_folder()
         illustration_generation = []
 
-        for module in generated_output:
+        for i, module in enumerate(generated_output):
             if isinstance(module, TextModule):
                 generated_text = module.get_text()
                 if self._need_illustration:
                     # Generate the illustrations
 
-                    suggested_illustrations = query_suggested_illustrations(
-                        generated_text, max_illustrations=2
+                    suggested_illustrations = self._run_checkpointed(
+                        self._get_unit_key("suggestions/{}".format(i)),
+                        query_suggested_illustrations,
+                        generated_text,
+                        max_illustrations=2,
                     )
                     suggested_illustrations = sorted(
                         suggested_illustrations, key=lambda x: x["start_idx"]
@@ -196,8 +224,11 @@ class AIStory(Story):
             # Generate the illustrations
 
             illustration_descriptions = []
-            for illustration in illustration_generation:
-                description = query_illustration_complete_description(
+            for i, illustration in enumerate(illustration_generation):
+                cancel_token.raise_if_cancelled()
+                description = self._run_checkpointed(
+                    self._get_unit_key("description/{}".format(i)),
+                    query_illustration_complete_description,
                     text=prompt_story,
                     description=illustration["suggestion"]["description"],
                     text_subpart=illustration["suggestion"]["text"],
@@ -207,51 +238,118 @@ class AIStory(Story):
 
             print("Generating illustrations ...")
             args = [
-                [description, "vivid", working_folder]
-                for description in illustration_descriptions
+                [self._get_unit_key("image/{}".format(i)), description, "vivid"]
+                for i, description in enumerate(illustration_descriptions)
             ]
 
-            urls = query_in_parallel(
-                function=query_openai_image_generation,
+            def generate_image(key: str, description: str, style: str) -> tuple:
+                asset_id = self._run_checkpointed_asset(
+                    key,
+                    "image_asset",
+                    query_illustration,
+                    description,
+                    style,
+                    self._reuse_similar_images,
+                )
+                if asset_id is None:
+                    return None
+                # Recomputed from a checkpointed image (same content -> same asset ids)
+                return asset_id, make_image_variants(asset_id)
+
+            def set_image_asset(index: int, result: tuple):
+                if result is None:
+                    return
+                asset_id, variant_assets = result
+                module = illustration_generation[index]["module"]
+                module.set_image_asset(asset_id)
+                module.set_image_variant_assets(variant_assets)
+                if self._thumbnail_asset is None:
+                    self._thumbnail_asset = variant_assets.get("thumbnail", asset_id)
+
+            # The part waits for the images within its latency budget
+            self._start_asset_job(
+                name="images",
+                function=generate_image,
                 args_list=args,
                 max_parallel_queries=API_MAX_BATCH_IMAGES,
-                time_between_queries=API_BATCH_DELAY,
+                on_result=set_image_asset,
             )
 
-            for i, url in enumerate(urls):
-                illustration_generation[i]["module"].set_image_path(url)
-
         return ERRORCODE_NO_ERROR, generated_modules
 
+    @staticmethod
+    def from_dict(story_dict: dict, decode_part_source: callable = None):
+        """
+        Create a story from its dictionary (Story.to_dict format).
+        The parts are decoded on first access.
+
+        Args:
+            story_dict (dict): the story dictionary
+            decode_part_source (callable): decodes a part of story_dict["story_parts"] (None -> serialized modules)
+        """
+        story = AIStory(
+            title="Title",
+            overview=story_dict["overview"],
+            need_illustration=story_dict["need_illustration"],
+            generate_speeches=story_dict["generate_speeches"],
+            target_lang=story_dict["target_lang"],
+            story_length=story_dict["story_length"],
+            id=story_dict["id"],
+            reuse_similar_images=story_dict.get("reuse_similar_images", True),
+        )
+        story._title_module = TextModule.from_dict(story_dict["title"])
+        story._budget_overruns = story_dict.get("budget_overruns", [])
+        story._thumbnail_asset = story_dict.get("thumbnail_asset")
+        story._story_parts = LazyStoryParts(
+            story_dict["story_parts"], decode_part_source
+        )
+        story._part_links = [
+            None if link is None else list(link)
+            for link in story_dict.get("part_links", [])
+        ]
+        story._active_part = story_dict.get("active_part")
+        # Units of an interrupted generation (see Story._run_checkpointed)
+        story._checkpoints = dict(story_dict.get("checkpoints", {}))
+        story._drop_completed_checkpoints()
+        return story
+
     @staticmethod
     def load_story(directory: str):
         """
-        Load a story from a directory.
+        Load a story from a directory or a story bundle.
+        Only the metadata is decoded: the parts are decoded on first access
+        (legacy story.json files are also supported).
+        The assets of a bundle are served from the bundle (and copied to the asset store when
+        the story is saved, Ex: continued).
 
         Args:
             directory (str): the directory of the story (Example: "out/stories/story_id")
+                or the path of a bundle (Example: "out/bundles/story_id.rvb")
 
         Returns:
             Story: the loaded story or None if the story does not exist
         """
+        # The saves of the story still queued are written first
+        flush_saves(os.path.normpath(directory))
         if not os.path.exists(directory):
             return None
 
-        filename = os.path.join(directory, "story.json")
-        with open(filename, "r") as file:
-            story_dict = json.load(file)
-            story = AIStory(
-                title="Title",
-                overview=story_dict["overview"],
-                need_illustration=story_dict["need_illustration"],
-                generate_speeches=story_dict["generate_speeches"],
-                target_lang=story_dict["target_lang"],
-                story_length=story_dict["story_length"],
-                id=story_dict["id"],
-            )
-            story._title_module = TextModule.from_dict(story_dict["title"])
-            story._story_parts = [
-                StoryPart([StoryModules.from_dict(module) for module in part])
-                for part in story_dict["story_parts"]
-            ]
+        if is_bundle_path(directory):
+            bundle = open_bundle(directory)
+            register_asset_source(bundle)
+            story = AIStory.from_dict(bundle.get_story_dict())
+            story._source_bundle = bundle
             return story
+
+        if has_story_log(directory):
+            story_dict, log_info = read_story_log_lazily(directory)
+            story = AIStory.from_dict(story_dict, decode_part_records)
+        else:
+            story_dict, log_info = read_story_dict(directory)
+            if story_dict is None:
+                return None
+            story = AIStory.from_dict(story_dict)
+
+        if os.path.abspath(directory) == os.path.abspath(story.get_working_folder()):
+            story._set_persisted_state(log_info)
+        return story
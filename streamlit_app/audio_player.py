@@ -0,0 +1,319 @@
+import io
+import os
+import pygame
+import queue
+import time
+
+from collections import deque
+from threading import Event, Lock, Thread
+from pygame import mixer
+from metrics import metrics_observe
+from storage.asset_store import open_asset
+from storage.audio_tracks import get_merged_track, get_track_offset
+from streamlit_app.streamlit_utils import to_media_source
+
+###############################################################################################
+# Audio player
+#
+# The speeches of the pages are played by a background thread instead of the Streamlit
+# script: the script sends commands (play a page, stop, next page) and reads the state of
+# the player (which page, finished or not), it never waits for the audio.
+# The player thread sleeps on the pygame event queue: it wakes up on the end-of-music events
+# of the mixer (set_endevent) and on the commands (command queue + wake-up event). The audio
+# sources of a page (merged track, speech files, segments of streamed speeches) are prepared
+# by a feeder thread and played back to back with the music queue of the mixer.
+###############################################################################################
+
+# Time (seconds) between two checks of a speech whose synthesis has not started yet
+AUDIO_PENDING_SPEECH_INTERVAL = 0.1
+
+_END_EVENT = pygame.USEREVENT + 1
+_COMMAND_EVENT = pygame.USEREVENT + 2
+
+_player = None
+_player_lock = Lock()
+
+
+class _Playback:
+    """
+    The audio sources of a page being played.
+    """
+
+    def __init__(self, page, modules: list, story, speech_index: int):
+        self.page = page
+        self.modules = modules
+        self.story = story
+        self.speech_index = speech_index
+        # (source, start time, name hint) ready to be played
+        self.sources = deque()
+        self.is_fed = False
+        self.cancelled = Event()
+        self.start_time = time.time()
+        self.started = False
+
+
+class AudioPlayer:
+    """
+    Play the speeches of the story pages in a background thread.
+    The methods are called by the Streamlit script: they only send commands and read the state.
+    """
+
+    def __init__(self):
+        self._commands = queue.Queue()
+        self._lock = Lock()
+        self._page = None
+        self._page_finished = False
+        self._ready = Event()
+
+        # State of the player thread
+        self._playback = None
+        self._playing = False
+        self._queued = False
+        self._ignored_end_events = 0
+
+        self._thread = Thread(target=self._run, name="audio-player", daemon=True)
+        self._thread.start()
+        self._ready.wait()
+
+    ###########################################################################################
+    # Commands (Streamlit script)
+    ###########################################################################################
+
+    def play_page(self, page, modules: list, story, speech_index: int = 0) -> None:
+        """
+        Play the speeches of a page (stops the page being played).
+
+        Args:
+            page (dict): the page
+            modules (list): the modules of the page that have a speech (generated, streamed or pending)
+            story (Story): the story of the page (the speeches pending while it has pending assets are waited for)
+            speech_index (int): the index of the first played speech among the modules
+        """
+        with self._lock:
+            self._page = page
+            self._page_finished = False
+        self._send("play", _Playback(page, modules, story, speech_index))
+
+    def next_page(self) -> None:
+        """
+        End the page being played now: it is reported as finished.
+        """
+        with self._lock:
+            if self._page is not None:
+                self._page_finished = True
+        self._send("stop")
+
+    def stop(self) -> None:
+        """
+        Stop playing.
+        """
+        with self._lock:
+            self._page = None
+            self._page_finished = False
+        self._send("stop")
+
+    def get_page(self):
+        """
+        Get the page being played (or played to its end), None if stopped.
+        """
+        with self._lock:
+            return self._page
+
+    def is_page_finished(self) -> bool:
+        """
+        Return whether the page was played to its end (or skipped with next_page).
+        """
+        with self._lock:
+            return self._page_finished
+
+    def _send(self, *command) -> None:
+        self._commands.put(command)
+        pygame.event.post(pygame.event.Event(_COMMAND_EVENT))
+
+    ###########################################################################################
+    # Player thread
+    ###########################################################################################
+
+    def _run(self) -> None:
+        # Only the event queue of pygame is used (no window)
+        os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+        pygame.display.init()
+        mixer.init()
+        mixer.music.set_endevent(_END_EVENT)
+        pygame.event.set_allowed([_END_EVENT, _COMMAND_EVENT])
+        self._ready.set()
+
+        while True:
+            event = pygame.event.wait()
+            if event.type == _END_EVENT:
+                self._on_end()
+            while not self._commands.empty():
+                self._on_command(*self._commands.get())
+
+    def _on_command(self, name: str, *args) -> None:
+        if name == "play":
+            self._stop_playback()
+            self._playback = args[0]
+            Thread(
+                target=self._feed,
+                args=(self._playback,),
+                name="audio-feeder",
+                daemon=True,
+            ).start()
+        elif name == "stop":
+            self._stop_playback()
+        elif name == "source":
+            playback, source = args
+            if playback is self._playback:
+                playback.sources.append(source)
+                self._advance()
+        elif name == "fed":
+            playback = args[0]
+            if playback is self._playback:
+                playback.is_fed = True
+                self._advance()
+
+    def _on_end(self) -> None:
+        if self._ignored_end_events > 0:
+            # End of a stopped music
+            self._ignored_end_events -= 1
+            return
+        if self._playback is None:
+            return
+        if mixer.music.get_busy():
+            # The queued source started
+            self._queued = False
+        else:
+            self._playing = False
+            self._queued = False
+        self._advance()
+
+    def _stop_playback(self) -> None:
+        if self._playback is not None:
+            self._playback.cancelled.set()
+            self._playback = None
+        if mixer.music.get_busy():
+            self._ignored_end_events += 1
+            mixer.music.stop()
+        self._playing = False
+        self._queued = False
+
+    def _advance(self) -> None:
+        """
+        Play the next source of the page (or queue it behind the playing one).
+        """
+        playback = self._playback
+        if not self._playing:
+            if len(playback.sources) > 0:
+                source, start, namehint = playback.sources.popleft()
+                mixer.music.load(source, namehint)
+                mixer.music.play(start=start)
+                self._playing = True
+                if not playback.started:
+                    playback.started = True
+                    metrics_observe(
+                        "audio_start_seconds", time.time() - playback.start_time
+                    )
+            elif playback.is_fed:
+                self._playback = None
+                with self._lock:
+                    if self._page is playback.page:
+                        self._page_finished = True
+        elif not self._queued and len(playback.sources) > 0:
+            source, _, namehint = playback.sources.popleft()
+            mixer.music.queue(source, namehint)
+            self._queued = True
+
+    ###########################################################################################
+    # Feeder thread
+    ###########################################################################################
+
+    def _feed(self, playback: _Playback) -> None:
+        """
+        Prepare the audio sources of a page, in order.
+        A source that fails is skipped: the page always ends.
+        """
+        try:
+            if not self._feed_merged_track(playback):
+                self._feed_speeches(playback)
+        except Exception as e:
+            print("Failed to prepare the audio of the page: {}".format(e))
+        finally:
+            self._send("fed", playback)
+
+    def _feed_merged_track(self, playback: _Playback) -> bool:
+        """
+        Play the speeches of the page as one track (no gap between them).
+
+        Returns:
+            bool: False if the speeches cannot be merged (Ex: being synthesized)
+        """
+        modules = playback.modules
+        if not all(module.has_speech_generated() for module in modules):
+            return False
+        try:
+            track = get_merged_track(
+                [
+                    (
+                        module.get_speech_asset() or module.get_speech_file_path(),
+                        module.get_speech(),
+                    )
+                    for module in modules
+                ]
+            )
+            if track is None:
+                return False
+            source = to_media_source(open_asset(track["asset_id"]))
+            start = get_track_offset(track, playback.speech_index)
+        except Exception as e:
+            print("Failed to merge the speeches of the page: {}".format(e))
+            return False
+        self._send("source", playback, (source, start, ""))
+        return True
+
+    def _feed_speeches(self, playback: _Playback) -> None:
+        """
+        Play the speeches of the page one after the other (being synthesized or not mergeable).
+        """
+        for module in playback.modules[playback.speech_index :]:
+            # Wait for the synthesis of the speech to start
+            while (
+                not playback.cancelled.is_set()
+                and not module.has_speech_generated()
+                and module.get_speech_stream() is None
+                and playback.story.has_pending_assets()
+            ):
+                time.sleep(AUDIO_PENDING_SPEECH_INTERVAL)
+            if playback.cancelled.is_set():
+                return
+
+            try:
+                stream = module.get_speech_stream()
+                if stream is not None:
+                    start_time = time.time()
+                    for segment in stream.iter_segments():
+                        if playback.cancelled.is_set():
+                            return
+                        if start_time is not None:
+                            metrics_observe(
+                                "speech_first_audio_seconds", time.time() - start_time
+                            )
+                            start_time = None
+                        self._send("source", playback, (io.BytesIO(segment), 0, "mp3"))
+                elif module.has_speech_generated():
+                    source = to_media_source(module.get_speech())
+                    self._send("source", playback, (source, 0, ""))
+            except Exception as e:
+                # The next speeches of the page are still played
+                print("Failed to play a speech: {}".format(e))
+
+
+def get_audio_player() -> AudioPlayer:
+    """
+    Get the audio player of the process (started on first use).
+    """
+    global _player
+    with _player_lock:
+        if _player is None:
+            _player = AudioPlayer()
+        return _player
@@ -1,10 +1,21 @@
 import streamlit as st
-import os
-import json
-
 from story.story_type.ai_story import AIStory
-from story.story_modules import TextModule
-from datetime import datetime
+from storage.story_catalog import (
+    rebuild_catalog,
+    is_catalog_built,
+    catalog_list_stories,
+    catalog_remove_story,
+    catalog_mark_story_opened,
+)
+from storage.story_search import (
+    rebuild_search_index,
+    is_search_index_built,
+    search_stories,
+    search_remove_story,
+    SEARCH_RESULTS_LIMIT,
+)
+from storage.asset_store import open_asset
+from streamlit_app.streamlit_utils import to_media_source, HISTORY_THUMBNAIL_WIDTH
 
 
 # Should be bot available in the OpenAI TTS and DeepL API
@@ -12,13 +23,21 @@ AVAILABLE_LANGUAGES = [
     {"code": "EN", "name": "English"},
     {"code": "FR", "name": "French"},
 ]
+# Number of stories per page of the history
+STORIES_PER_PAGE = 10
 
 
 def update_story_settings(
-    need_illustration=None, generate_speeches=None, story_length=None, target_lang=None
+    need_illustration=None,
+    generate_speeches=None,
+    story_length=None,
+    target_lang=None,
+    reuse_similar_images=None,
 ):
     if need_illustration is not None:
         st.session_state.story_parameters["need_illustration"] = need_illustration
+    if reuse_similar_images is not None:
+        st.session_state.story_parameters["reuse_similar_images"] = reuse_similar_images
     if generate_speeches is not None:
         st.session_state.story_parameters["generate_speeches"] = generate_speeches
     if story_length is not None:
@@ -32,6 +51,7 @@ def start_dreaming_with_settings(
     generate_speeches,
     story_length,
     target_lang,
+    reuse_similar_images,
     start_dreaming_function: callable,
 ):
     story = AIStory(
@@ -39,65 +59,45 @@ def start_dreaming_with_settings(
         generate_speeches=generate_speeches,
         story_length=story_length,
         target_lang=target_lang,
+        reuse_similar_images=reuse_similar_images,
     )
     start_dreaming_function(story)
 
 
 def load_story(story_path, start_dreaming_function: callable):
     story = AIStory.load_story(story_path)
+    if story is None:
+        # The story folder has been removed
+        catalog_remove_story(story_path)
+        search_remove_story(story_path)
+        return
+    # The least recently opened stories are evicted first (see storage/maintenance.py)
+    catalog_mark_story_opened(story_path)
     start_dreaming_function(story)
 
 
-def get_story_infos():
-    # Get the history of stories
-    story_dirs_path = ["demo_story", "out/stories"]
-    story_dirs = []
-    for directory_path in story_dirs_path:
+def get_story_infos(limit=STORIES_PER_PAGE, after=None):
+    # Get a page of the history of stories (most recently used first)
+    if not is_catalog_built():
+        rebuild_catalog()
 
-        if not os.path.exists(directory_path):
-            continue
+    return catalog_list_stories(limit=limit, after=after)
+
+
+def search_story_infos(query, limit=SEARCH_RESULTS_LIMIT):
+    # Get the stories that best match the query
+    if not is_search_index_built():
+        rebuild_search_index()
+
+    return search_stories(query, limit=limit)
 
-        # Get a list of folder names
-        story_dirs.extend(
-            [
-                os.path.join(directory_path, name)
-                for name in os.listdir(directory_path)
-                if os.path.isdir(os.path.join(directory_path, name))
-            ]
-        )
-    # Open the json
-    stories_info = []
-    for story_dir in story_dirs:
-        story_file = os.path.join(story_dir, "story.json")
-        if not os.path.exists(story_file):
-            continue
-        with open(story_file) as f:
-            json_data = json.load(f)
-
-        title_module = TextModule.from_dict(json_data["title"])
-        title = title_module.get_displayed_text()
-
-        saved_time = datetime.fromisoformat(json_data["saved_time"]).timestamp()
-
-        lang = json_data["target_lang"]
-        if lang == None:
-            lang = "en"
-
-        overview = json_data["overview"]
-
-        stories_info.append(
-            {
-                "title": title,
-                "datetime": saved_time,
-                "overview": overview,
-                "lang": lang,
-                "path": story_dir,
-            }
-        )
 
-    stories_info = sorted(stories_info, key=lambda x: x["datetime"], reverse=True)
+def next_history_page(cursor):
+    st.session_state.history_cursors.append(cursor)
 
-    return stories_info
+
+def previous_history_page():
+    st.session_state.history_cursors.pop()
 
 
 # Main functions
@@ -111,10 +111,14 @@ def refresh_initial_state():
     if "story_parameters" not in st.session_state:
         st.session_state.story_parameters = {
             "need_illustration": True,
+            "reuse_similar_images": True,
             "generate_speeches": True,
             "story_length": 3,
             "target_lang": "EN",
         }
+    if "history_cursors" not in st.session_state:
+        # Cursor of the story before each visited page (keyset paging, None -> first page)
+        st.session_state.history_cursors = [None]
 
 
 def display(start_dreaming_function: callable):
@@ -141,6 +145,20 @@ def display(start_dreaming_function: callable):
             on_change=update_illustration,
         )
 
+        def update_image_reuse():
+            update_story_settings(
+                reuse_similar_images=st.session_state.checkbox_image_reuse
+            )
+
+        # Images of near-identical descriptions are reused instead of generated
+        st.checkbox(
+            "Reuse similar illustrations",
+            value=st.session_state.story_parameters["reuse_similar_images"],
+            key="checkbox_image_reuse",
+            on_change=update_image_reuse,
+            disabled=not st.session_state.story_parameters["need_illustration"],
+        )
+
         def update_speeches():
             update_story_settings(generate_speeches=st.session_state.checkbox_speeches)
 
@@ -199,6 +217,7 @@ def display(start_dreaming_function: callable):
             story_settings["generate_speeches"],
             story_settings["story_length"],
             story_settings["target_lang"],
+            story_settings["reuse_similar_images"],
             start_dreaming_function,
         ),
         use_container_width=True,
@@ -210,7 +229,24 @@ def display(start_dreaming_function: callable):
     """,
         unsafe_allow_html=True,
     )
-    stories_info = get_story_infos()
+    search_query = st.text_input(
+        "🔎 Search a story",
+        key="history_search",
+        placeholder="Title, character, place...",
+    )
+    is_searching = search_query.strip() != ""
+    if is_searching:
+        stories_info = search_story_infos(search_query)
+        if len(stories_info) == 0:
+            st.write("No story found.")
+    else:
+        # One more story tells whether there is a next page
+        stories_info = get_story_infos(
+            limit=STORIES_PER_PAGE + 1,
+            after=st.session_state.history_cursors[-1],
+        )
+    has_next_page = not is_searching and len(stories_info) > STORIES_PER_PAGE
+    stories_info = stories_info[:STORIES_PER_PAGE]
     for story_info in stories_info:
         title = story_info["title"]
         lang = story_info["lang"]
@@ -223,13 +259,51 @@ def display(start_dreaming_function: callable):
             "[TITLE]", title
         )
 
-        st.button(
-            label=latex_button,
-            on_click=load_story,
-            args=(
-                story_info["path"],
-                start_dreaming_function,
-            ),
-            key=story_info["path"],
-            use_container_width=True,
-        )
+        # Thumbnail variant of the first image (stories saved before the variants have none)
+        thumbnail = None
+        if story_info.get("thumbnail_asset") is not None:
+            thumbnail = open_asset(story_info["thumbnail_asset"])
+        if thumbnail is None:
+            button_col = st.container()
+        else:
+            thumbnail_col, button_col = st.columns([0.25, 0.75])
+            with thumbnail_col:
+                st.image(to_media_source(thumbnail), width=HISTORY_THUMBNAIL_WIDTH // 2)
+
+        with button_col:
+            st.button(
+                label=latex_button,
+                on_click=load_story,
+                args=(
+                    story_info["path"],
+                    start_dreaming_function,
+                ),
+                key=story_info["path"],
+                use_container_width=True,
+            )
+
+    page_index = len(st.session_state.history_cursors) - 1
+    if (page_index > 0 or has_next_page) and not is_searching:
+        b1, b2, b3 = st.columns([0.2, 0.6, 0.2])
+        with b1:
+            st.button(
+                "⬅️",
+                key="history_previous_page",
+                on_click=previous_history_page,
+                disabled=page_index == 0,
+                use_container_width=True,
+            )
+        with b2:
+            st.markdown(
+                f"<p style='text-align: center;'>{page_index + 1}</p>",
+                unsafe_allow_html=True,
+            )
+        with b3:
+            st.button(
+                "➡️",
+                key="history_next_page",
+                on_click=next_history_page,
+                args=(stories_info[-1]["cursor"] if has_next_page else None,),
+                disabled=not has_next_page,
+                use_container_width=True,
+            )
@@ -1,6 +1,14 @@
+import io
 import time
 from story.story_modules import *
 
+# Display widths (pixels, high density screens included) of the images: the smallest
+# variant at least as wide is sent to the browser (see storage/image_variants.py)
+# Image column of the story pages (70% of a wide page, whole centered page)
+PAGE_IMAGE_WIDTH = 1024
+# Thumbnails of the history
+HISTORY_THUMBNAIL_WIDTH = 240
+
 
 def stream_data(text):
     for word in text.split(" "):
@@ -8,8 +16,34 @@ def stream_data(text):
         time.sleep(0.05)
 
 
+def to_media_source(source):
+    """
+    Convert a module media (Ex: ImageModule.get_image) for Streamlit and pygame.
+
+    Args:
+        source (str | memoryview): a file path or the content of an asset served from a story bundle
+
+    Returns:
+        str | io.BytesIO: the file path or a file-like object
+    """
+    if isinstance(source, memoryview):
+        return io.BytesIO(source)
+    return source
+
+
+# (module class name, checked type name) -> result of isinstance_story_modules_streamlit
+# (keyed by name: the classes reloaded by the reruns share their entries and are not kept alive)
+_isinstance_cache = {}
+
+
+def _get_class_key(cls: type) -> str:
+    return cls.__module__ + "." + cls.__qualname__
+
+
 # This is a workaround for the Streamlit execution module (object and type caching)
 # https://github.com/streamlit/streamlit/issues/6765
+# The classes may be reloaded between two runs: the types are compared by their
+# type tag (registered modules) or their name (mixins), once per pair of classes.
 def isinstance_story_modules_streamlit(module: StoryModules, module_type: type):
     """
     Check if a module is of a certain type.
@@ -18,13 +52,13 @@ def isinstance_story_modules_streamlit(module: StoryModules, module_type: type):
         module (StoryModules): the module to check (Ex: a module)
         module_type (StoryModules): the type to check for (Ex: TextModule)
     """
-
-    if isinstance(module, module_type):
-        return True
-
-    try:
-        module_obj_type = globals()[module.__class__.__name__]
-        module = module_obj_type(module)
-        return isinstance(module, module_type)
-    except:
-        return False
+    key = (_get_class_key(module.__class__), _get_class_key(module_type))
+    result = _isinstance_cache.get(key)
+    if result is None:
+        type_name = getattr(module_type, "TYPE_TAG", None) or module_type.__qualname__
+        result = isinstance(module, module_type) or any(
+            (getattr(base, "TYPE_TAG", None) or base.__qualname__) == type_name
+            for base in module.__class__.__mro__
+        )
+        _isinstance_cache[key] = result
+    return result
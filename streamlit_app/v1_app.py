@@ -12,45 +12,59 @@ from story.story_modules import (
 from streamlit_extras.stylable_container import stylable_container
 from streamlit_app.streamlit_utils import (
     stream_data,
+    to_media_source,
     isinstance_story_modules_streamlit,
+    PAGE_IMAGE_WIDTH,
 )
+from storage.speech_formats import get_speech_mime_type
 
 ### Display functions
 
 
-def display_module(module, is_new):
+def display_module(module, is_new, part_position=None):
     """
     Display a story module.
 
     Args:
         module (StoryModules): the module to display
         is_new (bool): whether the module is new
+        part_position (int): the position of the part of the module in the displayed story
     """
     unique_key = "".join(random.choices(string.ascii_letters + string.digits, k=6))
     if isinstance_story_modules_streamlit(module, TextModule):
         choice_text = module.get_displayed_text()
         displayed_text = stream_data(choice_text) if is_new else choice_text
         if module.has_speech_generated():
-            st.audio(module.get_speech_file_path(), format="audio/mp3")
+            st.audio(
+                to_media_source(module.get_speech()),
+                format=get_speech_mime_type(module.get_speech_format()),
+            )
 
         st.write(displayed_text)
     elif (
         isinstance_story_modules_streamlit(module, ImageModule)
         and module.has_image_path()
     ):
-        st.image(module.get_image_path(), use_column_width=True)
+        st.image(
+            to_media_source(module.get_image(width=PAGE_IMAGE_WIDTH)),
+            use_column_width=True,
+        )
     elif isinstance_story_modules_streamlit(module, PossibleChoicesModule):
-        disabled = module.has_selected_choice()
         made_choice = module.get_selected_choice()
         choices = [choice for choice in module.get_choices()]
+        # The choice of the last part can be made again (Ex: its part was not generated)
+        is_last_part = part_position is None or part_position >= len(
+            st.session_state.story_parts
+        ) - 1
 
+        # Another choice can be made on a previous part (the story continues on its branch)
         create_button = lambda choice: st.button(
             choice.get_displayed_text(),
             key=f"button_user_input_{unique_key}_{i}",
             use_container_width=True,
             on_click=enter_user_input,
-            args=(choice,),
-            disabled=disabled,
+            args=(choice, part_position),
+            disabled=made_choice == choice and not is_last_part,
         )
 
         for i, choice_text in enumerate(choices):
@@ -69,9 +83,9 @@ def display_module(module, is_new):
                 create_button(choice_text)
 
 
-def display_modules(modules, new_modules):
+def display_modules(modules, new_modules, part_position=None):
     for module in modules:
-        display_module(module, new_modules)
+        display_module(module, new_modules, part_position)
 
 
 def display_story_title():
@@ -87,8 +101,8 @@ def display_story():
     display_story_title()
 
     story_parts = st.session_state.story_parts
-    for story_part in story_parts:
-        display_modules(story_part, False)
+    for part_position, story_part in enumerate(story_parts):
+        display_modules(story_part, False, part_position)
 
 
 ### Main functions
@@ -99,14 +113,23 @@ def continue_dreaming():
 
 
 def stop_dreaming():
+    if st.session_state.story is not None:
+        # Stop paying for parts and assets nobody will read
+        st.session_state.story.cancel_generation()
+        st.session_state.story.cancel_background_assets()
     st.session_state.story = None
     st.session_state.story_extension_requested = False
     st.session_state.is_title_displayed = False
 
 
-def enter_user_input(choice: ChoiceModule):
+def enter_user_input(choice: ChoiceModule, part_position: int = None):
     story = st.session_state.story
-    story.input_user_answer(choice)
+    # A generation still running from a previous run is not needed anymore
+    story.cancel_generation()
+    story.input_user_answer(choice, part_position)
+    if part_position is not None:
+        # The parts after the choice are replaced by the branch of the choice
+        st.session_state.story_parts = story.get_story_parts()[: part_position + 1]
 
     continue_dreaming()
 
@@ -142,14 +165,13 @@ def display():
             if not st.session_state.is_title_displayed:
                 display_story_title()
 
-            generated_modules = []
+            part_position = len(st.session_state.story_parts)
             for generated_part in generated_parts:
-                generated_modules.extend(generated_part.get_modules())
-
-            display_modules(generated_modules, True)
+                display_modules(generated_part.get_modules(), True, part_position)
+                part_position += 1
 
             st.session_state.story_parts.extend(generated_parts)
-        elif not (error_code == 1 or error_code == 2):
+        elif not (error_code == 1 or error_code == 2 or error_code == 5):
             st.error("An error occurred while generating the story.")
             st.error("Error code: " + str(error_code))
 
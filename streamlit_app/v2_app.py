@@ -1,7 +1,6 @@
 import streamlit as st
 import random
 import string
-import time
 
 from story.story_modules import (
     ImageModule,
@@ -13,11 +12,17 @@ from story.story_modules import (
 from streamlit_extras.stylable_container import stylable_container
 from streamlit_app.streamlit_utils import (
     stream_data,
+    to_media_source,
     isinstance_story_modules_streamlit,
+    PAGE_IMAGE_WIDTH,
 )
+from streamlit_app.audio_player import get_audio_player
 from typing import List
-from pygame import mixer
 from openaiAPI import openai_show_usage
+from metrics import metrics_show
+
+# Time (seconds) between two checks of the end of the page played by the audio player
+AUDIO_REFRESH_INTERVAL = 0.25
 
 ### Main functions
 
@@ -28,6 +33,10 @@ def continue_dreaming():
 
 
 def stop_dreaming():
+    if st.session_state.story is not None:
+        # Stop paying for parts and assets nobody will read
+        st.session_state.story.cancel_generation()
+        st.session_state.story.cancel_background_assets()
     st.session_state.story = None
     st.session_state.story_extension_requested = False
     st.session_state.is_title_displayed = False
@@ -36,6 +45,8 @@ def stop_dreaming():
 
 def enter_user_input(choice: ChoiceModule):
     story = st.session_state.story
+    # A generation still running from a previous run is not needed anymore
+    story.cancel_generation()
     story.input_user_answer(choice)
 
     continue_dreaming()
@@ -103,14 +114,14 @@ def display_story_title():
         )
 
 
-def _split_pages(modules) -> List[dict]:
+def _split_pages(modules, has_pending_assets=False) -> List[dict]:
     page_list = []
     started_page = []
     found_image = None
     for module in modules:
-        if (
-            isinstance_story_modules_streamlit(module, ImageModule)
-            and module.has_image_path()
+        # An image still generated in the background gets its page (filled when it arrives)
+        if isinstance_story_modules_streamlit(module, ImageModule) and (
+            module.has_image_path() or has_pending_assets
         ):
             if found_image is not None:
                 page_list.append(
@@ -155,19 +166,23 @@ def _display_page(page, is_new):
                 use_container_width=True,
             )
         with b3:
+            # While reading aloud: the audio player moves to the next page
             st.button(
                 "➡️",
-                on_click=change_page,
-                args=(+1,),
+                on_click=(
+                    skip_audio_page
+                    if st.session_state.story_audio_requested
+                    else change_page
+                ),
+                args=() if st.session_state.story_audio_requested else (+1,),
                 disabled=st.session_state.displayed_page_index
-                == len(st.session_state.pages) - 1
-                or st.session_state.story_audio_requested,
+                == len(st.session_state.pages) - 1,
                 use_container_width=True,
             )
         st.button("🚫 Quit", on_click=stop_dreaming, use_container_width=True)
 
     number_of_modules = len(page["modules"])
-    if page["image"] is None:
+    if page["image"] is None or not page["image"].has_image_path():
         _, col, _ = st.columns([0.25, 0.5, 0.25], gap="medium")
         with col:
             display_modules(page["modules"], is_new)
@@ -177,7 +192,10 @@ def _display_page(page, is_new):
         col1, col2 = st.columns([0.7, 0.3], gap="medium")
 
         with col1:
-            st.image(page["image"].get_image_path(), use_column_width=True)
+            st.image(
+                to_media_source(page["image"].get_image(width=PAGE_IMAGE_WIDTH)),
+                use_column_width=True,
+            )
             display_buttons()
 
         with col2:
@@ -205,9 +223,12 @@ def stop_audio():
     st.session_state.story_audio_requested = False
 
 
+def skip_audio_page():
+    get_audio_player().next_page()
+
+
 def stop_playing_audio():
-    if mixer.music.get_busy():
-        mixer.music.stop()
+    get_audio_player().stop()
 
 
 def _next_audio_page():
@@ -222,37 +243,50 @@ def _next_audio_page():
 def _has_speech_available_page():
     page_number = st.session_state.displayed_page_index
     page = st.session_state.pages[page_number]
-    for module in page["modules"]:
-        if (
-            isinstance_story_modules_streamlit(module, canBeSpeechSynthesized)
-            and module.has_speech_generated()
-        ):
-            return True
-    return False
+    return len(_get_page_speech_modules(page)) > 0
 
 
-def play_audio():
-    if st.session_state.story_audio_requested:
-        page_number = st.session_state.displayed_page_index
-        page = st.session_state.pages[page_number]
-        num_modules = len(page["modules"])
-
-        index = 0
-        while index < num_modules and st.session_state.story_audio_requested:
-            module = page["modules"][index]
-            if (
-                isinstance_story_modules_streamlit(module, canBeSpeechSynthesized)
-                and module.has_speech_generated()
-            ):
-                mixer.music.load(module.get_speech_file_path())
-                mixer.music.play()
-
-                while mixer.music.get_busy():  # wait for speech to finish playing
-                    time.sleep(1)
-            index += 1
+def _is_speech_pending(module) -> bool:
+    # Speech synthesized (streamed) or about to be after the delivery of the part
+    return (
+        module.get_speech_stream() is not None
+        or st.session_state.story.has_pending_assets()
+    )
 
-        if st.session_state.story_audio_requested:
+
+def _get_page_speech_modules(page) -> list:
+    return [
+        module
+        for module in page["modules"]
+        if isinstance_story_modules_streamlit(module, canBeSpeechSynthesized)
+        and (module.has_speech_generated() or _is_speech_pending(module))
+    ]
+
+
+@st.fragment(run_every=AUDIO_REFRESH_INTERVAL)
+def _watch_audio_end():
+    # Reruns alone until the audio player finishes the displayed page
+    player = get_audio_player()
+    page = st.session_state.pages[st.session_state.displayed_page_index]
+    if player.get_page() is page and player.is_page_finished():
+        st.rerun()
+
+
+def play_audio():
+    if not st.session_state.story_audio_requested:
+        return
+    player = get_audio_player()
+    page = st.session_state.pages[st.session_state.displayed_page_index]
+    if player.get_page() is not page:
+        modules = _get_page_speech_modules(page)
+        if len(modules) == 0:
             _next_audio_page()
+            return
+        player.play_page(page, modules, st.session_state.story)
+    elif player.is_page_finished():
+        _next_audio_page()
+        return
+    _watch_audio_end()
 
 
 # Main
@@ -263,7 +297,7 @@ def set_display_parameters(page_title, page_icon):
 
 
 def refresh_initial_state():
-    mixer.init()
+    get_audio_player()
     if "story_extension_requested" not in st.session_state:
         st.session_state.story_extension_requested = False
     if "is_title_displayed" not in st.session_state:
@@ -290,6 +324,7 @@ def display():
             error_code, generated_parts = story.generate_next_parts()
 
         openai_show_usage()
+        metrics_show()
 
         if error_code == 3 or error_code == 4:
             st.error("An error occurred while generating the story.")
@@ -297,7 +332,9 @@ def display():
         elif error_code == 0:
             added_page = False
             for generated_part in generated_parts:
-                pages = _split_pages(generated_part.get_modules())
+                pages = _split_pages(
+                    generated_part.get_modules(), story.has_pending_assets()
+                )
                 if len(pages) > 0:
                     added_page = True
                     st.session_state.pages.extend(pages)